@@ -0,0 +1,172 @@
+import json
+from datetime import datetime
+from functools import wraps
+
+from flask import request, make_response, url_for
+from flask_login import current_user
+from flask_restful import Api, Resource, abort
+
+from models import db, User, Task
+
+# fields the tasks API can give, (fields) picks a subset
+TASK_FIELDS = ("id", "title", "description", "status", "time_estimate", "priority", "updated_at", "freetimes")
+# ways (freetimes) links are given, as ids or as embedded freetimes with their times
+LINK_STYLES = ("ids", "embed")
+# most tasks in one page of the list
+MAX_LIMIT = 500
+
+def dumps(data):
+    """encodes json without the whitespace & key sorting pretty printing adds"""
+    return json.dumps(data, separators=(",", ":"), default=encode_value)
+
+def encode_value(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    raise TypeError(f"can't encode {type(value).__name__} as json")
+
+def output_json(data, code, headers=None):
+    """the api's json representation, compact whatever JSON settings the app has"""
+    resp = make_response(dumps(data), code)
+    resp.headers.extend(headers or {})
+    resp.mimetype = "application/json"
+    return resp
+
+def api_login_required(view):
+    """answers 401 instead of redirecting to the login page when nobody's logged in"""
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        if not current_user.is_authenticated:
+            abort(401, error="must be logged in")
+        return view(*args, **kwargs)
+    return wrapper
+
+def read_fields():
+    """reads the (fields) & (freetimes) link style of a request
+
+    Returns:
+        tuple(tuple[string], string): the fields to give & how freetimes are linked
+    """
+    fields = request.args.get("fields")
+    fields = tuple(field for field in fields.split(",") if field) if fields else TASK_FIELDS
+    unknown = set(fields) - set(TASK_FIELDS)
+    if unknown:
+        abort(400, error=f"(fields) must be some of {', '.join(TASK_FIELDS)}")
+    links = request.args.get("freetimes", "ids")
+    if links not in LINK_STYLES:
+        abort(400, error=f"(freetimes) must be one of {', '.join(LINK_STYLES)}")
+    return fields, links
+
+def serialize_tasks(tasks, fields, links):
+    """turns tasks into dicts of the given fields, the freetimes of all of them found with one query"""
+    freetimes = Task.get_freetime_links([t.id for t in tasks], links == "embed") if "freetimes" in fields else {}
+    columns = [field for field in fields if field != "freetimes"]
+    items = []
+    for task in tasks:
+        item = {field: getattr(task, field) for field in columns}
+        if "freetimes" in fields:
+            item["freetimes"] = freetimes[task.id]
+        items.append(item)
+    return items
+
+def apply(operations):
+    """applies operations on the current user's tasks & commits the ones that were valid
+
+    Returns:
+        list[dict]: the results of Task.apply_batch
+    """
+    results = Task.apply_batch(current_user.id, operations)
+    if any(result["ok"] for result in results):
+        User.bump_version(current_user.id)
+        db.session.commit()
+    return results
+
+def get_owned_task(id, fields):
+    """loads a task of the current user with only the columns fields need, 404 for anyone else's"""
+    columns = [field for field in fields if field != "freetimes"]
+    task = Task.query.options(db.load_only(*columns or ["id"])).filter(Task.id == id, Task.user_id == current_user.id).one_or_none()
+    if task is None:
+        abort(404, error="must provide the (id) of a task the user owns")
+    return task
+
+class TaskListResource(Resource):
+    """the user's tasks, a page at a time, & creating new ones"""
+    method_decorators = [api_login_required]
+
+    def get(self):
+        """gives a page of tasks in (sort) order after (cursor), (limit) of them
+
+        (fields) picks which fields each task has & (freetimes) whether blocked freetimes
+        are given as ids or embedded.
+        """
+        fields, links = read_fields()
+        limit = min(max(request.args.get("limit", 100, type=int), 1), MAX_LIMIT)
+        try:
+            tasks, next_cursor = Task.get_user_tasks_page(
+                current_user.id, request.args.get("sort") or None, request.args.get("cursor"), limit,
+                only=[field for field in fields if field != "freetimes"],
+            )
+        except ValueError:
+            abort(400, error="(cursor) must be the next_cursor of a previous page")
+        return dict(tasks=serialize_tasks(tasks, fields, links), next_cursor=next_cursor)
+
+    def post(self):
+        """creates a task from its json fields, optionally blocked into (freetimes)"""
+        data = request.get_json(silent=True)
+        if not isinstance(data, dict):
+            abort(400, error="must provide the task's fields as a json object")
+        result, = apply([dict(data, op="create")])
+        if not result["ok"]:
+            abort(400, error=result["error"])
+        fields, links = read_fields()
+        task = get_owned_task(result["id"], fields)
+        return serialize_tasks([task], fields, links)[0], 201, {"Location": url_for("api_task", id=task.id)}
+
+class TaskResource(Resource):
+    """one of the user's tasks"""
+    method_decorators = [api_login_required]
+
+    def get(self, id):
+        fields, links = read_fields()
+        return serialize_tasks([get_owned_task(id, fields)], fields, links)[0]
+
+    def patch(self, id):
+        """changes the fields sent, (freetimes) replaces the task's blocks"""
+        data = request.get_json(silent=True)
+        if not isinstance(data, dict):
+            abort(400, error="must provide the fields to change as a json object")
+        result, = apply([dict(data, op="update", id=id)])
+        if not result["ok"]:
+            abort(404 if "(id)" in result["error"] else 400, error=result["error"])
+        fields, links = read_fields()
+        return serialize_tasks([get_owned_task(id, fields)], fields, links)[0]
+
+    def delete(self, id):
+        result, = apply([dict(op="delete", id=id)])
+        if not result["ok"]:
+            abort(404, error=result["error"])
+        return make_response("", 204)
+
+class TaskBatchResource(Resource):
+    """many task creates / updates / deletes in one transaction"""
+    method_decorators = [api_login_required]
+
+    def post(self):
+        """applies a json list of (operations) (or an object with an (operations) list)
+
+        Answers with a result per operation, the invalid ones are skipped & the rest saved.
+        """
+        operations = request.get_json(silent=True)
+        if isinstance(operations, dict):
+            operations = operations.get("operations")
+        if not isinstance(operations, list):
+            abort(400, error="must provide a list of (operations)")
+        return dict(results=apply(operations))
+
+def make_api(app):
+    """mounts the tasks api under /api on the app"""
+    api = Api(app, prefix="/api")
+    api.representation("application/json")(output_json)
+    api.add_resource(TaskListResource, "/tasks", endpoint="api_tasks")
+    api.add_resource(TaskBatchResource, "/tasks/batch", endpoint="api_tasks_batch")
+    api.add_resource(TaskResource, "/tasks/<int:id>", endpoint="api_task")
+    return api
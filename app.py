@@ -1,13 +1,31 @@
-from flask import Flask, render_template, redirect, url_for, flash, request, abort, jsonify
+from flask import Flask, render_template, redirect, url_for, flash, request, abort, jsonify, Response, stream_with_context, g, session, make_response
 from flask_login import LoginManager, current_user, login_user, logout_user, login_required
 from urllib.parse import urlparse, urljoin
-import dateutil.parser as dt
+from markupsafe import Markup
 from flask_cors import CORS
-from requests import get
+from itsdangerous import URLSafeSerializer, BadSignature
+from functools import wraps
+from datetime import timedelta
+from hashlib import sha1
+from time import time
+import tempfile
+import json
+import click
+import sys
 import os
 
-from models import db, connect_db, User, Task, Freetime, blocks
+from models import db, connect_db, parse_utc, user_cache, hasher, User, Task, Freetime, FreetimeSeries, PlanDiff, UserCapacity, Job, OVERLAP_POLICIES, STATUSES
 from forms import CreateUserForm, LoginUserForm, UserTaskForm
+from hashing import HasherBusy
+from caching import make_cache
+from profiler import SQLProfiler
+from routing import ReplicaRouter, pool_options
+from api import make_api
+from jobs import job, enqueue, cancel, check_cancelled, registry as job_kinds, JobFailed
+from timefmt import is_timezone
+from planner import make_plan, PLAN_MODES
+from ical import stream_calendar, make_sync_token, read_sync_token, import_events
+from quotes import QuoteStore, QuotesUnavailable, remote_source, file_source, QUOTES_URL
 
 # ***********************************************************************
 # APP CONFIGURATIONS
@@ -15,11 +33,58 @@ from forms import CreateUserForm, LoginUserForm, UserTaskForm
 app = Flask(__name__)
 
 app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
-app.config["SQLALCHEMY_ECHO"] = True
-app.config["SQLALCHEMY_DATABASE_URI"] = os.environ.get("DATABASE_URL", "postgres:///instime").replace("postgres", "postgresql")
+app.config["SQLALCHEMY_ECHO"] = os.environ.get("SQLALCHEMY_ECHO") == "1"
+app.config["SQLALCHEMY_DATABASE_URI"] = os.environ.get("DATABASE_URL", "postgres:///instime").replace("postgres://", "postgresql://", 1)
+# a gevent worker serves many requests at once, so its pool & the wait for a free connection are sized here,
+# per worker from DB_POOL_SIZE etc. or split from a DB_MAX_CONNECTIONS budget for all workers
+app.config["SQLALCHEMY_ENGINE_OPTIONS"] = pool_options("DB")
+# read only requests are spread over the DATABASE_REPLICA_URLS (comma separated), their pools sized by DB_REPLICA_*
+replica_urls = [url.strip().replace("postgres://", "postgresql://", 1) for url in os.environ.get("DATABASE_REPLICA_URLS", "").split(",") if url.strip()]
+app.config["SQLALCHEMY_BINDS"] = {f"replica_{i}": url for i, url in enumerate(replica_urls)}
+app.config["SQLALCHEMY_BIND_ENGINE_OPTIONS"] = {bind: pool_options("DB_REPLICA") for bind in app.config["SQLALCHEMY_BINDS"]}
+app.config["REPLICA_BINDS"] = list(app.config["SQLALCHEMY_BINDS"])
+# how long a user reads from the primary after writing, should be more than the replicas lag behind
+app.config["REPLICA_STICKY_SECONDS"] = float(os.environ.get("REPLICA_STICKY_SECONDS", 5))
+# operations applied per bulk statement by /times/batch
+app.config["BATCH_CHUNK"] = 1000
+app.config["TASKS_PER_PAGE"] = int(os.environ.get("TASKS_PER_PAGE", 100))
+app.config["PLANS_PER_PAGE"] = int(os.environ.get("PLANS_PER_PAGE", 100))
+app.config["PROFILER_SAMPLE_RATE"] = float(os.environ.get("PROFILER_SAMPLE_RATE", 0.01))
+app.config["PROFILER_EXPLAIN_MS"] = float(os.environ["PROFILER_EXPLAIN_MS"]) if os.environ.get("PROFILER_EXPLAIN_MS") else None
+app.config["PROFILER_TOKEN"] = os.environ.get("PROFILER_TOKEN")
+# rendered page fragments are kept per process, FRAGMENT_CACHE=shared keeps them in a sqlite file every worker reads
+app.config["FRAGMENT_CACHE"] = os.environ.get("FRAGMENT_CACHE", "memory")
+app.config["FRAGMENT_CACHE_SIZE"] = int(os.environ.get("FRAGMENT_CACHE_SIZE", 32 * 1024 * 1024))
+app.config["FRAGMENT_CACHE_PATH"] = os.environ.get("FRAGMENT_CACHE_PATH", os.path.join(tempfile.gettempdir(), "instime-fragments.sqlite3"))
+# background jobs: running jobs per user, queued & running jobs a user may have, seconds before a job of a
+# silent worker is taken back, first & longest retry delays & how often idle workers look for jobs
+app.config["JOB_USER_CONCURRENCY"] = int(os.environ.get("JOB_USER_CONCURRENCY", 1))
+app.config["JOB_QUEUE_LIMIT"] = int(os.environ.get("JOB_QUEUE_LIMIT", 20))
+app.config["JOB_TIMEOUT"] = int(os.environ.get("JOB_TIMEOUT", 15 * 60))
+app.config["JOB_BACKOFF"] = float(os.environ.get("JOB_BACKOFF", 10))
+app.config["JOB_BACKOFF_MAX"] = float(os.environ.get("JOB_BACKOFF_MAX", 60 * 60))
+app.config["JOB_POLL_SECONDS"] = float(os.environ.get("JOB_POLL_SECONDS", 1))
 app.config["SECRET_KEY"] = os.environ.get("SECRET_KEY", "p-olIJg0C1yu1oUqaccDgztpWa-J1Ag0")
 
+# quotes are served from memory, QUOTES_FILE swaps the API for a local json file
+quotes_file = os.environ.get("QUOTES_FILE")
+quote_store = QuoteStore(
+    file_source(quotes_file) if quotes_file else remote_source(os.environ.get("QUOTES_URL", QUOTES_URL)),
+    path=os.environ.get("QUOTES_CACHE", os.path.join(tempfile.gettempdir(), "instime-quotes.json")),
+)
+
+fragment_cache = make_cache(
+    app.config["FRAGMENT_CACHE"], app.config["FRAGMENT_CACHE_SIZE"], app.config["FRAGMENT_CACHE_PATH"],
+)
+
+# calendar feed urls carry a signed user id since calendar apps can't log in
+calendar_tokens = URLSafeSerializer(app.config["SECRET_KEY"], salt="calendar-feed")
+
 CORS(app)
+profiler = SQLProfiler(app)
+router = ReplicaRouter(app)
+# the json tasks api under /api
+api = make_api(app)
 login_manager = LoginManager()
 connect_db(app)
 login_manager.init_app(app)
@@ -27,9 +92,21 @@ login_manager.login_view = "login"
 login_manager.login_message = "You must be logged in to access that."
 login_manager.login_message_category = "info"
 
+user_cache.maxsize = int(os.environ.get("USER_CACHE_SIZE", user_cache.maxsize))
+user_cache.ttl = int(os.environ.get("USER_CACHE_TTL", user_cache.ttl))
+
+# repeating freetimes are expanded this many days ahead on every page
+FreetimeSeries.window = timedelta(days=int(os.environ.get("RECURRENCE_DAYS", FreetimeSeries.window.days)))
+
+hasher.rounds = int(os.environ.get("BCRYPT_LOG_ROUNDS", hasher.rounds))
+hasher.configure(
+    workers=int(os.environ.get("HASH_WORKERS", hasher.workers)),
+    max_pending=int(os.environ.get("HASH_MAX_PENDING", hasher.max_pending)),
+)
+
 @login_manager.user_loader
 def load_user(user_id):
-    return User.query.get(user_id)
+    return User.load_identity(user_id)
 
 
 # ***********************************************************************
@@ -44,6 +121,74 @@ def is_safe_url(target):
     return test_url.scheme in ('http', 'https') and \
            ref_url.netloc == test_url.netloc
 
+def get_data_version():
+    """gets the current user's data version & when it changed, once per request"""
+    if "data_version" not in g:
+        g.data_version = User.get_version(current_user.id)
+    return g.data_version
+
+def conditional(max_age=None):
+    """makes a GET view of the current user's data answer 304 when the client's copy is current
+
+    The ETag comes from the user's data version & the day, so a fresh copy is spotted before
+    the view loads anything. There's no Last-Modified, the data changes more than once a
+    second & If-Modified-Since could hand back a stale copy. Pages with flashed messages
+    waiting are always rendered.
+
+    Args:
+        max_age (int, optional): seconds a copy stays valid even when the data didn't change,
+            for pages holding form tokens that expire
+    """
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            if request.method != "GET" or "_flashes" in session:
+                return view(*args, **kwargs)
+            version, _ = get_data_version()
+            # repeating freetimes are expanded from the start of the day, so pages change daily too
+            today, _ = FreetimeSeries.default_window()
+            tag = f"{current_user.id}:{version}:{current_user.timezone}:{today:%Y%m%d}:{request.full_path}"
+            if max_age:
+                window = int(time() // max_age)
+                tag = f"{tag}:{window}"
+            etag = sha1(tag.encode()).hexdigest()
+
+            fresh = request.if_none_match.contains(etag)
+            response = Response(status=304) if fresh else make_response(view(*args, **kwargs))
+            if response.status_code in (200, 304):
+                response.set_etag(etag)
+                response.headers["Cache-Control"] = "private, no-cache"
+                response.vary.add("Cookie")
+            return response
+        return wrapper
+    return decorator
+
+def render_fragment(name, variant, template, load):
+    """renders a fragment of the current user's page, cached until their data version changes
+
+    Args:
+        name (string): which fragment it is
+        variant (dict): request params the fragment depends on
+        template (string): template rendering the fragment
+        load (function): gives the template's context, only called when the fragment isn't cached
+
+    Returns:
+        Markup: the fragment's html
+    """
+    version, _ = get_data_version()
+    today, _ = FreetimeSeries.default_window()
+    key = f"{name}:{current_user.id}:{version}:{current_user.timezone}:{today:%Y%m%d}:{json.dumps(variant, sort_keys=True)}"
+    html = fragment_cache.get(key)
+    if html is None:
+        html = render_template(template, **load())
+        fragment_cache.set(key, html)
+    return Markup(html)
+
+@app.errorhandler(HasherBusy)
+def hasher_busy(err):
+    """sheds logins & registrations while the password hashing pool is full"""
+    return str(err), 503, {"Retry-After": "1"}
+
 # ***********************************************************************
 # USER REGISTER / LOGIN / LOGOUT
 
@@ -76,6 +221,7 @@ def login():
         if not user:
             form.email.errors.append("Email or Password is incorrect.")
         else:
+            db.session.commit()
             login_user(user, True)
             flash("Successfully logged into your account.", "success")
             next = request.args.get("next")
@@ -92,6 +238,21 @@ def logout():
     flash("Successfully logged out.", "success")
     return redirect(url_for("home_page"))
 
+@app.route("/timezone", methods=["GET", "POST"])
+@login_required
+def user_timezone():
+    """gets or sets (POST json with a (timezone) name) the zone the user's times are shown in"""
+    if request.method == "GET":
+        return jsonify(timezone=current_user.timezone)
+    timezone = (request.get_json(silent=True) or {}).get("timezone")
+    if not is_timezone(timezone):
+        return jsonify(error="must provide a known (timezone) name, like America/New_York")
+    user = User.query.get(current_user.id)
+    user.timezone = timezone
+    User.bump_version(user.id)
+    db.session.commit()
+    return jsonify(timezone=timezone)
+
 # ***********************************************************************
 # HOME PAGE
 
@@ -104,33 +265,44 @@ def home_page():
 def get_quotes():
     """attempts to get quotes"""
     try:
-        quotes = get("https://goquotes-api.herokuapp.com/api/v1/all/quotes")
-        return jsonify(quotes.json())
-    except Exception as err:
-        return jsonify(error=err), 500
+        return jsonify(quotes=quote_store.all())
+    except QuotesUnavailable as err:
+        return jsonify(error=str(err)), 503
+
+@app.route("/quotes/random")
+def get_random_quote():
+    """attempts to get a single random quote"""
+    try:
+        return jsonify(quote=quote_store.random())
+    except QuotesUnavailable as err:
+        return jsonify(error=str(err)), 503
 
 # ***********************************************************************
 # TIMES VIEWS
 
 @app.route("/times", methods=["GET", "POST", "PATCH", "DELETE"])
 @login_required
+@conditional()
 def freetimes_view():
     """shows times management for user"""
     if request.method == "GET":
-        freetimes = current_user.freetimes
-        return render_template("user/times.html", freetimes=freetimes)
+        def load():
+            freetimes = current_user.freetimes
+            series = FreetimeSeries.query.filter_by(user_id=current_user.id).order_by(FreetimeSeries.start_time).all()
+            occurrences = FreetimeSeries.expand(current_user.id)
+            labels = Freetime.get_labels(freetimes + occurrences, current_user.timezone)
+            series_labels = Freetime.get_labels(series, current_user.timezone)
+            return dict(freetimes=freetimes, series=series, occurrences=occurrences, labels=labels, series_labels=series_labels)
+        fragment = render_fragment("times", {}, "user/times-list.html", load)
+        return render_template("user/times.html", fragment=fragment)
 
     elif request.method == "POST":
         start_time = request.json.get("start")
         end_time = request.json.get("end")
+        if start_time and end_time and request.json.get("repeat"):
+            return save_series(start_time, end_time, request.json["repeat"])
         if start_time and end_time:
-            start_time = dt.parse(start_time).isoformat()
-            end_time = dt.parse(end_time).isoformat()
-            freetime = Freetime(start_time=start_time, end_time=end_time, user_id=current_user.id)
-            db.session.add(freetime)
-            db.session.commit()
-            flash("Successfully added your new freetime.", "success")
-            return jsonify(url=url_for("freetimes_view"))
+            return save_freetime(start_time, end_time)
         return jsonify(error="required data not provided (start/end) times")
 
     freetime_id = request.json.get("id")
@@ -139,7 +311,9 @@ def freetimes_view():
         if freetime and freetime.user_id == current_user.id:
 
             if request.method == "DELETE":
+                Freetime.skip_occurrences(Freetime.id == freetime.id)
                 db.session.delete(freetime)
+                User.bump_version(current_user.id)
                 db.session.commit()
                 flash("Successfully deleted your freetime.", "success")
                 return jsonify(url=url_for("freetimes_view"))
@@ -147,63 +321,332 @@ def freetimes_view():
             start_time = request.json.get("start")
             end_time = request.json.get("end")
             if start_time and end_time:
-                start_time = dt.parse(start_time).isoformat()
-                end_time = dt.parse(end_time).isoformat()
-                freetime.start_time = start_time
-                freetime.end_time = end_time
-                db.session.commit()
-                flash("Successfully updated your freetime.", "success")
-                return jsonify(url=url_for("freetimes_view"))
+                return save_freetime(start_time, end_time, freetime)
 
         if request.method == "DELETE":
             return jsonify(error="must provide the (id) of a freetime the user owns")
 
         return jsonify(error="must provide the (id) of a freetime the user owns & the (start/end) times")
 
+def save_freetime(start_time, end_time, freetime=None):
+    """creates or updates a freetime of the current user from the json request
+
+    Args:
+        start_time (string): start time sent by the client
+        end_time (string): end time sent by the client
+        freetime (Freetime, optional): the freetime to update, else a new one is made
+
+    Returns:
+        Response: json with the url to go to next & the freetime's id, or an error
+    """
+    overlap = request.json.get("overlap", "reject")
+    if overlap not in OVERLAP_POLICIES:
+        return jsonify(error=f"(overlap) must be one of {', '.join(OVERLAP_POLICIES)}")
+    start_time = parse_utc(start_time)
+    end_time = parse_utc(end_time)
+    if end_time <= start_time:
+        return jsonify(error="(start) time must be before the (end) time")
+    saved, conflicts = Freetime.save_window(current_user.id, start_time, end_time, overlap, freetime)
+    if not saved:
+        db.session.rollback()
+        flash("That freetime overlaps with other freetimes you have.", "danger")
+        return jsonify(
+            error="freetime overlaps with other freetimes of the user",
+            conflicts=[f.id for f in conflicts], url=url_for("freetimes_view"),
+        )
+    User.bump_version(current_user.id)
+    db.session.commit()
+    if freetime:
+        flash("Successfully updated your freetime.", "success")
+    else:
+        flash("Successfully added your new freetime.", "success")
+    return jsonify(url=url_for("freetimes_view"), id=saved.id)
+
+def save_series(start_time, end_time, repeat):
+    """creates a repeating freetime of the current user, repeating in the user's timezone
+
+    Args:
+        start_time (string): start of the first occurrence
+        end_time (string): end of the first occurrence
+        repeat (string): the RRULE it repeats by, like FREQ=WEEKLY;BYDAY=MO,WE
+
+    Returns:
+        Response: json with the url to go to next or an error
+    """
+    try:
+        rule = FreetimeSeries.check_rule(repeat)
+    except ValueError as err:
+        return jsonify(error=f"(repeat) must be a recurrence rule like FREQ=WEEKLY, {err}")
+    start_time = parse_utc(start_time)
+    end_time = parse_utc(end_time)
+    if end_time <= start_time:
+        return jsonify(error="(start) time must be before the (end) time")
+    series = FreetimeSeries(start_time=start_time, end_time=end_time, rule=rule, timezone=current_user.timezone, user_id=current_user.id)
+    db.session.add(series)
+    User.bump_version(current_user.id)
+    db.session.commit()
+    flash("Successfully added your repeating freetime.", "success")
+    return jsonify(url=url_for("freetimes_view"), id=series.id)
+
+@app.route("/times/series/<int:id>", methods=["DELETE"])
+@login_required
+def delete_series(id):
+    """deletes a repeating freetime, occurrences tasks were blocked into stay as freetimes"""
+    series = FreetimeSeries.query.get(id)
+    if not series or series.user_id != current_user.id:
+        return jsonify(error="must provide the (id) of a repeating freetime the user owns")
+    db.session.delete(series)
+    User.bump_version(current_user.id)
+    db.session.commit()
+    flash("Successfully deleted your repeating freetime.", "success")
+    return jsonify(url=url_for("freetimes_view"))
+
+@app.route("/times/occurrences", methods=["DELETE"])
+@login_required
+def skip_occurrence():
+    """takes one occurrence, by its (id) key, out of a repeating freetime"""
+    if not FreetimeSeries.skip(current_user.id, (request.get_json(silent=True) or {}).get("id")):
+        return jsonify(error="must provide the (id) of an occurrence of a repeating freetime the user owns")
+    User.bump_version(current_user.id)
+    db.session.commit()
+    flash("Successfully skipped that freetime.", "success")
+    return jsonify(url=url_for("freetimes_view"))
+
+@app.route("/times/batch", methods=["POST"])
+@login_required
+def batch_freetimes():
+    """applies many freetime creates / updates / deletes in one transaction
+
+    Takes a json list of operations (or an object with an (operations) list) and answers with
+    a result per operation. An application/x-ndjson body, one operation per line, is read &
+    applied in chunks as it streams in and the results are streamed back the same way, ending
+    with a line saying whether the batch was (committed). Creates & updates overlapping other
+    freetimes are rejected like single writes, unless the (overlap) query param is allow.
+    """
+    user_id = current_user.id
+    overlap = request.args.get("overlap", "reject")
+    if overlap not in ("reject", "allow"):
+        return jsonify(error="(overlap) must be one of reject, allow")
+    if request.mimetype == "application/x-ndjson":
+        return Response(stream_with_context(stream_freetime_batch(user_id, overlap)), mimetype="application/x-ndjson")
+
+    operations = request.get_json(silent=True)
+    if isinstance(operations, dict):
+        operations = operations.get("operations")
+    if not isinstance(operations, list):
+        return jsonify(error="must provide a list of (operations)")
+    size = app.config["BATCH_CHUNK"]
+    results = []
+    for offset in range(0, len(operations), size):
+        results.extend(Freetime.apply_batch(user_id, operations[offset:offset + size], offset, overlap))
+    User.bump_version(user_id)
+    db.session.commit()
+    return jsonify(results=results)
+
+def stream_freetime_batch(user_id, overlap):
+    """reads ndjson operations from the request body & yields ndjson results, chunk by chunk
+
+    Results stream before the batch commits, so a last line tells whether it was (committed)
+    along with how many operations were (ok) & (failed), or the (error) it was rolled back for.
+    """
+    size = app.config["BATCH_CHUNK"]
+    chunk, offset, counts = [], 0, dict(ok=0, failed=0)
+    def apply(chunk, offset):
+        for result in Freetime.apply_batch(user_id, chunk, offset, overlap):
+            counts["ok" if result["ok"] else "failed"] += 1
+            yield json.dumps(result) + "\n"
+    try:
+        for line in request.stream:
+            if not line.strip():
+                continue
+            try:
+                chunk.append(json.loads(line))
+            except ValueError:
+                chunk.append(None)
+            if len(chunk) == size:
+                yield from apply(chunk, offset)
+                offset += len(chunk)
+                chunk = []
+        yield from apply(chunk, offset)
+        User.bump_version(user_id)
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        app.logger.exception("freetime batch of user %s failed", user_id)
+        yield json.dumps(dict(committed=False, error="batch failed, nothing was saved")) + "\n"
+        return
+    yield json.dumps(dict(committed=True, **counts)) + "\n"
+
+@app.route("/times/normalize", methods=["GET", "POST"])
+@login_required
+def normalize_freetimes():
+    """previews (GET) or applies (POST) merging the user's overlapping & touching freetimes"""
+    if request.method == "GET":
+        merged = Freetime.coalesce(current_user.id)
+    else:
+        merged = Freetime.normalize(current_user.id)
+        User.bump_version(current_user.id)
+        db.session.commit()
+    count = sum(len(ids) - 1 for _, _, ids in merged)
+    if request.method == "POST":
+        flash(f"Merged {count} of your freetimes into others.", "success")
+    return jsonify(
+        url=url_for("freetimes_view"), merged=count,
+        freetimes=[dict(start=start, end=end, ids=ids) for start, end, ids in merged],
+    )
+
+@app.route("/times/import", methods=["POST"])
+@login_required
+def import_freetimes():
+    """imports the events of an .ics file, sent as a (calendar) file or a text/calendar body, as freetimes
+
+    Events already imported (matched by their UID) are skipped & overlaps aren't checked.
+    """
+    upload = request.files.get("calendar")
+    if upload:
+        lines = upload.stream
+    elif request.mimetype == "text/calendar":
+        lines = request.stream
+    else:
+        return jsonify(error="must provide a (calendar) .ics file")
+    counts = import_events(current_user.id, lines)
+    User.bump_version(current_user.id)
+    db.session.commit()
+    flash(f"Imported {counts['imported']} freetimes from your calendar.", "success")
+    return jsonify(url=url_for("freetimes_view"), **counts)
+
+@app.route("/times/overlaps")
+@login_required
+def get_overlapping_freetimes():
+    """gets the user's freetimes that overlap the (start/end) query params"""
+    start_time = request.args.get("start")
+    end_time = request.args.get("end")
+    if not (start_time and end_time):
+        return jsonify(error="required data not provided (start/end) times")
+    start_time = parse_utc(start_time)
+    end_time = parse_utc(end_time)
+    if end_time < start_time:
+        return jsonify(error="(start) time must not be after the (end) time")
+    freetimes = Freetime.get_overlapping(current_user.id, start_time, end_time)
+    return jsonify(freetimes=[dict(id=f.id, start=f.start_time, end=f.end_time) for f in freetimes])
+
 @app.route("/times/<int:id>")
 @login_required
+@conditional()
 def get_freetime(id):
     """gets a specific freetime if exists"""
     freetime = Freetime.query.get(id)
     if freetime and freetime.user_id == current_user.id:
-        return jsonify(start=freetime.start_time, end=freetime.end_time)
+        return jsonify(
+            start=freetime.start_time, end=freetime.end_time,
+            committed_minutes=freetime.committed_minutes, open_minutes=freetime.open_minutes,
+        )
     return jsonify(error="requires (id) of freetime and must belong to the user")
 
 # ***********************************************************************
 # TASKS PAGE VIEWS
 
+def get_owned_freetime_ids(freetime_ids):
+    """keeps the freetime ids the current user owns, flashing about the rest, picked occurrences
+    of repeating freetimes are saved as freetimes
+
+    Args:
+        freetime_ids (list[string]): ids of freetimes or occurrence keys picked for a task
+
+    Returns:
+        list[int]: the ids that exist & belong to the current user
+    """
+    keys = [id for id in freetime_ids if not id.isdigit()]
+    saved = FreetimeSeries.materialize(current_user.id, keys) if keys else {}
+    freetime_ids = [int(id) if id.isdigit() else saved.get(id) for id in freetime_ids]
+    owners = Freetime.get_owners([id for id in freetime_ids if id is not None])
+    owned = []
+    for freetime_id in freetime_ids:
+        owner = owners.get(freetime_id)
+        if owner is None:
+            flash("Oh no, no freetime was found in our database.", "danger")
+        elif owner != current_user.id:
+            flash("You don't own that freetime and can't assign tasks to it.", "danger")
+        else:
+            owned.append(freetime_id)
+    return owned
+
+def read_search_args():
+    """reads the (q) words & the optional (status) & (priority) filters of a task search
+
+    Raises:
+        ValueError: when a filter isn't a valid status or priority
+
+    Returns:
+        dict: the arguments of Task.search after the user id
+    """
+    status = request.args.get("status") or None
+    if status is not None and status not in STATUSES:
+        raise ValueError(f"(status) must be one of {', '.join(STATUSES)}")
+    priority = request.args.get("priority") or None
+    if priority is not None:
+        if not priority.isdigit() or int(priority) > 9:
+            raise ValueError("(priority) must be a number from 0 to 9")
+        priority = int(priority)
+    return dict(text=request.args.get("q", ""), status=status, priority=priority)
+
 @app.route("/tasks", methods=["GET", "POST"])
 @login_required
+# the page's form token expires after WTF_CSRF_TIME_LIMIT (an hour), so copies are reused for half that at most
+@conditional(max_age=30 * 60)
 def tasks_view():
     """shows task management for user"""
     form = UserTaskForm()
-    sort = request.args.get("sort")
-    if sort:
-        tasks = Task.get_user_tasks_by_sort(current_user, sort)
-    else:
-        tasks = current_user.tasks
-    form.freetimes.choices = [(f.id, f"{f.pretty_start} - {f.pretty_end}") for f in current_user.freetimes]
+    form.freetimes.choices = Freetime.get_choices(current_user.id, current_user.timezone, FreetimeSeries.expand(current_user.id))
     if form.validate_on_submit():
         task = Task()
         freetimes = form.freetimes.data
         form.__delitem__("freetimes")
         form.populate_obj(task)
         task.user_id = current_user.id
-        task_freetimes = []
-        for freetime_id in freetimes:
-            freetime = Freetime.query.get(freetime_id)
-            if not freetime:
-                flash("Oh no, no freetime was found in our database.", "danger")
-            elif freetime.user_id != current_user.id:
-                flash("You don't own that freetime and can't assign tasks to it.", "danger")
-            else:
-                task_freetimes.append(freetime)
-        task.freetimes = task_freetimes
         db.session.add(task)
+        task.set_freetimes(get_owned_freetime_ids(freetimes))
+        User.bump_version(current_user.id)
         db.session.commit()
         flash("Successfully created your task.", "success")
         return redirect(url_for("tasks_view"))
-    return render_template("user/tasks.html", tasks=tasks, form=form, submit="Add")
+    sort = request.args.get("sort") or None
+    cursor = request.args.get("cursor")
+    try:
+        search = read_search_args()
+    except ValueError:
+        return abort(400)
+    def load():
+        if search["text"]:
+            tasks = [task for task, _ in Task.search(current_user.id, limit=app.config["TASKS_PER_PAGE"], **search)]
+            return dict(tasks=tasks, sort=sort, next_cursor=None, search=search, statuses=STATUSES)
+        tasks, next_cursor = Task.get_user_tasks_page(current_user.id, sort, cursor, app.config["TASKS_PER_PAGE"])
+        return dict(tasks=tasks, sort=sort, next_cursor=next_cursor, search=search, statuses=STATUSES)
+    try:
+        fragment = render_fragment("tasks", dict(sort=sort, cursor=cursor, **search), "user/tasks-list.html", load)
+    except ValueError:
+        return abort(400)
+    return render_template("user/tasks.html", fragment=fragment, form=form, submit="Add")
+
+@app.route("/tasks/search")
+@login_required
+@conditional()
+def search_tasks():
+    """finds the user's tasks with every word of (q) in their title or description, best matches first
+
+    Words match as prefixes, so it can suggest tasks while the user types. (status) & (priority)
+    narrow the results & (limit) caps them, 20 by default.
+    """
+    try:
+        search = read_search_args()
+    except ValueError as err:
+        return jsonify(error=str(err))
+    limit = min(max(request.args.get("limit", 20, type=int), 1), app.config["TASKS_PER_PAGE"])
+    results = Task.search(current_user.id, limit=limit, **search)
+    return jsonify(tasks=[
+        dict(id=task.id, title=task.title, status=task.status, priority=task.priority, rank=round(rank, 4))
+        for task, rank in results
+    ])
 
 @app.route("/tasks/<int:id>", methods=["DELETE"])
 @login_required
@@ -213,6 +656,7 @@ def delete_task(id):
     if task.user_id != current_user.id:
         return jsonify(error="must provide the (id) of a task the user owns")
     db.session.delete(task)
+    User.bump_version(current_user.id)
     db.session.commit()
     flash("Successfully deleted your task.", "success")
     return jsonify(url=url_for("tasks_view"))
@@ -225,30 +669,20 @@ def update_task(id):
     if task.user_id != current_user.id:
         flash("You must own the task to edit it.", "warning")
         return redirect(url_for("tasks_view"))
-    form = UserTaskForm(obj=task)
-    form.freetimes.choices = [(f.id, f"{f.pretty_start} - {f.pretty_end}") for f in current_user.freetimes]
+    form = UserTaskForm(obj=task, freetimes=task.get_freetime_ids())
+    form.freetimes.choices = Freetime.get_choices(current_user.id, current_user.timezone, FreetimeSeries.expand(current_user.id))
     if form.validate_on_submit():
         freetimes = form.freetimes.data
         form.__delitem__("freetimes")
         form.populate_obj(task)
-        task_freetimes = []
-        for freetime_id in freetimes:
-            freetime = Freetime.query.get(freetime_id)
-            if not freetime:
-                flash("Oh no, no freetime was found in our database.", "danger")
-            elif freetime.user_id != current_user.id:
-                flash("You don't own that freetime and can't assign tasks to it.", "danger")
-            else:
-                task_freetimes.append(freetime)
-        task.freetimes = task_freetimes
+        task.set_freetimes(get_owned_freetime_ids(freetimes))
+        User.bump_version(current_user.id)
         db.session.commit()
         flash("Successfully updated your task.", "success")
         next = request.args.get("next")
         if not is_safe_url(next):
             return abort(400)
         return redirect(next or url_for("tasks_view"))
-    if request.method == "GET":
-        form.freetimes.data = [f.id for f in task.freetimes]
     return render_template("user/edit-task.html", form=form, submit="Save")
 
 # ***********************************************************************
@@ -256,22 +690,201 @@ def update_task(id):
 
 @app.route("/plans")
 @login_required
+@conditional()
 def plans_view():
     """shows block management to user"""
-    plans = (db.session.query(blocks, Task, Freetime, User)
-        .join(Task, Task.id == blocks.c.task_id)
-        .join(Freetime, Freetime.id == blocks.c.freetime_id)
-        .join(User, Task.user_id == User.id)
-        .filter(User.id == current_user.id)
-        .order_by(Freetime.start_time, Freetime.end_time)
-    ).all()
-
-    user_blocks = [(plan[2], plan[3]) for plan in plans]
-
-    open_tasks = [task for task in current_user.tasks if task not in [ub[0] for ub in user_blocks]]
-    open_freetimes = [freetime for freetime in current_user.freetimes if freetime not in [ub[1] for ub in user_blocks]]
-
-    return render_template(
-        "user/plans.html", blocks=user_blocks,
-        open_tasks=open_tasks, open_freetimes=open_freetimes,
+    pages = {key: request.args.get(key) or None for key in ("blocks_cursor", "tasks_cursor", "freetimes_cursor")}
+    def load():
+        plans = PlanDiff(current_user.id, app.config["PLANS_PER_PAGE"], **pages)
+        occurrences = FreetimeSeries.expand(current_user.id, limit=app.config["PLANS_PER_PAGE"])
+        labels = Freetime.get_labels([f for _, f in plans.blocks] + plans.open_freetimes + occurrences, current_user.timezone)
+        return dict(
+            blocks=plans.blocks, open_tasks=plans.open_tasks, open_freetimes=plans.open_freetimes,
+            occurrences=occurrences, plans=plans, pages=pages, labels=labels,
+            capacity=UserCapacity.get(current_user.id),
+        )
+    try:
+        fragment = render_fragment("plans", pages, "user/plans-list.html", load)
+    except ValueError:
+        return abort(400)
+    return render_template("user/plans.html", fragment=fragment)
+
+@app.route("/plans/capacity")
+@login_required
+@conditional()
+def get_capacity():
+    """gets the user's freetime, planned, open & pending (unfinished task) minutes"""
+    return jsonify(UserCapacity.get(current_user.id).to_dict())
+
+@app.route("/plans/auto", methods=["GET", "POST"])
+@login_required
+def auto_plan():
+    """proposes (GET, a dry run) or saves (POST) blocks packing open tasks into open freetimes"""
+    data = request.json if request.is_json else request.args
+    mode = data.get("mode", "greedy")
+    if mode not in PLAN_MODES:
+        return jsonify(error=f"(mode) must be one of {', '.join(PLAN_MODES)}")
+    plan = make_plan(current_user.id, mode)
+    if request.method == "GET":
+        return jsonify(plan.to_dict())
+    User.bump_version(current_user.id)
+    saved = plan.save()
+    db.session.commit()
+    flash(f"Successfully planned {saved} of your tasks.", "success")
+    return jsonify(url=url_for("plans_view"), saved=saved, **plan.to_dict())
+
+# ***********************************************************************
+# CALENDAR FEEDS
+
+@app.route("/calendar")
+@login_required
+def calendar_link():
+    """gets the url of the user's calendar feed, to subscribe to from a calendar app"""
+    return jsonify(url=url_for("calendar_feed", token=calendar_tokens.dumps(current_user.id), _external=True))
+
+@app.route("/calendar/<token>.ics")
+def calendar_feed(token):
+    """streams a user's freetimes & planned blocks as an iCalendar feed
+
+    A (since) time or the (sync) token from a previous download's X-Sync-Token header
+    limits the feed to events that changed after it. Deleted events aren't listed,
+    clients catch those when downloading the whole feed.
+    """
+    try:
+        user_id = calendar_tokens.loads(token)
+    except BadSignature:
+        return abort(404)
+    try:
+        if request.args.get("sync"):
+            since = read_sync_token(request.args["sync"])
+        elif request.args.get("since"):
+            since = parse_utc(request.args["since"])
+        else:
+            since = None
+    except (ValueError, OverflowError):
+        return abort(400)
+    return Response(
+        stream_with_context(stream_calendar(user_id, since)), mimetype="text/calendar",
+        headers={"X-Sync-Token": make_sync_token(), "Content-Disposition": 'inline; filename="instime.ics"'},
     )
+
+# ***********************************************************************
+# BACKGROUND JOBS
+
+@job("auto_plan")
+def run_auto_plan(job):
+    """packs the user's open tasks into open freetimes, like POST /plans/auto with its (mode)"""
+    mode = job.args.get("mode", "greedy")
+    if mode not in PLAN_MODES:
+        raise JobFailed(f"(mode) must be one of {', '.join(PLAN_MODES)}")
+    plan = make_plan(job.user_id, mode)
+    check_cancelled(job)
+    User.bump_version(job.user_id)
+    return dict(planned=plan.save())
+
+@job("import_calendar")
+def run_import_calendar(job):
+    """imports the events of the (calendar) .ics text as freetimes, like POST /times/import"""
+    calendar = job.args.get("calendar")
+    if not isinstance(calendar, str):
+        raise JobFailed("must provide a (calendar) .ics text")
+    counts = import_events(job.user_id, calendar.splitlines(keepends=True))
+    User.bump_version(job.user_id)
+    return counts
+
+@job("normalize_freetimes")
+def run_normalize_freetimes(job):
+    """merges the user's overlapping & touching freetimes, like POST /times/normalize"""
+    merged = Freetime.normalize(job.user_id)
+    User.bump_version(job.user_id)
+    return dict(merged=sum(len(ids) - 1 for _, _, ids in merged))
+
+@job("delete_freetimes")
+def run_delete_freetimes(job):
+    """deletes the user's freetimes that ended (before) a time, all of them without it"""
+    criteria = [Freetime.user_id == job.user_id]
+    if job.args.get("before"):
+        try:
+            criteria.append(Freetime.end_time < parse_utc(job.args["before"]))
+        except (TypeError, ValueError, OverflowError):
+            raise JobFailed("(before) must be a time")
+    Freetime.skip_occurrences(*criteria)
+    deleted = Freetime.query.filter(*criteria).delete(synchronize_session=False)
+    User.bump_version(job.user_id)
+    return dict(deleted=deleted)
+
+@job("reconcile_capacity", max_attempts=1, public=False)
+def run_reconcile_capacity(job):
+    """checks & fixes the capacity counters, like flask reconcile-capacity --fix"""
+    return UserCapacity.reconcile(fix=True)
+
+@app.route("/jobs", methods=["GET", "POST"])
+@login_required
+def jobs_view():
+    """lists the user's latest jobs (GET) or queues a job of (kind) with its (args) (POST)"""
+    if request.method == "GET":
+        jobs = Job.query.filter(Job.user_id == current_user.id).order_by(Job.id.desc()).limit(50)
+        return jsonify(jobs=[job.to_dict() for job in jobs])
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict):
+        return jsonify(error="must provide the job's (kind) & (args) as a json object")
+    kind = job_kinds.get(data["kind"]) if isinstance(data.get("kind"), str) else None
+    if kind is None or not kind.public:
+        names = [name for name, kind in job_kinds.items() if kind.public]
+        return jsonify(error=f"(kind) must be one of {', '.join(names)}")
+    if not isinstance(data.get("args", {}), dict):
+        return jsonify(error="(args) must be an object")
+    pending = Job.query.filter(Job.user_id == current_user.id, Job.status.in_(("queued", "running"))).count()
+    if pending >= app.config["JOB_QUEUE_LIMIT"]:
+        return jsonify(error="too many of your jobs are waiting, try again once some finished"), 429
+    queued = enqueue(kind.name, current_user.id, data.get("args"))
+    db.session.commit()
+    return jsonify(id=queued.id, status=queued.status, url=url_for("get_job", id=queued.id)), 202
+
+@app.route("/jobs/<int:id>")
+@login_required
+def get_job(id):
+    """gets the status of one of the user's jobs, along with its result or error once it's finished"""
+    queued = Job.query.get(id)
+    if queued is None or queued.user_id != current_user.id:
+        return jsonify(error="must provide the (id) of a job the user owns")
+    return jsonify(queued.to_dict())
+
+@app.route("/jobs/<int:id>", methods=["DELETE"])
+@login_required
+def cancel_job(id):
+    """cancels one of the user's jobs, a running job stops at its next check"""
+    queued = Job.query.get(id)
+    if queued is None or queued.user_id != current_user.id:
+        return jsonify(error="must provide the (id) of a job the user owns")
+    if not cancel(id):
+        return jsonify(error="the job already finished")
+    db.session.commit()
+    db.session.refresh(queued)
+    return jsonify(queued.to_dict())
+
+# ***********************************************************************
+# MAINTENANCE COMMANDS
+
+@app.cli.command("reconcile-capacity")
+@click.option("--fix", is_flag=True, help="rewrite the counters that are off")
+def reconcile_capacity(fix):
+    """recounts the capacity counters from scratch & reports any the triggers got wrong
+
+    Meant to run on a schedule, exits with 1 when counters were off & weren't fixed.
+    """
+    drift = UserCapacity.reconcile(fix)
+    click.echo(f"{drift['freetimes']} freetimes & {drift['users']} users had counters off" + (", fixed" if fix else ""))
+    if not fix and (drift["freetimes"] or drift["users"]):
+        sys.exit(1)
+
+@app.cli.command("enqueue-job")
+@click.argument("kind")
+def enqueue_job(kind):
+    """queues a job of the whole app, like reconcile_capacity, for a scheduler to run"""
+    try:
+        queued = enqueue(kind)
+    except ValueError as err:
+        raise click.BadParameter(str(err))
+    db.session.commit()
+    click.echo(f"queued job {queued.id}")
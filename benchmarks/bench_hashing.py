@@ -0,0 +1,60 @@
+"""reports password checks (logins) per second for different bcrypt costs & pool sizes
+
+    python benchmarks/bench_hashing.py --rounds 10 12 --workers 1 2 4 --clients 16
+"""
+import os
+import sys
+from argparse import ArgumentParser
+from threading import Thread
+from time import perf_counter
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from flask_bcrypt import Bcrypt
+from hashing import PasswordHasher, HasherBusy
+
+def run(rounds, workers, clients, seconds):
+    """hammers one hasher from many client threads
+
+    Returns:
+        tuple(float, int): logins per second & how many were shed as busy
+    """
+    hasher = PasswordHasher(Bcrypt(), rounds=rounds, workers=workers, max_pending=clients)
+    hashed_password = hasher.hash("strongpassword123")
+    counts = [0] * clients
+    shed = [0] * clients
+    deadline = perf_counter() + seconds
+
+    def client(i):
+        while perf_counter() < deadline:
+            try:
+                hasher.check(hashed_password, "strongpassword123")
+                counts[i] += 1
+            except HasherBusy:
+                shed[i] += 1
+
+    start = perf_counter()
+    threads = [Thread(target=client, args=(i,)) for i in range(clients)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    hasher.executor.shutdown()
+    return sum(counts) / (perf_counter() - start), sum(shed)
+
+def main():
+    parser = ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rounds", type=int, nargs="+", default=[10, 12])
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4])
+    parser.add_argument("--clients", type=int, default=8, help="concurrent login requests")
+    parser.add_argument("--seconds", type=float, default=3, help="time spent on each setting")
+    args = parser.parse_args()
+
+    print(f"{'rounds':>6} {'workers':>7} {'logins/sec':>10} {'shed':>6}")
+    for rounds in args.rounds:
+        for workers in args.workers:
+            rate, shed = run(rounds, workers, args.clients, args.seconds)
+            print(f"{rounds:>6} {workers:>7} {rate:>10.1f} {shed:>6}")
+
+if __name__ == "__main__":
+    main()
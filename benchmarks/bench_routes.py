@@ -0,0 +1,216 @@
+"""times each route of the app through the test client on generated datasets of several sizes
+
+    python benchmarks/bench_routes.py --sizes small medium --repeat 50
+    python benchmarks/bench_routes.py --save          # store the results as the new baselines
+    python benchmarks/bench_routes.py --only tasks    # cases with "tasks" in their name
+
+Every case reports p50/p99 latency, the most SQL statements one request ran & the peak
+memory traced while serving one request, then checks them against the stored baselines:
+latency & memory may grow by --tolerance, statement counts may not grow at all. Exits with
+1 when anything regressed. The data is loaded into BENCH_DATABASE_URL (postgresql:///instime_bench
+by default) with seed.py's generator, which is wiped & refilled, so nothing outside the machine
+is needed.
+"""
+import os
+import sys
+import json
+import shutil
+import tempfile
+import tracemalloc
+from argparse import ArgumentParser
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from time import perf_counter
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ["DATABASE_URL"] = os.environ.get("BENCH_DATABASE_URL", "postgresql:///instime_bench")
+
+from sqlalchemy import event
+
+from models import db
+from seed import Dataset, load
+from app import app, fragment_cache
+
+app.config["TESTING"] = True
+app.config["WTF_CSRF_ENABLED"] = False
+app.config["PROFILER_SAMPLE_RATE"] = 0.0
+
+BASELINES = os.path.join(os.path.dirname(os.path.abspath(__file__)), "baselines", "routes.json")
+# the datasets, every user gets the given average of tasks & freetimes & user 1 is the one benchmarked
+SIZES = {
+    "small": dict(users=100, tasks=10, freetimes=10),
+    "medium": dict(users=100, tasks=100, freetimes=100),
+    "large": dict(users=100, tasks=1000, freetimes=1000),
+}
+PASSWORD = "password123"
+
+def percentile(values, share):
+    """gives the nearest rank percentile of values, share between 0 & 1"""
+    values = sorted(values)
+    return values[min(len(values) - 1, max(0, round(share * len(values) + 0.5) - 1))]
+
+@contextmanager
+def count_queries(engine):
+    """collects every SQL statement run inside the block"""
+    statements = []
+    def record(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+    event.listen(engine, "before_cursor_execute", record)
+    try:
+        yield statements
+    finally:
+        event.remove(engine, "before_cursor_execute", record)
+
+def page(path):
+    """a case getting a page, fragment caches are emptied first so the page is built every time"""
+    def run(client, step):
+        fragment_cache.clear()
+        return client.get(path)
+    return run
+
+def create_freetime(client, step):
+    # far in the future so the new freetimes never overlap the dataset's
+    start = datetime(2100, 1, 1) + timedelta(hours=2 * step)
+    return client.post("/times", json=dict(start=start.isoformat(), end=(start + timedelta(hours=1)).isoformat()))
+
+def update_freetime(client, step):
+    start = datetime(2100, 1, 1) + timedelta(hours=2 * step, minutes=30)
+    freetime_id = client.created[step]
+    return client.patch("/times", json=dict(id=freetime_id, start=start.isoformat(), end=(start + timedelta(hours=1)).isoformat()))
+
+def delete_freetime(client, step):
+    return client.delete("/times", json=dict(id=client.created[step]))
+
+def login(client, step):
+    return client.post("/login", data=dict(email="user1@example.com", password=PASSWORD))
+
+# name -> request, run in this order, the /times verbs make, move & remove the same freetimes
+CASES = {
+    "tasks": page("/tasks"),
+    "tasks?sort=priority": page("/tasks?sort=priority"),
+    "tasks?sort=status": page("/tasks?sort=status"),
+    "tasks?sort=estimate": page("/tasks?sort=estimate"),
+    "api/tasks": page("/api/tasks"),
+    "api/tasks?fields=id,title": page("/api/tasks?fields=id,title"),
+    "api/tasks?freetimes=embed": page("/api/tasks?freetimes=embed"),
+    "times": page("/times"),
+    "plans": page("/plans"),
+    "times POST": create_freetime,
+    "times PATCH": update_freetime,
+    "times DELETE": delete_freetime,
+    "login": login,
+}
+
+def run_case(client, engine, run, repeat, warmup):
+    """runs a case warmup + repeat times, then once more with memory tracing on
+
+    Returns:
+        dict: p50 & p99 in ms, most statements (queries) & peak memory in KiB
+    """
+    times, queries, peak = [], 0, 0
+    for step in range(-warmup, repeat + 1):
+        # tracing slows everything down, so memory is only traced on a last, untimed request
+        traced = step == repeat
+        if traced:
+            tracemalloc.start()
+        with count_queries(engine) as statements:
+            started = perf_counter()
+            resp = run(client, step)
+            elapsed = perf_counter() - started
+        if traced:
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+        if resp.status_code >= 400 or (resp.is_json and "error" in resp.json):
+            raise RuntimeError(f"request failed with {resp.status_code}: {resp.get_data(as_text=True)[:200]}")
+        if resp.is_json and "id" in (resp.json or {}):
+            client.created[step] = resp.json["id"]
+        # flashed messages would pile up in the session cookie
+        with client.session_transaction() as session:
+            session.pop("_flashes", None)
+        if 0 <= step < repeat:
+            times.append(elapsed * 1000)
+            queries = max(queries, len(statements))
+    return dict(p50=round(percentile(times, 0.5), 3), p99=round(percentile(times, 0.99), 3), queries=queries, memory=round(peak / 1024, 1))
+
+def run_size(size, repeat, warmup, only, seed):
+    """loads one dataset & runs the cases against it
+
+    Returns:
+        dict: case name -> results
+    """
+    directory = tempfile.mkdtemp(prefix="instime-bench-")
+    try:
+        Dataset(**SIZES[size], seed=seed, password=PASSWORD).write(directory)
+        with app.app_context():
+            load(directory)
+            engine = db.engine
+    finally:
+        shutil.rmtree(directory)
+
+    client = app.test_client()
+    # ids of the freetimes made by the POST case, by step
+    client.created = {}
+    login(client, 0)
+    results = {}
+    for name, run in CASES.items():
+        if only and not any(part in name for part in only):
+            continue
+        results[name] = run_case(client, engine, run, repeat, warmup)
+    return results
+
+def compare(results, baselines, tolerance):
+    """checks results against baselines
+
+    Returns:
+        list[string]: one line per regression
+    """
+    regressions = []
+    for key, result in results.items():
+        baseline = baselines.get(key)
+        if not baseline:
+            continue
+        if result["queries"] > baseline["queries"]:
+            regressions.append(f"{key}: {result['queries']} statements, baseline {baseline['queries']}")
+        for metric in ("p50", "p99", "memory"):
+            if result[metric] > baseline[metric] * (1 + tolerance):
+                regressions.append(f"{key}: {metric} {result[metric]}, baseline {baseline[metric]}")
+    return regressions
+
+def main():
+    parser = ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sizes", nargs="+", choices=SIZES, default=["small", "medium"])
+    parser.add_argument("--repeat", type=int, default=30, help="timed requests per case")
+    parser.add_argument("--warmup", type=int, default=3, help="untimed requests before them")
+    parser.add_argument("--only", nargs="*", help="only run cases with one of these in their name")
+    parser.add_argument("--seed", type=int, default=0, help="seed of the generated datasets")
+    parser.add_argument("--baselines", default=BASELINES, help="json file of stored results")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="share latency & memory may grow by")
+    parser.add_argument("--save", action="store_true", help="store the results as the baselines")
+    args = parser.parse_args()
+
+    results = {}
+    print(f"{'case':<36} {'p50 ms':>9} {'p99 ms':>9} {'queries':>7} {'KiB':>9}")
+    for size in args.sizes:
+        for name, result in run_size(size, args.repeat, args.warmup, args.only, args.seed).items():
+            key = f"{size}/{name}"
+            results[key] = result
+            print(f"{key:<36} {result['p50']:>9.2f} {result['p99']:>9.2f} {result['queries']:>7} {result['memory']:>9.1f}")
+
+    baselines = {}
+    if os.path.exists(args.baselines):
+        with open(args.baselines) as file:
+            baselines = json.load(file)
+    if args.save:
+        os.makedirs(os.path.dirname(args.baselines), exist_ok=True)
+        with open(args.baselines, "w") as file:
+            json.dump(dict(baselines, **results), file, indent=2, sort_keys=True)
+        print(f"saved {len(results)} baselines to {args.baselines}")
+        return
+    regressions = compare(results, baselines, args.tolerance)
+    for line in regressions:
+        print(f"REGRESSED {line}")
+    if regressions:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,188 @@
+import os
+import sqlite3
+from collections import OrderedDict
+from threading import Lock
+from time import monotonic, time
+
+class LRUCache:
+    """a thread safe in process cache that drops the least recently used entries
+
+    Entries are weighed with sizeof (1 each by default) and the oldest are evicted
+    once the total weight goes over maxsize. With a ttl, entries older than ttl
+    seconds count as misses.
+    """
+
+    def __init__(self, maxsize=1024, ttl=None, sizeof=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.sizeof = sizeof or (lambda value: 1)
+        self.entries = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = Lock()
+
+    def __repr__(self):
+        return f"<LRUCache entries={len(self.entries)} size={self.size}/{self.maxsize} hits={self.hits} misses={self.misses}>"
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key, default=None):
+        """gives the value for key, or default when missing or expired"""
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and self.ttl is not None and monotonic() - entry[1] > self.ttl:
+                self._drop(key)
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return default
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def set(self, key, value):
+        """stores value under key, evicting old entries to stay within maxsize"""
+        weight = self.sizeof(value)
+        with self.lock:
+            if key in self.entries:
+                self._drop(key)
+            if weight > self.maxsize:
+                return
+            self.entries[key] = (value, monotonic(), weight)
+            self.size += weight
+            while self.size > self.maxsize:
+                self._drop(next(iter(self.entries)))
+
+    def delete(self, key):
+        """removes key if it's cached"""
+        with self.lock:
+            if key in self.entries:
+                self._drop(key)
+
+    def clear(self):
+        """removes every entry"""
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+
+    def stats(self):
+        """gives the hit & miss counters along with the current size"""
+        return dict(hits=self.hits, misses=self.misses, entries=len(self.entries), size=self.size, maxsize=self.maxsize)
+
+    def _drop(self, key):
+        """removes key, the lock must already be held"""
+        self.size -= self.entries.pop(key)[2]
+
+class SQLiteCache:
+    """a cache in a local sqlite file, shared by every worker process on the machine
+
+    Same interface as LRUCache. Values must be strings or bytes, they're weighed by
+    their length and the least recently used are evicted past maxsize.
+    """
+
+    def __init__(self, path, maxsize=32 * 1024 * 1024, ttl=None):
+        self.path = path
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.lock = Lock()
+        self.pid = None
+
+    @property
+    def conn(self):
+        """the connection of this process, a forked worker opens its own"""
+        if self.pid != os.getpid():
+            self._conn = sqlite3.connect(self.path, timeout=5, check_same_thread=False, isolation_level=None)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("""CREATE TABLE IF NOT EXISTS entries (
+                key TEXT PRIMARY KEY, value BLOB NOT NULL, size INTEGER NOT NULL, stored REAL NOT NULL, used REAL NOT NULL
+            )""")
+            self._conn.execute("CREATE INDEX IF NOT EXISTS entries_used ON entries (used)")
+            self.pid = os.getpid()
+        return self._conn
+
+    def __repr__(self):
+        return f"<SQLiteCache {self.path} hits={self.hits} misses={self.misses}>"
+
+    def __len__(self):
+        with self.lock:
+            return self.conn.execute("SELECT COUNT(*) FROM entries").fetchone()[0]
+
+    @property
+    def size(self):
+        with self.lock:
+            return self.conn.execute("SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()[0]
+
+    def get(self, key, default=None):
+        """gives the value for key, or default when missing or expired"""
+        now = time()
+        with self.lock:
+            row = self.conn.execute("SELECT value, stored FROM entries WHERE key = ?", (key,)).fetchone()
+            if row is not None and self.ttl is not None and now - row[1] > self.ttl:
+                self.conn.execute("DELETE FROM entries WHERE key = ?", (key,))
+                row = None
+            if row is None:
+                self.misses += 1
+                return default
+            self.conn.execute("UPDATE entries SET used = ? WHERE key = ?", (now, key))
+            self.hits += 1
+            return row[0]
+
+    def set(self, key, value):
+        """stores value under key, evicting old entries to stay within maxsize"""
+        size = len(value)
+        if size > self.maxsize:
+            return
+        now = time()
+        with self.lock:
+            conn = self.conn
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                conn.execute("INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?)", (key, value, size, now, now))
+                total = conn.execute("SELECT SUM(size) FROM entries").fetchone()[0]
+                if total > self.maxsize:
+                    # drop the least recently used rows until the rest fit
+                    conn.execute("""DELETE FROM entries WHERE key IN (
+                        SELECT key FROM (
+                            SELECT key, SUM(size) OVER (ORDER BY used DESC, key) AS kept FROM entries
+                        ) WHERE kept > ?
+                    )""", (self.maxsize,))
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+
+    def delete(self, key):
+        """removes key if it's cached"""
+        with self.lock:
+            self.conn.execute("DELETE FROM entries WHERE key = ?", (key,))
+
+    def clear(self):
+        """removes every entry"""
+        with self.lock:
+            self.conn.execute("DELETE FROM entries")
+
+    def stats(self):
+        """gives the hit & miss counters along with the current size"""
+        return dict(hits=self.hits, misses=self.misses, entries=len(self), size=self.size, maxsize=self.maxsize)
+
+def make_cache(backend="memory", maxsize=32 * 1024 * 1024, path=None, ttl=None):
+    """builds a cache of strings weighed by length
+
+    Args:
+        backend (string): "memory" for this process only or "shared" for a sqlite file all workers use
+        maxsize (int): most characters (memory) or bytes (shared) kept
+        path (string, optional): the sqlite file for the shared backend
+        ttl (float, optional): seconds entries stay valid
+
+    Returns:
+        LRUCache | SQLiteCache: the cache
+    """
+    if backend == "shared":
+        return SQLiteCache(path, maxsize, ttl)
+    if backend == "memory":
+        return LRUCache(maxsize, ttl, sizeof=len)
+    raise ValueError(f"unknown cache backend {backend}")
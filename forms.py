@@ -23,6 +23,7 @@ class CreateUserForm(ModelForm):
     """form for making users"""
     class Meta:
         model = User
+        exclude = ["timezone", "data_version"]
 
 class LoginUserForm(ModelForm):
     """form for logging in users"""
@@ -35,5 +36,8 @@ class UserTaskForm(ModelForm):
     """form for creating / editing tasks of users"""
     class Meta:
         model = Task
+        # computed by postgres from the title & description
+        exclude = ["search_vector"]
     
-    freetimes = MultiCheckboxField("Freetimes", coerce=int)
+    # freetime ids, or occurrence keys of repeating freetimes
+    freetimes = MultiCheckboxField("Freetimes", coerce=str)
@@ -0,0 +1,18 @@
+"""gunicorn settings, read automatically by the Procfile's `gunicorn app:app`
+
+WEB_WORKER_CLASS=gevent serves every route from cooperative greenlets, so a worker
+waiting on the database or the quotes API keeps serving other connections.
+"""
+import os
+
+worker_class = os.environ.get("WEB_WORKER_CLASS", "sync")
+workers = int(os.environ.get("WEB_CONCURRENCY", 2))
+# open connections each gevent worker serves at once
+worker_connections = int(os.environ.get("WORKER_CONNECTIONS", 1000))
+timeout = int(os.environ.get("WEB_TIMEOUT", 30))
+
+def post_fork(server, worker):
+    """makes psycopg2 yield to other greenlets while it waits on postgres"""
+    if worker_class == "gevent":
+        from psycogreen.gevent import patch_psycopg
+        patch_psycopg()
@@ -0,0 +1,96 @@
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeout
+from threading import BoundedSemaphore
+
+def make_executor(workers):
+    """makes the hashing pool, out of real threads even when gevent patched threading into greenlets
+
+    bcrypt doesn't yield, so on a greenlet it would stall every other request of the worker.
+    """
+    try:
+        from gevent import monkey
+        if monkey.is_module_patched("threading"):
+            from gevent.threadpool import ThreadPoolExecutor as NativeThreadPoolExecutor
+            return NativeThreadPoolExecutor(max_workers=workers)
+    except ImportError:
+        pass
+    return ThreadPoolExecutor(max_workers=workers, thread_name_prefix="hasher")
+
+class HasherBusy(Exception):
+    """raised when too many hashes are already waiting on the pool"""
+
+class PasswordHasher:
+    """runs bcrypt on a bounded thread pool so a login spike can't take every request thread
+
+    bcrypt releases the GIL while it works, so worker threads hash in parallel.
+    Once max_pending jobs are queued or running, new ones fail fast with HasherBusy
+    instead of piling up behind them.
+    """
+
+    def __init__(self, bcrypt, rounds=12, workers=2, max_pending=16, timeout=30):
+        self.bcrypt = bcrypt
+        self.rounds = rounds
+        self.timeout = timeout
+        self.configure(workers, max_pending)
+
+    def __repr__(self):
+        return f"<PasswordHasher rounds={self.rounds} workers={self.workers} max_pending={self.max_pending}>"
+
+    def configure(self, workers, max_pending):
+        """(re)creates the pool with new limits
+
+        Args:
+            workers (int): threads doing the hashing
+            max_pending (int): hashes allowed to be queued or running at once
+        """
+        if getattr(self, "executor", None):
+            self.executor.shutdown(wait=False)
+        self.workers = workers
+        self.max_pending = max(max_pending, workers)
+        self.slots = BoundedSemaphore(self.max_pending)
+        self.executor = make_executor(workers)
+
+    def run(self, fn, *args):
+        """runs fn on the pool & waits for its result
+
+        A hash holds its slot until it finished on the pool, even when the caller stopped
+        waiting for it, so max_pending bounds the pool's real backlog.
+
+        Raises:
+            HasherBusy: when max_pending hashes are already waiting or the hash took longer than timeout
+        """
+        slots = self.slots
+        if not slots.acquire(blocking=False):
+            raise HasherBusy("too many passwords are being checked, try again shortly")
+        try:
+            future = self.executor.submit(fn, *args)
+        except BaseException:
+            slots.release()
+            raise
+        future.add_done_callback(lambda _: slots.release())
+        try:
+            return future.result(self.timeout)
+        except FutureTimeout:
+            raise HasherBusy("checking the password took too long, try again shortly")
+
+    def hash(self, password):
+        """hashes a password with the current number of rounds
+
+        Returns:
+            string: the bcrypt hash
+        """
+        return self.run(self.bcrypt.generate_password_hash, password, self.rounds).decode("utf-8")
+
+    def check(self, hashed_password, password):
+        """checks a password against a bcrypt hash
+
+        Returns:
+            bool: whether the password matches
+        """
+        return self.run(self.bcrypt.check_password_hash, hashed_password, password)
+
+    def needs_rehash(self, hashed_password):
+        """whether a hash was made with a different number of rounds than the current setting"""
+        try:
+            return int(hashed_password.split("$")[2]) != self.rounds
+        except (IndexError, ValueError):
+            return True
@@ -0,0 +1,503 @@
+import re
+from calendar import monthrange
+from datetime import datetime, timedelta
+from functools import lru_cache
+from hashlib import sha1
+
+import dateutil.parser as dt
+from dateutil import tz
+
+from models import db, parse_utc, encode_cursor, decode_cursor, blocks, series_exceptions, Task, Freetime, FreetimeSeries
+from timefmt import is_timezone
+
+# identifies the app as the maker of the feeds
+PRODID = "-//Instime//Instime//EN"
+ICS_TIME = "%Y%m%dT%H%M%SZ"
+ICS_LOCAL_TIME = "%Y%m%dT%H%M%S"
+# rows fetched from the server side cursor (& events written out) at a time
+FETCH_SIZE = 1000
+# how far back a sync token reaches, so rows committed by transactions still running
+# when the feed was read are picked up by the next sync
+SYNC_OVERLAP = timedelta(minutes=1)
+
+# the basic DATE-TIME form nearly every calendar writes, read without dateutil
+ICS_DATETIME = re.compile(r"^(\d{4})(\d{2})(\d{2})T(\d{2})(\d{2})(\d{2})(Z?)$")
+# an iCalendar DURATION like P1D, PT1H30M or P2W
+DURATION = re.compile(r"^\+?P(?:(\d+)W)?(?:(\d+)D)?(?:T(?:(\d+)H)?(?:(\d+)M)?(?:(\d+)S)?)?$")
+# iCalendar's names of the days of the week, monday first like datetime.weekday
+ICS_WEEKDAYS = ("MO", "TU", "WE", "TH", "FR", "SA", "SU")
+# years a zone's offset changes are checked against the yearly rule written for them
+RULE_YEARS = 5
+
+def escape_text(value):
+    """escapes a TEXT value, backslashes, commas, semicolons & newlines"""
+    return (value.replace("\\", "\\\\").replace(";", "\\;").replace(",", "\\,")
+        .replace("\r\n", "\\n").replace("\n", "\\n"))
+
+def fold(line):
+    """splits a content line into 75 octet pieces, continuation lines start with a space
+
+    Returns:
+        string: the folded line ending in CRLF
+    """
+    data = line.encode("utf-8")
+    if len(data) <= 75:
+        return line + "\r\n"
+    pieces, start, limit = [], 0, 75
+    while start < len(data):
+        end = min(start + limit, len(data))
+        # don't cut a multi byte character in half
+        while end < len(data) and data[end] & 0xC0 == 0x80:
+            end -= 1
+        pieces.append(data[start:end].decode("utf-8"))
+        start, limit = end, 74
+    return "\r\n ".join(pieces) + "\r\n"
+
+def format_event(uid, start, end, stamp, summary, description=None):
+    """writes one VEVENT
+
+    Args:
+        uid (string): stable id of the event across downloads
+        start (datetime): naive UTC start
+        end (datetime): naive UTC end
+        stamp (datetime): naive UTC time the event last changed
+        summary (string): the event's title
+        description (string, optional): the event's details
+
+    Returns:
+        string: the event's content lines
+    """
+    lines = [
+        "BEGIN:VEVENT",
+        f"UID:{escape_text(uid)}",
+        f"DTSTAMP:{stamp.strftime(ICS_TIME)}",
+        f"LAST-MODIFIED:{stamp.strftime(ICS_TIME)}",
+        f"DTSTART:{start.strftime(ICS_TIME)}",
+        f"DTEND:{end.strftime(ICS_TIME)}",
+        f"SUMMARY:{escape_text(summary)}",
+    ]
+    if description:
+        lines.append(f"DESCRIPTION:{escape_text(description)}")
+    lines.append("END:VEVENT")
+    return "".join(fold(line) for line in lines)
+
+def format_offset(offset):
+    """writes a UTC offset like -0500, seconds only when there are some"""
+    seconds = int(offset.total_seconds())
+    sign = "-" if seconds < 0 else "+"
+    hours, rest = divmod(abs(seconds), 3600)
+    minutes, seconds = divmod(rest, 60)
+    return f"{sign}{hours:02}{minutes:02}" + (f"{seconds:02}" if seconds else "")
+
+@lru_cache(maxsize=1024)
+def find_transitions(tzid, year):
+    """finds when a zone's UTC offset changes in a year, a day & then 15 minutes at a time
+
+    Returns:
+        tuple(tuple(datetime, timedelta, timedelta)): the naive UTC time of each change & the
+        offsets before & after it
+    """
+    zone, utc = tz.gettz(tzid), tz.tzutc()
+    offset = lambda moment: moment.replace(tzinfo=utc).astimezone(zone).utcoffset()
+    day = datetime(year, 1, 1)
+    current, changes = offset(day), []
+    while day.year == year:
+        following = day + timedelta(days=1)
+        if offset(following) != current:
+            moment = day + timedelta(minutes=15)
+            while offset(moment) == current:
+                moment += timedelta(minutes=15)
+            changes.append((moment, current, offset(moment)))
+            current = offset(moment)
+        day = following
+    return tuple(changes)
+
+def yearly_rule(change):
+    """gives the month, nth (-1 for last) weekday & wall clock time a change falls on, with its offsets"""
+    at, before, after = change
+    local = at + before
+    n = -1 if local.day + 7 > monthrange(local.year, local.month)[1] else (local.day - 1) // 7 + 1
+    return local.month, n, local.weekday(), local.time(), before, after
+
+def format_observance(tzid, change, rule=False):
+    """writes the STANDARD or DAYLIGHT part of a VTIMEZONE starting at a change of offset
+
+    Args:
+        tzid (string): the zone's name
+        change (tuple(datetime, timedelta, timedelta)): when the change happens in UTC & the offsets
+            before & after, as find_transitions gives them
+        rule (bool): repeat the change every year on the same nth weekday of the month
+
+    Returns:
+        list[string]: the part's content lines
+    """
+    at, before, after = change
+    moment = at.replace(tzinfo=tz.tzutc()).astimezone(tz.gettz(tzid))
+    kind = "DAYLIGHT" if moment.dst() else "STANDARD"
+    lines = [
+        f"BEGIN:{kind}",
+        f"DTSTART:{(at + before).strftime(ICS_LOCAL_TIME)}",
+        f"TZOFFSETFROM:{format_offset(before)}",
+        f"TZOFFSETTO:{format_offset(after)}",
+        f"TZNAME:{escape_text(moment.tzname() or tzid)}",
+    ]
+    if rule:
+        month, n, weekday = yearly_rule(change)[:3]
+        lines.append(f"RRULE:FREQ=YEARLY;BYMONTH={month};BYDAY={n}{ICS_WEEKDAYS[weekday]}")
+    lines.append(f"END:{kind}")
+    return lines
+
+def format_timezone(tzid, year):
+    """writes the VTIMEZONE a TZID of the feed refers to, so clients don't have to know the name
+
+    The zone's changes of offset in year become yearly RRULEs when each of the RULE_YEARS after
+    repeats them on the same nth weekday, otherwise every change of those years is listed.
+
+    Args:
+        tzid (string): a timezone name dateutil knows
+        year (int): a year before the first event written in the zone
+
+    Returns:
+        string: the VTIMEZONE's content lines
+    """
+    changes = find_transitions(tzid, year)
+    rules = [yearly_rule(change) for change in changes]
+    later = [find_transitions(tzid, year + i) for i in range(1, RULE_YEARS + 1)]
+    lines = ["BEGIN:VTIMEZONE", f"TZID:{tzid}"]
+    if all([yearly_rule(change) for change in other] == rules for other in later):
+        if changes:
+            for change in changes:
+                lines.extend(format_observance(tzid, change, rule=True))
+        else:
+            offset = datetime(year, 1, 1, tzinfo=tz.gettz(tzid)).utcoffset()
+            lines.extend(format_observance(tzid, (datetime(year, 1, 1) - offset, offset, offset)))
+    else:
+        start = datetime(year, 1, 1, tzinfo=tz.gettz(tzid))
+        lines.extend(format_observance(tzid, (start.replace(tzinfo=None) - start.utcoffset(), start.utcoffset(), start.utcoffset())))
+        for change in changes + tuple(change for other in later for change in other):
+            lines.extend(format_observance(tzid, change))
+    lines.append("END:VTIMEZONE")
+    return "".join(fold(line) for line in lines)
+
+def series_tzid(series):
+    """gives the TZID a series is written in, None for series in UTC"""
+    return series.timezone if series.timezone and is_timezone(series.timezone) else None
+
+def format_series(series, excluded, stamp):
+    """writes one repeating VEVENT for a freetime series, in the series' timezone so it keeps
+    its wall clock time over DST, the feed needs the zone's VTIMEZONE (see format_timezone)
+
+    Args:
+        series (FreetimeSeries): the series
+        excluded (list[datetime]): naive UTC starts of occurrences left out, skipped ones
+            & ones saved as their own freetimes
+        stamp (datetime): naive UTC time the series last changed
+
+    Returns:
+        string: the event's content lines
+    """
+    zone, utc, tzid = series.zone, tz.tzutc(), series_tzid(series)
+    length = series.end_time - series.start_time
+    if tzid:
+        local = lambda value: value.replace(tzinfo=utc).astimezone(zone).strftime(ICS_LOCAL_TIME)
+        param = f";TZID={tzid}"
+    else:
+        local = lambda value: value.strftime(ICS_TIME)
+        param = ""
+    lines = [
+        "BEGIN:VEVENT",
+        f"UID:series-{series.id}@instime",
+        f"DTSTAMP:{stamp.strftime(ICS_TIME)}",
+        f"LAST-MODIFIED:{stamp.strftime(ICS_TIME)}",
+        f"DTSTART{param}:{local(series.start_time)}",
+        f"DURATION:PT{int(length.total_seconds())}S",
+        f"RRULE:{series.rule}",
+    ]
+    if excluded:
+        lines.append(f"EXDATE{param}:{','.join(local(start) for start in sorted(excluded))}")
+    lines.extend(("SUMMARY:Freetime", "END:VEVENT"))
+    return "".join(fold(line) for line in lines)
+
+def make_sync_token(now=None):
+    """makes the token a client sends back to only get events changed after this download"""
+    now = now or datetime.utcnow()
+    return encode_cursor([(now - SYNC_OVERLAP).isoformat()])
+
+def read_sync_token(token):
+    """gives the time a sync token reaches back to
+
+    Raises:
+        ValueError: when the token is malformed
+    """
+    value, = decode_cursor(token, [datetime])
+    return value
+
+def stream_rows(query):
+    """runs a query on a server side cursor, giving its rows FETCH_SIZE at a time"""
+    result = db.session.execute(query.execution_options(stream_results=True, max_row_buffer=FETCH_SIZE))
+    yield from result.partitions(FETCH_SIZE)
+
+def stream_calendar(user_id, since=None):
+    """yields a user's freetimes & planned blocks as an iCalendar feed, a chunk of events at a time
+
+    Args:
+        user_id (int): whose calendar it is
+        since (datetime, optional): only include events changed after this naive UTC time
+
+    Yields:
+        string: pieces of the feed
+    """
+    yield "".join(fold(line) for line in (
+        "BEGIN:VCALENDAR", "VERSION:2.0", f"PRODID:{PRODID}", "CALSCALE:GREGORIAN", "X-WR-CALNAME:Instime",
+    ))
+
+    freetimes = (db.select(Freetime.id, Freetime.uid, Freetime.start_time, Freetime.end_time, Freetime.updated_at)
+        .where(Freetime.user_id == user_id)
+        .order_by(Freetime.start_time))
+    if since:
+        freetimes = freetimes.where(Freetime.updated_at > since)
+    for rows in stream_rows(freetimes):
+        yield "".join(
+            format_event(uid or f"freetime-{id}@instime", start, end, stamp, "Freetime")
+            for id, uid, start, end, stamp in rows
+        )
+
+    series = FreetimeSeries.query.filter(FreetimeSeries.user_id == user_id).order_by(FreetimeSeries.id)
+    if since:
+        series = series.filter(FreetimeSeries.updated_at > since)
+    series = series.all()
+    if series:
+        excluded = {s.id: [] for s in series}
+        skipped = (db.session.query(series_exceptions.c.series_id, series_exceptions.c.occurrence_start)
+            .filter(series_exceptions.c.series_id.in_(excluded)))
+        saved = (db.session.query(Freetime.series_id, Freetime.occurrence_start)
+            .filter(Freetime.series_id.in_(excluded)))
+        for series_id, start in skipped.union_all(saved):
+            excluded[series_id].append(start)
+        years = {}
+        for s in series:
+            tzid = series_tzid(s)
+            if tzid:
+                years[tzid] = min(years.get(tzid, s.start_time.year), s.start_time.year)
+        # a year early so the zone's offsets are known before the first occurrence
+        yield "".join(format_timezone(tzid, year - 1) for tzid, year in sorted(years.items()))
+        yield "".join(format_series(s, excluded[s.id], s.updated_at) for s in series)
+
+    stamp = db.func.greatest(blocks.c.created_at, Task.updated_at, Freetime.updated_at)
+    planned = (db.select(Task.id, Freetime.id, Task.title, Task.description, Freetime.start_time, Freetime.end_time, stamp)
+        .select_from(blocks)
+        .join(Task, Task.id == blocks.c.task_id)
+        .join(Freetime, Freetime.id == blocks.c.freetime_id)
+        .where(Freetime.user_id == user_id)
+        .order_by(Freetime.start_time, Task.id))
+    if since:
+        planned = planned.where(stamp > since)
+    for rows in stream_rows(planned):
+        yield "".join(
+            format_event(f"block-{task_id}-{freetime_id}@instime", start, end, stamp, title, description)
+            for task_id, freetime_id, title, description, start, end, stamp in rows
+        )
+
+    yield fold("END:VCALENDAR")
+
+def unfold(lines):
+    """joins folded content lines back together, reading the lines (bytes or text) as they come"""
+    current = None
+    for line in lines:
+        if isinstance(line, bytes):
+            line = line.decode("utf-8", "replace")
+        line = line.rstrip("\r\n")
+        if line[:1] in (" ", "\t") and current is not None:
+            current += line[1:]
+            continue
+        if current:
+            yield current
+        current = line
+    if current:
+        yield current
+
+def parse_line(line):
+    """splits a content line like DTSTART;TZID="America/New_York":20300101T080000
+
+    Returns:
+        tuple(string, dict, string): the upper cased name, its parameters & the value
+    """
+    i = line.find(":")
+    if '"' in line[:i]:
+        # a quoted parameter value may hold the colon
+        quoted = False
+        for i, char in enumerate(line):
+            if char == '"':
+                quoted = not quoted
+            elif char == ":" and not quoted:
+                break
+        else:
+            i = -1
+    if i < 0:
+        return line.upper(), {}, ""
+    if ";" not in line[:i]:
+        return line[:i].upper(), {}, line[i + 1:]
+    name, *params = line[:i].split(";")
+    params = dict(param.partition("=")[::2] for param in params)
+    return name.upper(), {key.upper(): value.strip('"') for key, value in params.items()}, line[i + 1:]
+
+def parse_time(value, params):
+    """turns a DTSTART / DTEND value into a naive UTC datetime, dates become midnight UTC
+
+    Raises:
+        ValueError: when the value isn't a date or date time
+    """
+    if params.get("VALUE") == "DATE" or len(value) == 8:
+        return datetime.strptime(value, "%Y%m%d")
+    tzid = params.get("TZID")
+    zone = tz.gettz(tzid) if tzid and not value.endswith("Z") and is_timezone(tzid) else None
+    match = ICS_DATETIME.match(value)
+    if match:
+        parsed = datetime(*(int(part) for part in match.groups()[:6]))
+    elif zone:
+        parsed = dt.parse(value).replace(tzinfo=None)
+    else:
+        # UTC & floating times are read the same way as the times sent to /times
+        return parse_utc(value)
+    if zone:
+        parsed = parsed.replace(tzinfo=zone).astimezone(tz.tzutc()).replace(tzinfo=None)
+    return parsed
+
+def parse_duration(value):
+    """turns a DURATION value into a timedelta
+
+    Raises:
+        ValueError: when the value isn't a positive duration
+    """
+    match = DURATION.match(value.strip())
+    if not match:
+        raise ValueError(f"unsupported duration {value}")
+    weeks, days, hours, minutes, seconds = (int(part or 0) for part in match.groups())
+    return timedelta(weeks=weeks, days=days, hours=hours, minutes=minutes, seconds=seconds)
+
+def read_event(properties):
+    """gives the (uid, start, end) of a parsed VEVENT, or None when it can't be a freetime"""
+    if "DTSTART" not in properties or "RECURRENCE-ID" in properties:
+        return None
+    if properties.get("STATUS", ({}, ""))[1].upper() == "CANCELLED":
+        return None
+    try:
+        params, value = properties["DTSTART"]
+        start = parse_time(value, params)
+        if "DTEND" in properties:
+            end_params, end_value = properties["DTEND"]
+            end = parse_time(end_value, end_params)
+        elif "DURATION" in properties:
+            end = start + parse_duration(properties["DURATION"][1])
+        elif params.get("VALUE") == "DATE" or len(value) == 8:
+            end = start + timedelta(days=1)
+        else:
+            return None
+    except (ValueError, OverflowError):
+        return None
+    if end <= start:
+        return None
+    uid = properties.get("UID", ({}, ""))[1]
+    if not uid:
+        # without a UID the event's times & summary stand in for one, so a re-import still matches
+        key = "|".join(properties.get(name, ({}, ""))[1] for name in ("DTSTART", "DTEND", "DURATION", "SUMMARY"))
+        uid = f"{sha1(key.encode()).hexdigest()}@ics-import"
+    return uid[:255], start, end
+
+def parse_events(lines):
+    """reads the VEVENTs of an iCalendar stream one at a time, without holding the file
+
+    Recurring events only give their first occurrence & changed occurrences are skipped.
+
+    Yields:
+        tuple(string, datetime, datetime) | None: the uid, start & end (naive UTC) of each event,
+        None for events that can't be a freetime
+    """
+    properties, nested = None, 0
+    for line in unfold(lines):
+        name, params, value = parse_line(line)
+        if properties is None:
+            if name == "BEGIN" and value.upper() == "VEVENT":
+                properties, nested = {}, 0
+            continue
+        if name == "BEGIN":
+            # alarms & other components inside the event have properties of their own
+            nested += 1
+        elif name == "END" and nested:
+            nested -= 1
+        elif name == "END" and value.upper() == "VEVENT":
+            yield read_event(properties)
+            properties = None
+        elif not nested:
+            properties.setdefault(name, (params, value))
+
+def copy_escape(value):
+    """escapes a value for COPY's text format"""
+    return value.replace("\\", "\\\\").replace("\t", "\\t").replace("\n", "\\n").replace("\r", "\\r")
+
+class RowStream:
+    """a read only file over generated COPY rows, so COPY pulls rows as they're parsed"""
+
+    def __init__(self, rows):
+        self.rows = rows
+        self.buffer = ""
+
+    def read(self, size=-1):
+        chunks, length = [self.buffer], len(self.buffer)
+        for row in self.rows:
+            chunks.append(row)
+            length += len(row)
+            if 0 <= size <= length:
+                break
+        data = "".join(chunks)
+        if size < 0:
+            self.buffer = ""
+            return data
+        self.buffer = data[size:]
+        return data[:size]
+
+def import_events(user_id, lines):
+    """bulk loads the events of an iCalendar stream as a user's freetimes, skipping ones already imported
+
+    Events are COPYed into a temporary table as they're parsed, then moved into freetimes
+    by one INSERT that drops UIDs the user already has, so memory use stays flat however
+    big the file is. Overlaps aren't checked, events are imported as they are.
+
+    Args:
+        user_id (int): who the freetimes are for
+        lines (iterable): lines of the .ics file, bytes or text
+
+    Returns:
+        dict: how many events were (imported), were already there (duplicates) & couldn't be used (invalid)
+    """
+    counts = dict(imported=0, duplicates=0, invalid=0)
+
+    def rows():
+        for event in parse_events(lines):
+            if event is None:
+                counts["invalid"] += 1
+                continue
+            uid, start, end = event
+            counts["duplicates"] += 1
+            yield f"{copy_escape(uid)}\t{start.isoformat()}\t{end.isoformat()}\n"
+
+    connection = db.session.connection()
+    connection.execute(db.text(
+        "CREATE TEMPORARY TABLE IF NOT EXISTS freetime_import "
+        "(uid text NOT NULL, start_time timestamp NOT NULL, end_time timestamp NOT NULL) ON COMMIT DROP"
+    ))
+    connection.execute(db.text("TRUNCATE freetime_import"))
+    cursor = connection.connection.cursor()
+    try:
+        cursor.copy_expert("COPY freetime_import (uid, start_time, end_time) FROM STDIN", RowStream(rows()))
+    finally:
+        cursor.close()
+
+    result = connection.execute(db.text("""
+        INSERT INTO freetimes (user_id, uid, start_time, end_time, updated_at)
+        SELECT DISTINCT ON (uid) :user_id, uid, start_time, end_time, :now FROM freetime_import ORDER BY uid
+        ON CONFLICT (user_id, uid) DO NOTHING
+    """), dict(user_id=user_id, now=datetime.utcnow()))
+    counts["imported"] = result.rowcount
+    counts["duplicates"] -= result.rowcount
+    return counts
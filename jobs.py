@@ -0,0 +1,300 @@
+"""runs background jobs from the durable queue in the jobs table, next to the web processes
+
+    python jobs.py                  # JOB_PROCESSES worker processes (2 by default)
+    python jobs.py --processes 4
+
+Workers take queued jobs with FOR UPDATE SKIP LOCKED, so any number of them can share the
+queue without a broker. A job's own writes commit in the same transaction that marks it done,
+a failed attempt is rolled back & retried later with exponential backoff. Each user has at
+most JOB_USER_CONCURRENCY jobs running at once. A worker refreshes its running job's lock a
+few times every JOB_TIMEOUT seconds, jobs whose lock went older than that are taken back.
+"""
+import os
+import sys
+import signal
+import random
+import socket
+import multiprocessing
+from argparse import ArgumentParser
+from datetime import datetime, timedelta
+from threading import Event, Thread
+from time import sleep
+
+from models import db, Job
+
+# key of the advisory locks taken while claiming a user's job, the user id is the second key
+CLAIM_LOCK = 0x4A0B
+# queued jobs a worker looks at per claim, jobs of users at their limit are passed over
+CLAIM_BATCH = 20
+
+class JobCancelled(Exception):
+    """raised inside a running job the user cancelled, its writes are rolled back"""
+
+class JobFailed(Exception):
+    """raised by a job that can't ever succeed, so it fails without being retried"""
+
+class JobKind:
+    """how a kind of job runs
+
+    Args:
+        name (string): the job's kind
+        run (function): takes the Job & gives a json result
+        max_attempts (int): tries before the job fails
+        public (bool): whether users may queue it, otherwise only the app does
+    """
+
+    def __init__(self, name, run, max_attempts=3, public=True):
+        self.name = name
+        self.run = run
+        self.max_attempts = max_attempts
+        self.public = public
+
+    def __repr__(self):
+        return f"<JobKind {self.name} max_attempts={self.max_attempts} public={self.public}>"
+
+# name -> JobKind, filled by the job decorator
+registry = {}
+
+def job(name, max_attempts=3, public=True):
+    """registers a function as the runner of a kind of job, see JobKind"""
+    def decorator(run):
+        registry[name] = JobKind(name, run, max_attempts, public)
+        return run
+    return decorator
+
+def enqueue(kind, user_id=None, args=None, delay=0):
+    """adds a job to the queue, only flushes so it's queued when the caller commits
+
+    Args:
+        kind (string): a registered kind of job
+        user_id (int, optional): who the job works for
+        args (dict, optional): json arguments the job reads
+        delay (float): seconds before it may run
+
+    Raises:
+        ValueError: when the kind isn't registered
+
+    Returns:
+        Job: the queued job
+    """
+    if kind not in registry:
+        raise ValueError(f"unknown job kind {kind}")
+    queued = Job(
+        kind=kind, user_id=user_id, args=args or {}, max_attempts=registry[kind].max_attempts,
+        run_at=datetime.utcnow() + timedelta(seconds=delay),
+    )
+    db.session.add(queued)
+    db.session.flush()
+    return queued
+
+def cancel(job_id):
+    """cancels a queued job at once & asks a running one to stop
+
+    A running job stops at its next check_cancelled, or when it finishes, either way its writes
+    are rolled back. Each step is a guarded UPDATE, so a worker claiming or finishing the job
+    at the same time can't be overwritten. Only flushes.
+
+    Returns:
+        bool: whether the job was still queued or running
+    """
+    now = datetime.utcnow()
+    if Job.query.filter(Job.id == job_id, Job.status == "queued").update(
+            dict(status="cancelled", finished_at=now), synchronize_session=False):
+        return True
+    return bool(Job.query.filter(Job.id == job_id, Job.status == "running").update(
+        dict(cancel_requested=True), synchronize_session=False))
+
+def check_cancelled(job):
+    """stops a running job the user cancelled, call it between the steps of long jobs
+
+    Raises:
+        JobCancelled: when a cancel was requested
+    """
+    if db.session.query(Job.cancel_requested).filter(Job.id == job.id).scalar():
+        raise JobCancelled()
+
+def backoff(attempts, base, cap):
+    """gives the seconds to wait before another try, doubling with every attempt up to cap with jitter"""
+    return min(base * 2 ** (attempts - 1), cap) * random.uniform(0.5, 1)
+
+def claim(worker, per_user):
+    """takes the next job that's due, keeping every user under per_user running jobs
+
+    A user's jobs are claimed under an advisory lock on the user, so two workers can't both
+    start one of theirs past the limit. Commits.
+
+    Args:
+        worker (string): name of the claiming worker
+        per_user (int): most jobs a user may have running
+
+    Returns:
+        Job | None: the claimed job, now running
+    """
+    now = datetime.utcnow()
+    candidates = db.session.execute(db.text("""
+        SELECT id, user_id FROM jobs j WHERE status = 'queued' AND run_at <= :now
+            AND (user_id IS NULL OR (SELECT COUNT(*) FROM jobs r WHERE r.user_id = j.user_id AND r.status = 'running') < :per_user)
+        ORDER BY run_at, id LIMIT :batch FOR UPDATE SKIP LOCKED
+    """), dict(now=now, per_user=per_user, batch=CLAIM_BATCH)).all()
+    for job_id, user_id in candidates:
+        if user_id is not None:
+            # another worker claiming for the same user right now gets this one, no waiting
+            if not db.session.execute(db.text("SELECT pg_try_advisory_xact_lock(:key, :user_id)"), dict(key=CLAIM_LOCK, user_id=user_id)).scalar():
+                continue
+            running = db.session.query(db.func.count(Job.id)).filter(Job.user_id == user_id, Job.status == "running").scalar()
+            if running >= per_user:
+                continue
+        Job.query.filter(Job.id == job_id).update(
+            dict(status="running", attempts=Job.attempts + 1, locked_by=worker, locked_at=now), synchronize_session=False)
+        db.session.commit()
+        return Job.query.get(job_id)
+    db.session.commit()
+    return None
+
+def requeue_stale(timeout):
+    """takes back the jobs of workers that stopped mid job, failing the ones out of attempts. Commits.
+
+    Returns:
+        int: how many jobs were taken back
+    """
+    cutoff = datetime.utcnow() - timedelta(seconds=timeout)
+    stale = Job.query.filter(Job.status == "running", Job.locked_at < cutoff)
+    failed = stale.filter(Job.attempts >= Job.max_attempts).update(dict(
+        status="failed", error="the worker stopped while running the job", finished_at=datetime.utcnow(), locked_by=None,
+    ), synchronize_session=False)
+    requeued = stale.update(dict(status="queued", locked_by=None), synchronize_session=False)
+    db.session.commit()
+    return failed + requeued
+
+class Worker:
+    """takes jobs off the queue & runs them one at a time until it's told to stop
+
+    Args:
+        app (Flask): the app, its config sizes the worker
+        name (string, optional): how the worker shows in locked_by, host & pid by default
+    """
+
+    def __init__(self, app, name=None):
+        self.app = app
+        self.name = name or f"{socket.gethostname()}:{os.getpid()}"
+        self.stopping = False
+
+    def __repr__(self):
+        return f"<Worker {self.name}>"
+
+    def stop(self, *_):
+        """finishes the running job, then stops"""
+        self.stopping = True
+
+    def run(self):
+        """works the queue, sleeping JOB_POLL_SECONDS whenever it's empty, until SIGTERM or SIGINT"""
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        while not self.stopping:
+            if not self.run_once():
+                sleep(self.app.config["JOB_POLL_SECONDS"])
+
+    def run_once(self):
+        """claims & runs one job
+
+        Returns:
+            bool: whether there was a job to run
+        """
+        config = self.app.config
+        with self.app.app_context():
+            requeue_stale(config["JOB_TIMEOUT"])
+            claimed = claim(self.name, config["JOB_USER_CONCURRENCY"])
+            if claimed is None:
+                return False
+            self.execute(claimed)
+            return True
+
+    def heartbeat(self, engine, job_id, stopped):
+        """refreshes the running job's locked_at until stopped, so a long job isn't taken back
+
+        Runs in its own thread on its own connection, the job's transaction stays open till it ends.
+        """
+        jobs = Job.__table__
+        while not stopped.wait(self.app.config["JOB_TIMEOUT"] / 3):
+            try:
+                with engine.begin() as conn:
+                    conn.execute(jobs.update()
+                        .where(jobs.c.id == job_id, jobs.c.status == "running", jobs.c.locked_by == self.name)
+                        .values(locked_at=datetime.utcnow()))
+            except Exception:
+                self.app.logger.exception("couldn't refresh the lock of job %s", job_id)
+
+    def execute(self, claimed):
+        """runs a claimed job & records how it went, with the job's writes when it succeeded"""
+        config = self.app.config
+        kind = registry.get(claimed.kind)
+        job_id, attempts, max_attempts = claimed.id, claimed.attempts, claimed.max_attempts
+        now = datetime.utcnow
+        stopped = Event()
+        beating = Thread(target=self.heartbeat, args=(db.engine, job_id, stopped), daemon=True)
+        beating.start()
+        try:
+            if kind is None:
+                raise JobFailed(f"no runner for {claimed.kind} jobs")
+            result = kind.run(claimed)
+            outcome = dict(status="done", result=result, error=None, finished_at=now())
+        except JobCancelled:
+            db.session.rollback()
+            outcome = dict(status="cancelled", finished_at=now())
+        except Exception as err:
+            db.session.rollback()
+            self.app.logger.exception("job %s (%s) failed on attempt %s", job_id, claimed.kind, attempts)
+            error = f"{type(err).__name__}: {err}"
+            if isinstance(err, JobFailed) or attempts >= max_attempts:
+                outcome = dict(status="failed", error=error, finished_at=now())
+            else:
+                delay = backoff(attempts, config["JOB_BACKOFF"], config["JOB_BACKOFF_MAX"])
+                outcome = dict(status="queued", error=error, run_at=now() + timedelta(seconds=delay))
+        finally:
+            # stopped before the outcome's update locks the job's row the heartbeat writes to
+            stopped.set()
+            beating.join()
+        # only while the job is still this worker's, it may have been taken back after JOB_TIMEOUT
+        # & be running again elsewhere, then its writes are dropped so they aren't applied twice
+        owned = Job.query.filter(Job.id == job_id, Job.status == "running", Job.locked_by == self.name)
+        if owned.filter(Job.cancel_requested.is_(False)).update(dict(outcome, locked_by=None), synchronize_session=False):
+            db.session.commit()
+            return
+        db.session.rollback()
+        # cancelled while it ran without checking, its writes are dropped all the same
+        if owned.update(dict(status="cancelled", finished_at=now(), locked_by=None), synchronize_session=False):
+            db.session.commit()
+        else:
+            db.session.rollback()
+            self.app.logger.warning("job %s (%s) was taken back from %s while it ran, its outcome was dropped", job_id, claimed.kind, self.name)
+
+def run_worker(index):
+    """runs one worker process, the app is imported in it so its jobs are registered"""
+    # the jobs module the app registered its jobs in, not this file run as __main__
+    from app import app
+    from jobs import Worker
+    Worker(app, f"{socket.gethostname()}:{os.getpid()}:{index}").run()
+
+def main():
+    parser = ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--processes", type=int, default=int(os.environ.get("JOB_PROCESSES", 2)))
+    args = parser.parse_args()
+
+    if args.processes <= 1:
+        return run_worker(0)
+    # spawned processes each open their own database connections
+    context = multiprocessing.get_context("spawn")
+    processes = [context.Process(target=run_worker, args=(index,), name=f"jobs-{index}") for index in range(args.processes)]
+    for process in processes:
+        process.start()
+    def stop(*_):
+        for process in processes:
+            process.terminate()
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    for process in processes:
+        process.join()
+    sys.exit(max(process.exitcode or 0 for process in processes))
+
+if __name__ == "__main__":
+    main()
@@ -1,19 +1,99 @@
-from flask_sqlalchemy import SQLAlchemy
 from flask_bcrypt import Bcrypt
 from flask_login import UserMixin
 from sqlalchemy_utils import EmailType
 from wtforms.fields.simple import PasswordField, TextAreaField
 from dateutil import tz
-from sqlalchemy import nullslast
+from base64 import urlsafe_b64encode, urlsafe_b64decode
+import re
+import json
+import heapq
+from itertools import islice
+from datetime import datetime, timedelta
+import dateutil.parser as dt
+from dateutil.rrule import rrulestr
+from sqlalchemy import event
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.orm import Session
 
-db = SQLAlchemy()
+from caching import LRUCache
+from timefmt import get_formatter, is_timezone
+from hashing import PasswordHasher
+from routing import RoutingSQLAlchemy
+
+# reads of read only requests can go to replicas, see routing.py
+db = RoutingSQLAlchemy()
 bcrypt = Bcrypt()
+hasher = PasswordHasher(bcrypt)
+
+# stored times are naive UTC, this is the database's side of datetime.utcnow
+UTC_NOW = db.text("(now() at time zone 'utc')")
+
+# identity records of recently seen users, kept per process for the login manager
+user_cache = LRUCache(maxsize=1024, ttl=5 * 60)
 
 def connect_db(app):
     """connects app to database"""
     db.app = app
     db.init_app(app)
 
+def parse_utc(value):
+    """parses a datetime string into a naive UTC datetime for storage
+
+    Args:
+        value (string): date & time in any format dateutil understands
+
+    Returns:
+        datetime: the parsed time converted to UTC without tzinfo
+    """
+    parsed = dt.parse(value)
+    if parsed.tzinfo:
+        parsed = parsed.astimezone(tz.tzutc()).replace(tzinfo=None)
+    return parsed
+
+def encode_cursor(values):
+    """packs the sort keys of the last row of a page into an opaque url safe cursor, datetimes as iso text"""
+    return urlsafe_b64encode(json.dumps(values, default=datetime.isoformat).encode()).decode().rstrip("=")
+
+def decode_cursor(cursor, types):
+    """unpacks a cursor made by encode_cursor, checking every value against its sort key's type
+
+    Args:
+        cursor (string): the cursor
+        types (list[type]): the python type of each sort key, int, str or datetime
+
+    Raises:
+        ValueError: when the cursor is malformed or its values don't match types
+
+    Returns:
+        list: the sort keys, datetimes parsed back
+    """
+    try:
+        values = json.loads(urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+    except (TypeError, ValueError) as err:
+        raise ValueError("malformed cursor") from err
+    if not isinstance(values, list) or len(values) != len(types):
+        raise ValueError("malformed cursor")
+    decoded = []
+    for value, kind in zip(values, types):
+        if kind is datetime and isinstance(value, str):
+            value = datetime.fromisoformat(value)
+        if type(value) is not kind:
+            raise ValueError("malformed cursor")
+        decoded.append(value)
+    return decoded
+
+def pretty_time(value, tzname=None):
+    """formats a stored UTC datetime into a display date
+
+    Args:
+        value (datetime): naive UTC datetime
+        tzname (string, optional): timezone to show the time in, the server's when not given
+
+    Returns:
+        string: nicely formatted date
+    """
+    return get_formatter(tzname).format(value)
+
 class User(UserMixin, db.Model):
     """model for users"""
     __tablename__ = "users"
@@ -22,6 +102,11 @@ class User(UserMixin, db.Model):
     name = db.Column(db.String(20), nullable=False)
     email = db.Column(EmailType, unique=True, nullable=False)
     password = db.Column(db.String(), nullable=False, info={"form_field_class": PasswordField})
+    # IANA name of the zone times are shown in, the server's zone when not set
+    timezone = db.Column(db.String(64))
+    # bumped with every change to the user's tasks, freetimes or plans, keys their cached pages
+    data_version = db.Column(db.Integer, nullable=False, default=0, server_default="0")
+    data_changed_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow, server_default=UTC_NOW)
     # relationship for a users tasks & freetimes
     tasks = db.relationship("Task", backref="user") 
     freetimes = db.relationship("Freetime", backref="user")
@@ -41,7 +126,7 @@ class User(UserMixin, db.Model):
         Returns:
             User: instance of the User class made from the args passed
         """
-        hashed_password = bcrypt.generate_password_hash(password).decode("utf-8")
+        hashed_password = hasher.hash(password)
         new_user = cls(email=email, name=name, password=hashed_password)
         db.session.add(new_user)
         return new_user
@@ -55,24 +140,126 @@ class User(UserMixin, db.Model):
             password (string): user's password to log in
 
         Returns:
-            User | False: if they exist, the user account, else false
+            User | False: if they exist, the user account, else false,
+            the password is rehashed when the work factor setting changed
         """
         user = cls.query.filter_by(email = email).one_or_none()
         if user:
-            correct_password = bcrypt.check_password_hash(user.password, password)
+            correct_password = hasher.check(user.password, password)
             if correct_password:
+                if hasher.needs_rehash(user.password):
+                    user.password = hasher.hash(password)
                 return user
         return False
 
+    @classmethod
+    def load_identity(cls, user_id):
+        """gets a session free identity record of a user, using the user cache when possible
+
+        Args:
+            user_id (int): id of the user to load
+
+        Returns:
+            UserIdentity | None: the user's identity if they exist, else None
+        """
+        user_id = int(user_id)
+        identity = user_cache.get(user_id)
+        if identity is None:
+            row = db.session.query(cls.id, cls.name, cls.email, cls.timezone).filter(cls.id == user_id).one_or_none()
+            if row is None:
+                return None
+            identity = tuple(row)
+            user_cache.set(user_id, identity)
+        return UserIdentity(*identity)
+
+    @classmethod
+    def bump_version(cls, user_id):
+        """marks that a user's data changed, run it in the same transaction as the change
+
+        A plain UPDATE so the user cache (which doesn't hold the version) is left alone.
+        """
+        db.session.execute(
+            cls.__table__.update().where(cls.__table__.c.id == user_id)
+            .values(data_version=cls.__table__.c.data_version + 1, data_changed_at=datetime.utcnow())
+        )
+
+    @classmethod
+    def get_version(cls, user_id):
+        """gets the data version of a user & when it last changed
+
+        Returns:
+            tuple(int, datetime) | None: the version & time, None when the user doesn't exist
+        """
+        row = db.session.query(cls.data_version, cls.data_changed_at).filter(cls.id == user_id).one_or_none()
+        return tuple(row) if row else None
+
+class UserIdentity(UserMixin):
+    """a plain copy of a user's id, name, email & timezone, safe to cache because it isn't tied to a session"""
+
+    def __init__(self, id, name, email, timezone=None):
+        self.id = id
+        self.name = name
+        self.email = email
+        self.timezone = timezone
+
+    def __repr__(self):
+        return f"<UserIdentity #{self.id} {self.name} - {self.email}>"
+
+    def __eq__(self, other):
+        return isinstance(other, (User, UserIdentity)) and other.id == self.id
+
+    def __hash__(self):
+        return hash(self.id)
+
+    @property
+    def tasks(self):
+        """the user's tasks, loaded in the current session"""
+        return Task.query.filter(Task.user_id == self.id).order_by(Task.id).all()
+
+    @property
+    def freetimes(self):
+        """the user's freetimes, loaded in the current session"""
+        return Freetime.query.filter(Freetime.user_id == self.id).order_by(Freetime.id).all()
+
+@event.listens_for(User, "after_update")
+@event.listens_for(User, "after_delete")
+def forget_user(mapper, connection, target):
+    """drops a changed user from the user cache"""
+    user_cache.delete(target.id)
+
+@event.listens_for(Session, "after_bulk_update")
+@event.listens_for(Session, "after_bulk_delete")
+def forget_users(context):
+    """empties the user cache when users are changed in bulk"""
+    if context.mapper.class_ is User:
+        user_cache.clear()
+
 # a join table for the many to many realtionship of tasks to freetimes & freetimes to tasks
 blocks = db.Table(
     "blocks",
     db.Column("task_id", db.Integer, db.ForeignKey("tasks.id", ondelete="cascade"), primary_key=True),
-    db.Column("freetime_id", db.Integer, db.ForeignKey("freetimes.id", ondelete="cascade"), primary_key=True)
+    db.Column("freetime_id", db.Integer, db.ForeignKey("freetimes.id", ondelete="cascade"), primary_key=True),
+    # when the task was planned into the freetime, for calendar syncs
+    db.Column("created_at", db.DateTime, nullable=False, server_default=UTC_NOW),
 )
 
 # used as the only values for the status of a task
 STATUSES = ("pending", "partial", "done")
+# text search configuration tasks are indexed & searched with
+SEARCH_CONFIG = "english"
+# most words of a search that are used
+SEARCH_TERMS = 8
+
+def make_tsquery(text):
+    """turns what a user typed into a tsquery where every word must match, each as a prefix
+
+    Only letters & digits are kept, so nothing typed can break the tsquery syntax.
+
+    Returns:
+        string | None: the tsquery, None when nothing searchable was typed
+    """
+    words = re.findall(r"[^\W_]+", text.lower().replace("'", ""))[:SEARCH_TERMS]
+    return " & ".join(f"{word}:*" for word in words) or None
 
 class Task(db.Model):
     """model for tasks"""
@@ -94,8 +281,16 @@ class Task(db.Model):
     })
     # links a user to a task, tasks must have a user
     user_id = db.Column(db.Integer, db.ForeignKey("users.id", ondelete="cascade"), nullable=False)
+    updated_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow, onupdate=datetime.utcnow, server_default=UTC_NOW)
     # relationship for task to have many freetimes & for freetime to have many tasks
     freetimes = db.relationship("Freetime", secondary=blocks, backref="tasks")
+    # stemmed words of the title (weighted higher) & description, plus the words as written so
+    # partly typed words still match after stemming shortened them, computed by postgres on every write
+    search_vector = db.deferred(db.Column(postgresql.TSVECTOR, db.Computed(
+        f"setweight(to_tsvector('{SEARCH_CONFIG}', title), 'A') || setweight(to_tsvector('{SEARCH_CONFIG}', description), 'B')"
+        " || setweight(to_tsvector('simple', title || ' ' || description), 'D')",
+        persisted=True,
+    )))
 
     def __repr__(self):
         return f"<Task #{self.id} {self.title} ({self.status}) user_id={self.user_id}>"
@@ -122,24 +317,299 @@ class Task(db.Model):
             sort (string): "status", "priority", or other value to sort the tasks order by
 
         Returns:
-            SQLAlchemy Query object: used to get a list of tasks from a user on a specific sort
+            list[Task]: all of the user's tasks in the sort's order
+        """
+        return cls.get_user_tasks_page(user.id, sort or "estimate")[0]
+
+    @classmethod
+    def sort_keys(cls, sort):
+        """gives the keys a sort orders tasks by, each as a column expression & a python getter
+
+        Every key is read in one direction so a page can start after a row with a single row
+        comparison, which the matching index on tasks answers as a range scan. Missing time
+        estimates become -1 so they sort last, just like nulls last.
+
+        Args:
+            sort (string | None): "status", "priority", None for creation order, else by estimate
+
+        Returns:
+            tuple(list[tuple], bool): (expression, getter) pairs & whether they're read descending
         """
-        query = cls.query.filter(cls.user_id == user.id)
+        estimate = (db.func.coalesce(cls.time_estimate, -1), lambda t: -1 if t.time_estimate is None else t.time_estimate)
+        priority = (cls.priority, lambda t: t.priority)
+        id = (cls.id, lambda t: t.id)
+        if sort is None:
+            return [id], False
         if sort == "status":
-            return query.order_by(cls.status, cls.priority.desc()).all()
+            return [(cls.status, lambda t: t.status), (-cls.priority, lambda t: -t.priority), id], False
         if sort == "priority":
-            return query.order_by(cls.priority.desc(), nullslast(cls.time_estimate.desc()))
-        return query.order_by(nullslast(cls.time_estimate.desc()), cls.priority.desc())
+            return [priority, estimate, id], True
+        return [estimate, priority, id], True
+
+    @classmethod
+    def get_user_tasks_page(cls, user_id, sort=None, cursor=None, per_page=None, only=None):
+        """returns one page of a user's tasks, starting after the row a cursor points to
+
+        Args:
+            user_id (int): the user to get tasks from
+            sort (string | None): see sort_keys
+            cursor (string, optional): the next_cursor of the previous page
+            per_page (int, optional): tasks in a page, all of them without it
+            only (iterable[string], optional): only load these columns, the sort keys' are always loaded
+
+        Raises:
+            ValueError: when the cursor is malformed
+
+        Returns:
+            tuple(list[Task], string | None): the tasks & the cursor for the next page if there is one
+        """
+        keys, descending = cls.sort_keys(sort)
+        columns = [column for column, _ in keys]
+        query = cls.query.filter(cls.user_id == user_id)
+        if only is not None:
+            query = query.options(db.load_only(*set(only) | {"id", "status", "priority", "time_estimate"}))
+        if cursor:
+            values = decode_cursor(cursor, [column.type.python_type for column in columns])
+            row, after = db.tuple_(*columns), db.tuple_(*values)
+            query = query.filter(row < after if descending else row > after)
+        query = query.order_by(*[column.desc() if descending else column for column in columns])
+        if not per_page:
+            return query.all(), None
+        tasks = query.limit(per_page + 1).all()
+        if len(tasks) <= per_page:
+            return tasks, None
+        tasks = tasks[:per_page]
+        return tasks, encode_cursor([get(tasks[-1]) for _, get in keys])
+
+    @classmethod
+    def search(cls, user_id, text, status=None, priority=None, limit=20):
+        """finds a user's tasks whose title or description has every word of text, best matches first
+
+        Words match as prefixes of either the stemmed or the written words, so partly typed
+        words find tasks too. Title matches rank higher.
+
+        Args:
+            user_id (int): the user whose tasks are searched
+            text (string): what the user typed
+            status (string, optional): only tasks with this status
+            priority (int, optional): only tasks with this priority
+            limit (int): most tasks given
+
+        Returns:
+            list[tuple(Task, float)]: the tasks & their rank
+        """
+        tsquery = make_tsquery(text)
+        if tsquery is None:
+            return []
+        query = db.func.to_tsquery(SEARCH_CONFIG, tsquery).op("||")(db.func.to_tsquery("simple", tsquery))
+        rank = db.func.ts_rank_cd(cls.search_vector, query)
+        results = (db.session.query(cls, rank)
+            .filter(cls.user_id == user_id, cls.search_vector.op("@@")(query)))
+        if status is not None:
+            results = results.filter(cls.status == status)
+        if priority is not None:
+            results = results.filter(cls.priority == priority)
+        return results.order_by(rank.desc(), cls.id).limit(limit).all()
+
+    @classmethod
+    def get_freetime_links(cls, task_ids, embed=False):
+        """gives the freetimes each task is blocked into with one query
+
+        Args:
+            task_ids (iterable[int]): the tasks
+            embed (bool): give each freetime's (id) & (start/end) times instead of only its id
+
+        Returns:
+            dict: task id -> list of freetime ids or dicts, in start order, for every task asked about
+        """
+        links = {id: [] for id in task_ids}
+        if not links:
+            return links
+        query = (db.session.query(blocks.c.task_id, Freetime.id, Freetime.start_time, Freetime.end_time)
+            .join(Freetime, Freetime.id == blocks.c.freetime_id)
+            .filter(blocks.c.task_id.in_(links))
+            .order_by(Freetime.start_time, Freetime.id))
+        for task_id, id, start_time, end_time in query:
+            links[task_id].append(dict(id=id, start=start_time.isoformat(), end=end_time.isoformat()) if embed else id)
+        return links
+
+    @classmethod
+    def clean(cls, data, partial=False):
+        """checks the fields of a task sent as json, like UserTaskForm checks the form's
+
+        Args:
+            data (dict): (title), (description), (status), (time_estimate) & (priority), other keys are ignored
+            partial (bool): only check the fields that were sent, for updates
+
+        Raises:
+            ValueError: naming the first field that isn't valid
+
+        Returns:
+            dict: column values of the valid fields
+        """
+        values = {}
+        for name in ("title", "description"):
+            if name in data or not partial:
+                value = data.get(name)
+                limit = getattr(cls, name).type.length
+                if not isinstance(value, str) or not value.strip() or len(value) > limit:
+                    raise ValueError(f"({name}) must be text of 1 to {limit} characters")
+                values[name] = value
+        if "status" in data:
+            if data["status"] not in STATUSES:
+                raise ValueError(f"(status) must be one of {', '.join(STATUSES)}")
+            values["status"] = data["status"]
+        if "time_estimate" in data:
+            value = data["time_estimate"]
+            if value is not None and (type(value) is not int or value < 1):
+                raise ValueError("(time_estimate) must be a whole number of minutes or null")
+            values["time_estimate"] = value
+        if "priority" in data:
+            value = data["priority"]
+            if type(value) is not int or not 0 <= value <= 9:
+                raise ValueError("(priority) must be a number from 0 to 9")
+            values["priority"] = value
+        return values
+
+    @classmethod
+    def apply_batch(cls, user_id, operations, offset=0):
+        """applies create / update / delete operations on a user's tasks with bulk statements,
+        only flushes so the caller decides when the whole batch commits
+
+        Args:
+            user_id (int): the user who owns the tasks
+            operations (list[dict]): items with an (op) of create, update or delete, an (id) for
+                update & delete, the task's fields for create & update and optionally a list of
+                (freetimes) ids replacing the task's blocks
+            offset (int): index of the first operation, for batches sent in chunks
+
+        Returns:
+            list[dict]: a result per operation with its (index), (op), (id) & (ok) or (error)
+        """
+        results = [dict(index=offset + i, op=item.get("op") if isinstance(item, dict) else None) for i, item in enumerate(operations)]
+        ids = {item["id"] for item in operations
+            if isinstance(item, dict) and item.get("op") in ("update", "delete") and type(item.get("id")) is int}
+        owned = {id for id, in db.session.query(cls.id).filter(cls.id.in_(ids), cls.user_id == user_id)} if ids else set()
+        linked = {id for item in operations if isinstance(item, dict) and isinstance(item.get("freetimes"), list)
+            for id in item["freetimes"] if type(id) is int}
+        owners = Freetime.get_owners(linked)
+
+        creates, updates, deletes, links = [], {}, set(), {}
+        for item, result in zip(operations, results):
+            op = result["op"]
+            if op not in BATCH_OPERATIONS:
+                result["error"] = f"(op) must be one of {', '.join(BATCH_OPERATIONS)}"
+                continue
+            if op != "create":
+                result["id"] = item.get("id")
+                if type(result["id"]) is not int or result["id"] not in owned or result["id"] in deletes:
+                    result["error"] = "must provide the (id) of a task the user owns"
+                    continue
+            if op == "delete":
+                deletes.add(result["id"])
+                updates.pop(result["id"], None)
+                links.pop(result["id"], None)
+                continue
+            try:
+                values = cls.clean(item, partial=op == "update")
+            except ValueError as err:
+                result["error"] = str(err)
+                continue
+            freetimes = item.get("freetimes")
+            if freetimes is not None:
+                if not isinstance(freetimes, list) or any(type(id) is not int or owners.get(id) != user_id for id in freetimes):
+                    result["error"] = "(freetimes) must be a list of ids of freetimes the user owns"
+                    continue
+                freetimes = set(freetimes)
+            if op == "create":
+                creates.append((result, dict(dict(status=STATUSES[0], priority=0, time_estimate=None), **values, user_id=user_id), freetimes))
+                continue
+            if values:
+                updates.setdefault(result["id"], dict(id=result["id"])).update(values, updated_at=datetime.utcnow())
+            if freetimes is not None:
+                links[result["id"]] = freetimes
+
+        if creates:
+            table = cls.__table__
+            new_ids = db.session.execute(table.insert().values([row for _, row, _ in creates]).returning(table.c.id)).scalars().all()
+            for (result, _, freetimes), id in zip(creates, new_ids):
+                result["id"] = id
+                if freetimes:
+                    links[id] = freetimes
+        if updates:
+            db.session.bulk_update_mappings(cls, list(updates.values()))
+        if deletes:
+            cls.query.filter(cls.id.in_(deletes)).delete(synchronize_session=False)
+        if links:
+            db.session.execute(blocks.delete().where(blocks.c.task_id.in_(links)))
+            rows = [dict(task_id=task_id, freetime_id=id) for task_id, freetimes in links.items() for id in freetimes]
+            if rows:
+                db.session.execute(blocks.insert(), rows)
+        db.session.flush()
+
+        for result in results:
+            result.setdefault("ok", "error" not in result)
+        return results
+
+    def get_freetime_ids(self):
+        """gives the ids of the freetimes the task is blocked into, straight from blocks"""
+        return [id for id, in db.session.query(blocks.c.freetime_id).filter(blocks.c.task_id == self.id)]
+
+    def set_freetimes(self, freetime_ids):
+        """replaces the task's blocks, only deleting & inserting the rows that changed
+
+        Args:
+            freetime_ids (iterable[int]): ids of the freetimes the task should be blocked into
+        """
+        if self.id is None:
+            db.session.flush()
+        wanted = set(freetime_ids)
+        current = set(self.get_freetime_ids()) if self.id else set()
+        removed = current - wanted
+        added = wanted - current
+        if removed:
+            db.session.execute(blocks.delete().where(blocks.c.task_id == self.id, blocks.c.freetime_id.in_(removed)))
+        if added:
+            db.session.execute(blocks.insert(), [dict(task_id=self.id, freetime_id=id) for id in added])
+        if removed or added:
+            db.session.expire(self, ["freetimes"])
+
+# indexes matching each of Task.sort_keys so every page of tasks is an index range scan
+db.Index("ix_tasks_user_id", Task.user_id, Task.id)
+db.Index("ix_tasks_user_status", Task.user_id, Task.status, -Task.priority, Task.id)
+db.Index("ix_tasks_user_priority", Task.user_id, Task.priority, db.func.coalesce(Task.time_estimate, -1), Task.id)
+db.Index("ix_tasks_user_estimate", Task.user_id, db.func.coalesce(Task.time_estimate, -1), Task.priority, Task.id)
+db.Index("ix_tasks_search", Task.search_vector, postgresql_using="gin")
+
+# how a write should treat the user's other freetimes that overlap it
+OVERLAP_POLICIES = ("reject", "merge", "allow")
+
+# operations accepted by Freetime.apply_batch
+BATCH_OPERATIONS = ("create", "update", "delete")
+
+# key of the advisory locks writes take while checking a user's freetimes for overlaps, the user id is the second key
+OVERLAP_LOCK = 0x4A0C
 
 class Freetime(db.Model):
     """model for freetimes"""
     __tablename__ = "freetimes"
+    __table_args__ = (
+        db.CheckConstraint("end_time >= start_time", name="freetimes_valid_range"),
+    )
 
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)
     start_time = db.Column(db.DateTime, nullable=False)
     end_time = db.Column(db.DateTime, nullable=False)
     # links freetime to a user, freetimes must have a user
     user_id = db.Column(db.Integer, db.ForeignKey("users.id", ondelete="cascade"), nullable=False)
+    updated_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow, onupdate=datetime.utcnow, server_default=UTC_NOW)
+    # UID of the calendar event the freetime was imported from
+    uid = db.Column(db.String(255))
+    # the series & occurrence a freetime was made from once a task was blocked into it
+    series_id = db.Column(db.Integer, db.ForeignKey("freetime_series.id", ondelete="set null"))
+    occurrence_start = db.Column(db.DateTime)
+    # minutes of the tasks blocked into the freetime, kept up to date by the capacity triggers
+    committed_minutes = db.Column(db.Integer, nullable=False, server_default="0")
 
     def __repr__(self):
         return f"<Freetime #{self.id} start={self.start_time} end={self.end_time} user_id={self.user_id}>"
@@ -151,8 +621,7 @@ class Freetime(db.Model):
         Returns:
             string: nicely formatted date
         """
-        utc = self.start_time.replace(tzinfo=tz.tzutc())
-        return utc.astimezone(tz.tzlocal()).strftime("%b %d, %Y @ %H:%M")
+        return pretty_time(self.start_time)
     
     @property
     def pretty_end(self):
@@ -161,5 +630,944 @@ class Freetime(db.Model):
         Returns:
             string: nicely formatted date
         """
-        utc = self.end_time.replace(tzinfo=tz.tzutc())
-        return utc.astimezone(tz.tzlocal()).strftime("%b %d, %Y @ %H:%M")
+        return pretty_time(self.end_time)
+
+    @property
+    def open_minutes(self):
+        """minutes of the freetime no blocked task's estimate takes up yet"""
+        minutes = int((self.end_time - self.start_time).total_seconds() // 60)
+        return max(minutes - (self.committed_minutes or 0), 0)
+
+    @classmethod
+    def get_choices(cls, user_id, tzname=None, occurrences=()):
+        """gives (id, label) checkbox choices of a user's freetimes without loading whole rows
+
+        Args:
+            user_id (int): the user who owns the freetimes
+            tzname (string, optional): timezone the labels are shown in
+            occurrences (list[Occurrence], optional): unsaved occurrences of repeating freetimes to offer too
+
+        Returns:
+            list[tuple(string, string)]: the freetime ids (occurrence keys for occurrences) & their
+            start - end labels in start order
+        """
+        rows = (db.session.query(cls.id, cls.start_time, cls.end_time)
+            .filter(cls.user_id == user_id)
+            .order_by(cls.start_time, cls.end_time)).all()
+        rows = heapq.merge(
+            [(start, end, str(id)) for id, start, end in rows],
+            [(o.start_time, o.end_time, o.id) for o in occurrences],
+        )
+        rows = list(rows)
+        labels = get_formatter(tzname).format_ranges([(start, end) for start, end, _ in rows])
+        return [(id, label) for (_, _, id), label in zip(rows, labels)]
+
+    @classmethod
+    def get_labels(cls, freetimes, tzname=None):
+        """formats the start - end labels of many freetimes in one batch
+
+        Args:
+            freetimes (iterable[Freetime]): the freetimes to label
+            tzname (string, optional): timezone the labels are shown in
+
+        Returns:
+            dict: freetime id -> label
+        """
+        freetimes = list(freetimes)
+        labels = get_formatter(tzname).format_ranges([(f.start_time, f.end_time) for f in freetimes])
+        return {f.id: label for f, label in zip(freetimes, labels)}
+
+    @classmethod
+    def get_owners(cls, ids):
+        """finds who owns each of the freetimes with a single IN query
+
+        Args:
+            ids (iterable[int]): the freetime ids to look up
+
+        Returns:
+            dict: freetime id -> owning user id, ids that don't exist are left out
+        """
+        ids = set(ids)
+        if not ids:
+            return {}
+        return dict(db.session.query(cls.id, cls.user_id).filter(cls.id.in_(ids)).all())
+
+    @classmethod
+    def period(cls, start, end):
+        """builds a half open [start, end) timestamp range for overlap checks
+
+        Args:
+            start (datetime | column): start of the range
+            end (datetime | column): end of the range
+
+        Returns:
+            SQL expression: a postgres tsrange
+        """
+        return db.func.tsrange(start, end, "[)")
+
+    @classmethod
+    def owner(cls, user_id):
+        """builds the one value [user_id, user_id] range the range index keys freetimes by, postgres
+        can only put a plain integer next to a tsrange in a gist index with the btree_gist extension
+
+        Args:
+            user_id (int | column): the user
+
+        Returns:
+            SQL expression: a postgres int4range, compared with =
+        """
+        return db.func.int4range(user_id, user_id, "[]")
+
+    @classmethod
+    def lock_overlaps(cls, user_id):
+        """makes writes checking the user's freetimes for overlaps wait on each other until the
+        transaction ends, so two of them can't both pass the check & save overlapping windows
+
+        Args:
+            user_id (int): the user whose freetimes are checked
+        """
+        db.session.execute(db.text("SELECT pg_advisory_xact_lock(:key, :user_id)"), dict(key=OVERLAP_LOCK, user_id=user_id))
+
+    @classmethod
+    def get_overlapping(cls, user_id, start, end, exclude_id=None):
+        """finds a user's freetimes that overlap [start, end) using the range index
+
+        Args:
+            user_id (int): the user who owns the freetimes
+            start (datetime): start of the window to check
+            end (datetime): end of the window to check
+            exclude_id (int, optional): a freetime to leave out, such as the one being edited
+
+        Returns:
+            list[Freetime]: the overlapping freetimes ordered by start time
+        """
+        query = cls.query.filter(
+            cls.owner(cls.user_id) == cls.owner(user_id),
+            cls.period(cls.start_time, cls.end_time).op("&&")(cls.period(start, end)),
+        )
+        if exclude_id is not None:
+            query = query.filter(cls.id != exclude_id)
+        return query.order_by(cls.start_time, cls.end_time).all()
+
+    @classmethod
+    def save_window(cls, user_id, start, end, overlap="reject", freetime=None):
+        """creates or updates a freetime, resolving overlaps with the user's other freetimes
+
+        Args:
+            user_id (int): the user who owns the freetime
+            start (datetime): new start time
+            end (datetime): new end time
+            overlap (string): one of OVERLAP_POLICIES, what to do with overlapping freetimes
+            freetime (Freetime, optional): an existing freetime to update, else a new one is made
+
+        Returns:
+            tuple(Freetime | None, list[Freetime]): the saved freetime (None if rejected) & the overlaps found
+        """
+        conflicts = []
+        if overlap != "allow":
+            cls.lock_overlaps(user_id)
+            exclude_id = freetime.id if freetime else None
+            conflicts = cls.get_overlapping(user_id, start, end, exclude_id)
+        if conflicts and overlap == "reject":
+            return None, conflicts
+
+        absorbed = conflicts
+        if conflicts and overlap == "merge":
+            start = min([start] + [c.start_time for c in conflicts])
+            end = max([end] + [c.end_time for c in conflicts])
+            if freetime is None:
+                freetime, absorbed = conflicts[0], conflicts[1:]
+
+        if freetime is None:
+            freetime = cls(user_id=user_id)
+            db.session.add(freetime)
+        freetime.start_time = start
+        freetime.end_time = end
+
+        if overlap == "merge" and absorbed:
+            db.session.flush()
+            cls.absorb(freetime, absorbed)
+        return freetime, conflicts
+
+    @classmethod
+    def skip_occurrences(cls, *criteria):
+        """takes the saved occurrences among the freetimes matching criteria out of their series,
+        call it before deleting or merging them away so expanding the series doesn't bring them back
+
+        Args:
+            criteria (SQL expressions): filters on freetimes picking the ones about to go
+
+        Returns:
+            int: how many occurrences were skipped
+        """
+        saved = (db.session.query(cls.series_id, cls.occurrence_start)
+            .filter(*criteria, cls.series_id.isnot(None), cls.occurrence_start.isnot(None)))
+        series_ids = db.session.execute(
+            postgresql.insert(series_exceptions).from_select(["series_id", "occurrence_start"], saved)
+            .on_conflict_do_nothing().returning(series_exceptions.c.series_id)
+        ).scalars().all()
+        if series_ids:
+            FreetimeSeries.query.filter(FreetimeSeries.id.in_(set(series_ids))).update(
+                dict(updated_at=datetime.utcnow()), synchronize_session=False)
+        return len(series_ids)
+
+    @classmethod
+    def absorb(cls, target, freetimes):
+        """moves the blocks of freetimes onto target & deletes them, target must be flushed
+
+        Args:
+            target (Freetime): the freetime that takes over the blocks
+            freetimes (list[Freetime]): the freetimes to fold into target
+        """
+        ids = [f.id for f in freetimes]
+        linked = db.session.query(blocks.c.task_id).filter(blocks.c.freetime_id == target.id)
+        moved = (db.session.query(blocks.c.task_id, db.literal(target.id))
+            .filter(blocks.c.freetime_id.in_(ids), blocks.c.task_id.notin_(linked))
+            .distinct())
+        db.session.execute(blocks.insert().from_select(["task_id", "freetime_id"], moved))
+        cls.skip_occurrences(cls.id.in_(ids))
+        cls.query.filter(cls.id.in_(ids)).delete(synchronize_session=False)
+        for freetime in freetimes:
+            db.session.expunge(freetime)
+        db.session.expire(target, ["tasks"])
+
+    @classmethod
+    def coalesce(cls, user_id, lock=False):
+        """gives a user's freetimes with overlapping & touching ones merged, without changing them
+
+        Args:
+            user_id (int): whose freetimes to merge
+            lock (bool): lock the freetimes' rows until the transaction ends
+
+        Returns:
+            list[tuple(datetime, datetime, list[int])]: the merged windows & the ids of the freetimes in each
+        """
+        query = (db.session.query(cls.id, cls.start_time, cls.end_time)
+            .filter(cls.user_id == user_id)
+            .order_by(cls.start_time, cls.id))
+        if lock:
+            query = query.with_for_update()
+        return sweep(query)
+
+    @classmethod
+    def normalize(cls, user_id):
+        """merges a user's overlapping & touching freetimes into single rows, only flushes
+
+        The earliest freetime of each merged window is kept & stretched over it, the
+        blocks of the others move onto it & the others are deleted.
+
+        Returns:
+            list[tuple(datetime, datetime, list[int])]: the merged windows, as coalesce gives them
+        """
+        merged = cls.coalesce(user_id, lock=True)
+        groups = [(start, end, ids) for start, end, ids in merged if len(ids) > 1]
+        if not groups:
+            return merged
+        absorbed, keepers = [], []
+        for _, _, ids in groups:
+            absorbed.extend(ids[1:])
+            keepers.extend([ids[0]] * (len(ids) - 1))
+        db.session.execute(db.text("""
+            INSERT INTO blocks (task_id, freetime_id)
+            SELECT DISTINCT blocks.task_id, moves.keeper_id
+            FROM blocks JOIN unnest(CAST(:absorbed AS integer[]), CAST(:keepers AS integer[])) AS moves (freetime_id, keeper_id)
+                ON blocks.freetime_id = moves.freetime_id
+            ON CONFLICT DO NOTHING
+        """), dict(absorbed=absorbed, keepers=keepers))
+        now = datetime.utcnow()
+        db.session.bulk_update_mappings(cls, [dict(id=ids[0], end_time=end, updated_at=now) for _, end, ids in groups])
+        cls.skip_occurrences(cls.id.in_(absorbed))
+        cls.query.filter(cls.id.in_(absorbed)).delete(synchronize_session=False)
+        db.session.flush()
+        return merged
+
+    @classmethod
+    def apply_batch(cls, user_id, operations, offset=0, overlap="reject"):
+        """applies create / update / delete operations on a user's freetimes with bulk statements,
+        only flushes so the caller decides when the whole batch commits
+
+        Like single writes, creates & updates overlapping the user's other freetimes (as they
+        stand after the operations before them) are rejected unless overlap is "allow".
+
+        Args:
+            user_id (int): the user who owns the freetimes
+            operations (list[dict]): items with an (op) of create, update or delete, an (id) for
+                update & delete and (start/end) times for create & update
+            offset (int): index of the first operation, for batches sent in chunks
+            overlap (string): "reject" or "allow", see OVERLAP_POLICIES
+
+        Returns:
+            list[dict]: a result per operation with its (index), (op), (id) & (ok) or (error)
+        """
+        results = [dict(index=offset + i, op=item.get("op") if isinstance(item, dict) else None) for i, item in enumerate(operations)]
+        ids = {item["id"] for item in operations
+            if isinstance(item, dict) and item.get("op") in ("update", "delete") and type(item.get("id")) is int}
+        owned = {id for id, in db.session.query(cls.id).filter(cls.id.in_(ids), cls.user_id == user_id)} if ids else set()
+        windows = {}
+        for i, item in enumerate(operations):
+            if isinstance(item, dict) and item.get("op") in ("create", "update"):
+                try:
+                    windows[i] = (parse_utc(item["start"]), parse_utc(item["end"]))
+                except (KeyError, TypeError, ValueError, OverflowError):
+                    continue
+        if overlap == "reject":
+            cls.lock_overlaps(user_id)
+        hits = cls.get_batch_overlaps(user_id, windows) if overlap == "reject" else {}
+
+        # every window the batch wrote so far, keyed by freetime id or ("new", index) for creates
+        written = {}
+        creates, updates, deletes = [], {}, set()
+        for i, (item, result) in enumerate(zip(operations, results)):
+            op = result["op"]
+            if op not in BATCH_OPERATIONS:
+                result["error"] = f"(op) must be one of {', '.join(BATCH_OPERATIONS)}"
+                continue
+            if op != "create":
+                result["id"] = item.get("id")
+                if type(result["id"]) is not int or result["id"] not in owned or result["id"] in deletes:
+                    result["error"] = "must provide the (id) of a freetime the user owns"
+                    continue
+            if op == "delete":
+                deletes.add(result["id"])
+                updates.pop(result["id"], None)
+                written.pop(result["id"], None)
+                continue
+            if i not in windows:
+                result["error"] = "required data not provided (start/end) times"
+                continue
+            start_time, end_time = windows[i]
+            if end_time <= start_time:
+                result["error"] = "(start) time must be before the (end) time"
+                continue
+            if overlap == "reject":
+                key = result.get("id", ("new", i))
+                conflicts = [id for id in hits.get(i, ()) if id != key and id not in deletes and id not in written]
+                conflicts += [other for other, (start, end) in written.items()
+                    if other != key and start < end_time and start_time < end]
+                if conflicts:
+                    result["error"] = "freetime overlaps with other freetimes of the user"
+                    result["conflicts"] = [id for id in conflicts if type(id) is int]
+                    continue
+                written[key] = (start_time, end_time)
+            if op == "create":
+                creates.append((result, dict(user_id=user_id, start_time=start_time, end_time=end_time)))
+            else:
+                updates[result["id"]] = dict(id=result["id"], start_time=start_time, end_time=end_time, updated_at=datetime.utcnow())
+
+        if creates:
+            table = cls.__table__
+            new_ids = db.session.execute(table.insert().values([row for _, row in creates]).returning(table.c.id)).scalars().all()
+            for (result, _), id in zip(creates, new_ids):
+                result["id"] = id
+        if updates:
+            db.session.bulk_update_mappings(cls, list(updates.values()))
+        if deletes:
+            cls.skip_occurrences(cls.id.in_(deletes))
+            cls.query.filter(cls.id.in_(deletes)).delete(synchronize_session=False)
+        db.session.flush()
+
+        for result in results:
+            result.setdefault("ok", "error" not in result)
+        return results
+
+    @classmethod
+    def get_batch_overlaps(cls, user_id, windows):
+        """finds the user's saved freetimes overlapping each of many windows with one range index query
+
+        Args:
+            user_id (int): the user who owns the freetimes
+            windows (dict): key -> (start, end) of the windows to check
+
+        Returns:
+            dict: key -> ids of the freetimes overlapping it, keys with none are left out
+        """
+        windows = {key: window for key, window in windows.items() if window[0] < window[1]}
+        if not windows:
+            return {}
+        keys = list(windows)
+        rows = db.session.execute(db.text("""
+            SELECT windows.n, freetimes.id
+            FROM unnest(CAST(:starts AS timestamp[]), CAST(:ends AS timestamp[])) WITH ORDINALITY AS windows (start_time, end_time, n)
+            JOIN freetimes ON int4range(freetimes.user_id, freetimes.user_id, '[]') = int4range(:user_id, :user_id, '[]')
+                AND tsrange(freetimes.start_time, freetimes.end_time, '[)') && tsrange(windows.start_time, windows.end_time, '[)')
+            ORDER BY freetimes.start_time, freetimes.id
+        """), dict(user_id=user_id, starts=[windows[key][0] for key in keys], ends=[windows[key][1] for key in keys]))
+        hits = {}
+        for n, id in rows:
+            hits.setdefault(keys[n - 1], []).append(id)
+        return hits
+
+def sweep(rows):
+    """merges overlapping or touching intervals in one pass over them sorted by start
+
+    Args:
+        rows (iterable): (id, start, end) of intervals, sorted by start
+
+    Returns:
+        list[tuple(datetime, datetime, list[int])]: each merged interval with the ids it covers, in order
+    """
+    merged = []
+    for id, start, end in rows:
+        if merged and start <= merged[-1][1]:
+            last = merged[-1]
+            if end > last[1]:
+                merged[-1] = (last[0], end, last[2])
+            last[2].append(id)
+        else:
+            merged.append((start, end, [id]))
+    return merged
+
+# gist index so overlap queries are a range lookup in the user's freetimes instead of a scan of them
+db.Index("ix_freetimes_user_period", Freetime.owner(Freetime.user_id), Freetime.period(Freetime.start_time, Freetime.end_time), postgresql_using="gist")
+db.Index("ix_freetimes_user_start", Freetime.user_id, Freetime.start_time)
+db.Index("ix_freetimes_user_updated", Freetime.user_id, Freetime.updated_at)
+# imports skip events whose UID the user already has
+db.Index("ix_freetimes_user_uid", Freetime.user_id, Freetime.uid, unique=True)
+# an occurrence is only ever saved as one freetime
+db.Index("ix_freetimes_occurrence", Freetime.series_id, Freetime.occurrence_start, unique=True)
+
+# occurrences of a series the user took out of it
+series_exceptions = db.Table(
+    "series_exceptions",
+    db.Column("series_id", db.Integer, db.ForeignKey("freetime_series.id", ondelete="cascade"), primary_key=True),
+    db.Column("occurrence_start", db.DateTime, primary_key=True),
+)
+
+# most occurrences one series gives for a window, however often it repeats
+MAX_OCCURRENCES = 500
+
+class Occurrence:
+    """one occurrence of a freetime series, expanded on the fly & only saved once a task is blocked into it"""
+
+    __slots__ = ("series_id", "start_time", "end_time")
+
+    def __init__(self, series_id, start_time, end_time):
+        self.series_id = series_id
+        self.start_time = start_time
+        self.end_time = end_time
+
+    def __repr__(self):
+        return f"<Occurrence {self.id} end={self.end_time}>"
+
+    def __eq__(self, other):
+        return isinstance(other, Occurrence) and (other.series_id, other.start_time) == (self.series_id, self.start_time)
+
+    def __hash__(self):
+        return hash((self.series_id, self.start_time))
+
+    @property
+    def id(self):
+        """key of the occurrence, stands in for a freetime id in choices & labels"""
+        return f"{self.series_id}@{self.start_time:%Y%m%dT%H%M%S}"
+
+    @staticmethod
+    def parse_key(key):
+        """splits an occurrence key into its series id & start
+
+        Raises:
+            ValueError: when the key is malformed
+        """
+        series_id, _, start = str(key).partition("@")
+        return int(series_id), datetime.strptime(start, "%Y%m%dT%H%M%S")
+
+class FreetimeSeries(db.Model):
+    """model for repeating freetimes, stored once with a recurrence rule & expanded when read"""
+    __tablename__ = "freetime_series"
+    __table_args__ = (
+        db.CheckConstraint("end_time > start_time", name="freetime_series_valid_range"),
+    )
+
+    # how far ahead of today occurrences are expanded
+    window = timedelta(days=28)
+
+    id = db.Column(db.Integer, primary_key=True, autoincrement=True)
+    # the first occurrence, naive UTC like freetimes
+    start_time = db.Column(db.DateTime, nullable=False)
+    end_time = db.Column(db.DateTime, nullable=False)
+    # an RRULE without DTSTART, like FREQ=WEEKLY;BYDAY=MO,WE
+    rule = db.Column(db.String(500), nullable=False)
+    # zone the rule repeats in so occurrences keep their wall clock time over DST, UTC when not set
+    timezone = db.Column(db.String(64))
+    user_id = db.Column(db.Integer, db.ForeignKey("users.id", ondelete="cascade"), nullable=False, index=True)
+    updated_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow, onupdate=datetime.utcnow, server_default=UTC_NOW)
+
+    def __repr__(self):
+        return f"<FreetimeSeries #{self.id} {self.rule} start={self.start_time} user_id={self.user_id}>"
+
+    @staticmethod
+    def check_rule(rule):
+        """normalizes a recurrence rule, making sure dateutil can expand it
+
+        Returns:
+            string: the rule without an RRULE: prefix
+
+        Raises:
+            ValueError: when the rule can't be parsed or repeats more than hourly
+        """
+        rule = str(rule).strip()
+        if rule.upper().startswith("RRULE:"):
+            rule = rule[6:]
+        if not rule or "\n" in rule or "DTSTART" in rule.upper():
+            raise ValueError("must be a single RRULE")
+        rrulestr(rule, dtstart=datetime(2000, 1, 1))
+        if any(part.strip().upper() in ("FREQ=SECONDLY", "FREQ=MINUTELY") for part in rule.split(";")):
+            raise ValueError("can't repeat more often than hourly")
+        return rule
+
+    @property
+    def zone(self):
+        return tz.gettz(self.timezone) if self.timezone and is_timezone(self.timezone) else tz.tzutc()
+
+    def recurrence(self):
+        """gives the dateutil rrule of the series, in the series' local wall time"""
+        local_start = self.start_time.replace(tzinfo=tz.tzutc()).astimezone(self.zone).replace(tzinfo=None)
+        return rrulestr(self.rule, dtstart=local_start)
+
+    def occurrences(self, start, end, skip=frozenset()):
+        """lazily gives the series' occurrences starting in [start, end)
+
+        Args:
+            start (datetime): naive UTC start of the window
+            end (datetime): naive UTC end of the window
+            skip (set[datetime]): occurrence starts to leave out
+
+        Yields:
+            Occurrence: each occurrence in start order
+        """
+        zone, utc, length = self.zone, tz.tzutc(), self.end_time - self.start_time
+        # a day either side covers any offset between the zone & UTC
+        local_from = start.replace(tzinfo=utc).astimezone(zone).replace(tzinfo=None) - timedelta(days=1)
+        local_to = end.replace(tzinfo=utc).astimezone(zone).replace(tzinfo=None) + timedelta(days=1)
+        for local in self.recurrence().xafter(local_from, inc=True):
+            if local > local_to:
+                break
+            occurrence_start = local.replace(tzinfo=zone).astimezone(utc).replace(tzinfo=None)
+            if start <= occurrence_start < end and occurrence_start not in skip:
+                yield Occurrence(self.id, occurrence_start, occurrence_start + length)
+
+    def has_occurrence(self, start):
+        """whether the rule has an occurrence starting at start (naive UTC)"""
+        return next(self.occurrences(start, start + timedelta(seconds=1)), None) is not None
+
+    @classmethod
+    def default_window(cls):
+        """gives the (start, end) window occurrences are shown for, from the start of today (UTC)"""
+        today = datetime.utcnow().replace(hour=0, minute=0, second=0, microsecond=0)
+        return today, today + cls.window
+
+    @classmethod
+    def get_taken(cls, series_ids, start, end):
+        """gives the starts of occurrences in the window that were skipped or saved as freetimes
+
+        Returns:
+            dict: series id -> set of occurrence starts
+        """
+        taken = {id: set() for id in series_ids}
+        if not series_ids:
+            return taken
+        skipped = (db.session.query(series_exceptions.c.series_id, series_exceptions.c.occurrence_start)
+            .filter(series_exceptions.c.series_id.in_(series_ids),
+                series_exceptions.c.occurrence_start >= start, series_exceptions.c.occurrence_start < end))
+        saved = (db.session.query(Freetime.series_id, Freetime.occurrence_start)
+            .filter(Freetime.series_id.in_(series_ids),
+                Freetime.occurrence_start >= start, Freetime.occurrence_start < end))
+        for series_id, occurrence_start in skipped.union_all(saved):
+            taken[series_id].add(occurrence_start)
+        return taken
+
+    @classmethod
+    def expand(cls, user_id, start=None, end=None, limit=MAX_OCCURRENCES):
+        """expands the occurrences of all of a user's series inside a window, leaving out
+        skipped occurrences & ones already saved as freetimes
+
+        Args:
+            user_id (int): whose series to expand
+            start (datetime, optional): naive UTC start of the window, defaults to the start of today
+            end (datetime, optional): naive UTC end of the window, defaults to window after start
+            limit (int): most occurrences given
+
+        Returns:
+            list[Occurrence]: the occurrences in start order
+        """
+        default_start, default_end = cls.default_window()
+        start = start or default_start
+        end = end or start + (default_end - default_start)
+        series = cls.query.filter(cls.user_id == user_id).order_by(cls.id).all()
+        taken = cls.get_taken([s.id for s in series], start, end)
+        streams = [islice(s.occurrences(start, end, taken[s.id]), limit) for s in series]
+        merged = heapq.merge(*streams, key=lambda o: (o.start_time, o.end_time, o.series_id))
+        return list(islice(merged, limit))
+
+    @classmethod
+    def materialize(cls, user_id, keys):
+        """saves occurrences as freetimes (once) so tasks can be blocked into them, only flushes
+
+        Args:
+            user_id (int): who the occurrences must belong to
+            keys (list[string]): occurrence keys, as Occurrence.id gives them
+
+        Returns:
+            dict: key -> freetime id for the keys that are real occurrences of the user's series
+        """
+        wanted = {}
+        for key in keys:
+            try:
+                wanted[key] = Occurrence.parse_key(key)
+            except ValueError:
+                continue
+        series = {s.id: s for s in cls.query.filter(cls.user_id == user_id, cls.id.in_({id for id, _ in wanted.values()}))} if wanted else {}
+        skipped = set(db.session.query(series_exceptions.c.series_id, series_exceptions.c.occurrence_start)
+            .filter(series_exceptions.c.series_id.in_(series))) if series else set()
+        rows = {}
+        for key, (series_id, start) in wanted.items():
+            found = series.get(series_id)
+            if found and (series_id, start) not in skipped and found.has_occurrence(start):
+                rows[key] = dict(user_id=user_id, series_id=series_id, occurrence_start=start,
+                    start_time=start, end_time=start + (found.end_time - found.start_time))
+        if not rows:
+            return {}
+        table = Freetime.__table__
+        db.session.execute(
+            postgresql.insert(table).values(list(rows.values()))
+            .on_conflict_do_nothing(index_elements=["series_id", "occurrence_start"])
+        )
+        saved = (db.session.query(Freetime.id, Freetime.series_id, Freetime.occurrence_start)
+            .filter(db.tuple_(Freetime.series_id, Freetime.occurrence_start).in_([(r["series_id"], r["occurrence_start"]) for r in rows.values()])))
+        ids = {(series_id, start): id for id, series_id, start in saved}
+        cls.query.filter(cls.id.in_({r["series_id"] for r in rows.values()})).update(dict(updated_at=datetime.utcnow()), synchronize_session=False)
+        return {key: ids[(row["series_id"], row["occurrence_start"])] for key, row in rows.items()}
+
+    @classmethod
+    def skip(cls, user_id, key):
+        """takes one occurrence out of its series, only flushes
+
+        Returns:
+            bool: whether the key was an occurrence of one of the user's series
+        """
+        try:
+            series_id, start = Occurrence.parse_key(key)
+        except ValueError:
+            return False
+        series = cls.query.filter(cls.id == series_id, cls.user_id == user_id).one_or_none()
+        if series is None or not series.has_occurrence(start):
+            return False
+        db.session.execute(
+            postgresql.insert(series_exceptions).values(series_id=series_id, occurrence_start=start)
+            .on_conflict_do_nothing()
+        )
+        series.updated_at = datetime.utcnow()
+        db.session.flush()
+        return True
+
+# blocks is keyed (task_id, freetime_id) so freetime side lookups need their own index
+db.Index("ix_blocks_freetime", blocks.c.freetime_id)
+
+def paginate(query, keys, cursor=None, per_page=None):
+    """runs a query, optionally only for the page of results after a cursor
+
+    Args:
+        query (Query): the query to run, it's ordered by keys here
+        keys (list[tuple]): (column, getter) pairs of the sort keys, together unique for each row
+        cursor (string, optional): the next cursor of the previous page, from the first row without it
+        per_page (int, optional): rows in a page, all rows are returned without it
+
+    Raises:
+        ValueError: when the cursor is malformed
+
+    Returns:
+        tuple(list, string | None): the rows & the cursor of the next page if there is one
+    """
+    columns = [column for column, _ in keys]
+    if cursor:
+        values = decode_cursor(cursor, [column.type.python_type for column in columns])
+        query = query.filter(db.tuple_(*columns) > db.tuple_(*values))
+    query = query.order_by(*columns)
+    if not per_page:
+        return query.all(), None
+    rows = query.limit(per_page + 1).all()
+    if len(rows) <= per_page:
+        return rows, None
+    rows = rows[:per_page]
+    return rows, encode_cursor([get(rows[-1]) for _, get in keys])
+
+class PlanDiff:
+    """a user's planned blocks, unplanned tasks & open freetimes, each found with one query
+
+    Each section is paged on its own with a keyset cursor, blocks & freetimes by start time.
+    """
+
+    def __init__(self, user_id, per_page=None, blocks_cursor=None, tasks_cursor=None, freetimes_cursor=None):
+        task_planned = db.exists().where(blocks.c.task_id == Task.id)
+        freetime_planned = db.exists().where(blocks.c.freetime_id == Freetime.id)
+
+        planned = (db.session.query(Task, Freetime)
+            .join(blocks, blocks.c.task_id == Task.id)
+            .join(Freetime, Freetime.id == blocks.c.freetime_id)
+            .filter(Task.user_id == user_id))
+        open_tasks = Task.query.filter(Task.user_id == user_id, ~task_planned)
+        open_freetimes = Freetime.query.filter(Freetime.user_id == user_id, ~freetime_planned)
+
+        self.blocks, self.next_blocks = paginate(planned, [
+            (Freetime.start_time, lambda row: row[1].start_time), (Freetime.id, lambda row: row[1].id), (Task.id, lambda row: row[0].id),
+        ], blocks_cursor, per_page)
+        self.open_tasks, self.next_tasks = paginate(open_tasks, [(Task.id, lambda t: t.id)], tasks_cursor, per_page)
+        self.open_freetimes, self.next_freetimes = paginate(open_freetimes, [
+            (Freetime.start_time, lambda f: f.start_time), (Freetime.id, lambda f: f.id),
+        ], freetimes_cursor, per_page)
+
+    def __repr__(self):
+        return f"<PlanDiff blocks={len(self.blocks)} open_tasks={len(self.open_tasks)} open_freetimes={len(self.open_freetimes)}>"
+
+class UserCapacity(db.Model):
+    """a user's freetime minutes, how many are planned or still open & the minutes of unfinished tasks
+
+    Rows are kept up to date by triggers on users, freetimes, tasks & blocks (see CAPACITY_DDL),
+    so every way of writing them, bulk statements & cascades included, keeps them right.
+    Tasks count with their time estimate, tasks without one count as 0 minutes.
+    """
+    __tablename__ = "user_capacity"
+
+    user_id = db.Column(db.Integer, db.ForeignKey("users.id", ondelete="cascade"), primary_key=True)
+    freetime_minutes = db.Column(db.Integer, nullable=False, server_default="0")
+    planned_minutes = db.Column(db.Integer, nullable=False, server_default="0")
+    open_minutes = db.Column(db.Integer, nullable=False, server_default="0")
+    pending_minutes = db.Column(db.Integer, nullable=False, server_default="0")
+
+    def __repr__(self):
+        return f"<UserCapacity user_id={self.user_id} planned={self.planned_minutes}/{self.freetime_minutes} pending={self.pending_minutes}>"
+
+    def to_dict(self):
+        return dict(
+            freetime_minutes=self.freetime_minutes, planned_minutes=self.planned_minutes,
+            open_minutes=self.open_minutes, pending_minutes=self.pending_minutes,
+        )
+
+    @classmethod
+    def get(cls, user_id):
+        """gives the user's capacity, all zeros when they have no row yet"""
+        return cls.query.get(user_id) or cls(user_id=user_id, freetime_minutes=0, planned_minutes=0, open_minutes=0, pending_minutes=0)
+
+    @classmethod
+    def reconcile(cls, fix=False):
+        """recounts every freetime's committed minutes & every user's totals from scratch to check the triggers
+
+        The check reads one snapshot without locking anything. Fixing locks freetimes, tasks &
+        blocks against writes while the counters are rewritten.
+
+        Args:
+            fix (bool): rewrite the counters that are off
+
+        Returns:
+            dict: how many (freetimes) & (users) had counters that were off
+        """
+        with db.engine.connect() as conn:
+            if not fix:
+                conn = conn.execution_options(isolation_level="REPEATABLE READ")
+            with conn.begin():
+                if fix:
+                    conn.execute(db.text("LOCK TABLE freetimes, tasks, blocks IN SHARE MODE"))
+                    # updating freetimes fires their trigger, which moves the users' totals along
+                    freetimes = conn.execute(db.text(f"""
+                        UPDATE freetimes f SET committed_minutes = actual.minutes FROM ({ACTUAL_COMMITTED}) actual
+                        WHERE f.id = actual.id AND f.committed_minutes <> actual.minutes RETURNING f.id
+                    """)).rowcount
+                    users = conn.execute(db.text(f"""
+                        INSERT INTO user_capacity ({ACTUAL_CAPACITY}) ON CONFLICT (user_id) DO UPDATE SET
+                            freetime_minutes = EXCLUDED.freetime_minutes, planned_minutes = EXCLUDED.planned_minutes,
+                            open_minutes = EXCLUDED.open_minutes, pending_minutes = EXCLUDED.pending_minutes
+                        WHERE (user_capacity.freetime_minutes, user_capacity.planned_minutes, user_capacity.open_minutes, user_capacity.pending_minutes)
+                            IS DISTINCT FROM (EXCLUDED.freetime_minutes, EXCLUDED.planned_minutes, EXCLUDED.open_minutes, EXCLUDED.pending_minutes)
+                        RETURNING user_id
+                    """)).rowcount
+                else:
+                    freetimes = conn.execute(db.text(f"""
+                        SELECT COUNT(*) FROM freetimes f JOIN ({ACTUAL_COMMITTED}) actual ON actual.id = f.id
+                        WHERE f.committed_minutes <> actual.minutes
+                    """)).scalar()
+                    users = conn.execute(db.text(f"""
+                        SELECT COUNT(*) FROM ({ACTUAL_CAPACITY}) actual LEFT JOIN user_capacity c USING (user_id)
+                        WHERE (c.freetime_minutes, c.planned_minutes, c.open_minutes, c.pending_minutes)
+                            IS DISTINCT FROM (actual.freetime_minutes, actual.planned_minutes, actual.open_minutes, actual.pending_minutes)
+                    """)).scalar()
+        return dict(freetimes=freetimes, users=users)
+
+# what each freetime's committed minutes should be, counted from the blocks
+ACTUAL_COMMITTED = """
+    SELECT f.id, COALESCE(SUM(t.time_estimate), 0) AS minutes FROM freetimes f
+    LEFT JOIN blocks b ON b.freetime_id = f.id LEFT JOIN tasks t ON t.id = b.task_id
+    GROUP BY f.id
+"""
+
+# what every user's capacity row should be, counted from the freetimes' committed minutes & the tasks
+ACTUAL_CAPACITY = """
+    SELECT u.id AS user_id, COALESCE(f.total, 0) AS freetime_minutes, COALESCE(f.planned, 0) AS planned_minutes,
+        COALESCE(f.open, 0) AS open_minutes, COALESCE(t.pending, 0) AS pending_minutes
+    FROM users u
+    LEFT JOIN (
+        SELECT user_id, SUM(minutes_between(start_time, end_time)) AS total, SUM(committed_minutes) AS planned,
+            SUM(GREATEST(minutes_between(start_time, end_time) - committed_minutes, 0)) AS open
+        FROM freetimes GROUP BY user_id
+    ) f ON f.user_id = u.id
+    LEFT JOIN (
+        SELECT user_id, SUM(time_estimate) AS pending FROM tasks WHERE status <> 'done' GROUP BY user_id
+    ) t ON t.user_id = u.id
+"""
+
+# functions & statement level triggers keeping freetimes.committed_minutes & user_capacity up to date,
+# each trigger reads all rows its statement changed so bulk writes cost a few set based updates
+CAPACITY_DDL = """
+CREATE OR REPLACE FUNCTION minutes_between(start_time timestamp, end_time timestamp) RETURNS integer
+LANGUAGE sql IMMUTABLE AS $$ SELECT FLOOR(EXTRACT(EPOCH FROM end_time - start_time) / 60)::integer $$;
+
+-- committed minutes are only ever moved by deltas, the row lock of the update serializes writers
+-- where a recount from the writer's snapshot would overwrite what another transaction added
+DROP FUNCTION IF EXISTS recount_committed(integer[]);
+
+CREATE OR REPLACE FUNCTION users_capacity() RETURNS trigger LANGUAGE plpgsql AS $$
+BEGIN
+    INSERT INTO user_capacity (user_id) SELECT id FROM new_rows ON CONFLICT DO NOTHING;
+    RETURN NULL;
+END $$;
+
+CREATE OR REPLACE FUNCTION freetimes_capacity() RETURNS trigger LANGUAGE plpgsql AS $$
+BEGIN
+    IF TG_OP IN ('UPDATE', 'DELETE') THEN
+        UPDATE user_capacity c SET freetime_minutes = c.freetime_minutes - d.total,
+            planned_minutes = c.planned_minutes - d.planned, open_minutes = c.open_minutes - d.open
+        FROM (
+            SELECT user_id, SUM(minutes_between(start_time, end_time)) AS total, SUM(committed_minutes) AS planned,
+                SUM(GREATEST(minutes_between(start_time, end_time) - committed_minutes, 0)) AS open
+            FROM old_rows GROUP BY user_id
+        ) d
+        WHERE c.user_id = d.user_id;
+    END IF;
+    IF TG_OP IN ('INSERT', 'UPDATE') THEN
+        UPDATE user_capacity c SET freetime_minutes = c.freetime_minutes + d.total,
+            planned_minutes = c.planned_minutes + d.planned, open_minutes = c.open_minutes + d.open
+        FROM (
+            SELECT user_id, SUM(minutes_between(start_time, end_time)) AS total, SUM(committed_minutes) AS planned,
+                SUM(GREATEST(minutes_between(start_time, end_time) - committed_minutes, 0)) AS open
+            FROM new_rows GROUP BY user_id
+        ) d
+        WHERE c.user_id = d.user_id;
+    END IF;
+    RETURN NULL;
+END $$;
+
+CREATE OR REPLACE FUNCTION tasks_capacity() RETURNS trigger LANGUAGE plpgsql AS $$
+BEGIN
+    IF TG_OP IN ('UPDATE', 'DELETE') THEN
+        UPDATE user_capacity c SET pending_minutes = c.pending_minutes - d.pending
+        FROM (SELECT user_id, SUM(time_estimate) AS pending FROM old_rows WHERE status <> 'done' GROUP BY user_id) d
+        WHERE c.user_id = d.user_id AND d.pending IS NOT NULL;
+    END IF;
+    IF TG_OP IN ('INSERT', 'UPDATE') THEN
+        UPDATE user_capacity c SET pending_minutes = c.pending_minutes + d.pending
+        FROM (SELECT user_id, SUM(time_estimate) AS pending FROM new_rows WHERE status <> 'done' GROUP BY user_id) d
+        WHERE c.user_id = d.user_id AND d.pending IS NOT NULL;
+    END IF;
+    IF TG_OP = 'UPDATE' THEN
+        UPDATE freetimes f SET committed_minutes = f.committed_minutes + d.minutes
+        FROM (
+            SELECT b.freetime_id, SUM(COALESCE(n.time_estimate, 0) - COALESCE(o.time_estimate, 0)) AS minutes
+            FROM new_rows n JOIN old_rows o ON o.id = n.id JOIN blocks b ON b.task_id = n.id GROUP BY b.freetime_id
+        ) d
+        WHERE f.id = d.freetime_id AND d.minutes <> 0;
+    END IF;
+    RETURN NULL;
+END $$;
+
+-- blocks of deleted tasks go by cascade once the task is gone & the blocks trigger can't read its
+-- estimate, so it's taken off their freetimes before the task is deleted, unless the whole user is
+CREATE OR REPLACE FUNCTION tasks_release_blocks() RETURNS trigger LANGUAGE plpgsql AS $$
+BEGIN
+    IF EXISTS (SELECT 1 FROM users WHERE id = OLD.user_id) THEN
+        UPDATE freetimes f SET committed_minutes = f.committed_minutes - OLD.time_estimate
+        FROM blocks b WHERE b.task_id = OLD.id AND f.id = b.freetime_id AND OLD.time_estimate <> 0;
+    END IF;
+    RETURN OLD;
+END $$;
+
+CREATE OR REPLACE FUNCTION blocks_capacity() RETURNS trigger LANGUAGE plpgsql AS $$
+BEGIN
+    IF TG_OP IN ('UPDATE', 'DELETE') THEN
+        UPDATE freetimes f SET committed_minutes = f.committed_minutes - d.minutes
+        FROM (SELECT o.freetime_id, SUM(t.time_estimate) AS minutes FROM old_rows o JOIN tasks t ON t.id = o.task_id GROUP BY o.freetime_id) d
+        WHERE f.id = d.freetime_id AND d.minutes <> 0;
+    END IF;
+    IF TG_OP IN ('INSERT', 'UPDATE') THEN
+        UPDATE freetimes f SET committed_minutes = f.committed_minutes + d.minutes
+        FROM (SELECT n.freetime_id, SUM(t.time_estimate) AS minutes FROM new_rows n JOIN tasks t ON t.id = n.task_id GROUP BY n.freetime_id) d
+        WHERE f.id = d.freetime_id AND d.minutes <> 0;
+    END IF;
+    RETURN NULL;
+END $$;
+
+CREATE OR REPLACE TRIGGER tasks_capacity_release BEFORE DELETE ON tasks
+FOR EACH ROW EXECUTE FUNCTION tasks_release_blocks();
+""" + "".join(
+    f"""
+CREATE OR REPLACE TRIGGER {table}_capacity_{op.lower()} AFTER {op} ON {table}
+REFERENCING {references} FOR EACH STATEMENT EXECUTE FUNCTION {table}_capacity();
+"""
+    for table, ops in (
+        ("users", ("INSERT",)),
+        ("freetimes", ("INSERT", "UPDATE", "DELETE")),
+        ("tasks", ("INSERT", "UPDATE", "DELETE")),
+        ("blocks", ("INSERT", "UPDATE", "DELETE")),
+    )
+    for op in ops
+    for references in ({
+        "INSERT": "NEW TABLE AS new_rows", "UPDATE": "OLD TABLE AS old_rows NEW TABLE AS new_rows", "DELETE": "OLD TABLE AS old_rows",
+    }[op],)
+) + f"""
+-- rows from before the triggers were installed are counted once, freetimes first so the users' totals read them
+UPDATE freetimes f SET committed_minutes = actual.minutes FROM ({ACTUAL_COMMITTED}) actual
+WHERE f.id = actual.id AND f.committed_minutes <> actual.minutes;
+INSERT INTO user_capacity ({ACTUAL_CAPACITY}) ON CONFLICT (user_id) DO NOTHING;
+"""
+
+# installed whenever the tables are created, the statements replace what's there & only fill in
+# missing counters so reruns are safe, python setup.py on an older database backfills its users
+event.listen(db.metadata, "after_create", db.DDL(CAPACITY_DDL))
+
+# states of a background job, a failed attempt that will be retried goes back to queued
+JOB_STATUSES = ("queued", "running", "done", "failed", "cancelled")
+
+class Job(db.Model):
+    """a piece of background work in the queue the job workers (jobs.py) take from"""
+    __tablename__ = "jobs"
+
+    id = db.Column(db.Integer, primary_key=True, autoincrement=True)
+    # who the job works for, none for jobs of the whole app
+    user_id = db.Column(db.Integer, db.ForeignKey("users.id", ondelete="cascade"))
+    kind = db.Column(db.String(50), nullable=False)
+    args = db.Column(postgresql.JSONB, nullable=False, default=dict, server_default="{}")
+    status = db.Column(db.String(10), nullable=False, default=JOB_STATUSES[0])
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    max_attempts = db.Column(db.Integer, nullable=False, default=3)
+    # when the job may run next, pushed back after each failed attempt
+    run_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    # the worker running the job & when it last refreshed the lock, so jobs of workers that died can be taken back
+    locked_by = db.Column(db.String(100))
+    locked_at = db.Column(db.DateTime)
+    cancel_requested = db.Column(db.Boolean, nullable=False, default=False)
+    result = db.Column(postgresql.JSONB)
+    error = db.Column(db.Text)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow, server_default=UTC_NOW)
+    finished_at = db.Column(db.DateTime)
+
+    def __repr__(self):
+        return f"<Job #{self.id} {self.kind} ({self.status}) user_id={self.user_id}>"
+
+    def to_dict(self):
+        return dict(
+            id=self.id, kind=self.kind, status=self.status, attempts=self.attempts, max_attempts=self.max_attempts,
+            run_at=self.run_at, created_at=self.created_at, finished_at=self.finished_at,
+            cancel_requested=self.cancel_requested, result=self.result, error=self.error,
+        )
+
+# the queued jobs in the order workers take them & the running ones, to find jobs of dead workers
+db.Index("ix_jobs_queued", Job.run_at, Job.id, postgresql_where=Job.status == "queued")
+db.Index("ix_jobs_running", Job.user_id, Job.locked_at, postgresql_where=Job.status == "running")
+db.Index("ix_jobs_user", Job.user_id, Job.id)
@@ -0,0 +1,234 @@
+import heapq
+from datetime import datetime
+from time import perf_counter
+from bisect import bisect_left, insort
+
+from sqlalchemy.dialects import postgresql
+
+from models import db, Task, Freetime, FreetimeSeries, blocks
+
+# modes the planner can run in
+PLAN_MODES = ("greedy", "optimize")
+
+# minutes assumed for tasks that have no time estimate
+DEFAULT_ESTIMATE = 30
+
+# how long the optimize mode may spend improving the greedy plan (seconds)
+OPTIMIZE_BUDGET = 0.25
+
+class CapacityTree:
+    """segment tree over freetimes (in start order) holding the max remaining minutes,
+    finds the earliest freetime a task fits in within O(log n)"""
+
+    def __init__(self, capacities):
+        self.size = 1
+        while self.size < len(capacities):
+            self.size *= 2
+        self.tree = [-1] * (2 * self.size)
+        self.tree[self.size:self.size + len(capacities)] = capacities
+        for i in range(self.size - 1, 0, -1):
+            self.tree[i] = max(self.tree[2 * i], self.tree[2 * i + 1])
+
+    def earliest_fit(self, minutes):
+        """gives the index of the first freetime with at least minutes left or None"""
+        if self.tree[1] < minutes:
+            return None
+        i = 1
+        while i < self.size:
+            i = 2 * i if self.tree[2 * i] >= minutes else 2 * i + 1
+        return i - self.size
+
+    def take(self, index, minutes):
+        """removes minutes from the freetime at index"""
+        i = index + self.size
+        self.tree[i] -= minutes
+        i //= 2
+        while i:
+            self.tree[i] = max(self.tree[2 * i], self.tree[2 * i + 1])
+            i //= 2
+
+class Plan:
+    """a proposed assignment of tasks to freetimes"""
+
+    def __init__(self, mode, assignments, unplanned, user_id=None):
+        self.mode = mode
+        # list of (task_id, freetime_id) pairs, the freetime is an occurrence key for repeating freetimes
+        self.assignments = assignments
+        self.unplanned = unplanned
+        self.user_id = user_id
+
+    def __repr__(self):
+        return f"<Plan {self.mode} planned={len(self.assignments)} unplanned={len(self.unplanned)}>"
+
+    def to_dict(self):
+        """gives the plan as json friendly data"""
+        return dict(
+            mode=self.mode,
+            blocks=[dict(task_id=t, freetime_id=f) for t, f in self.assignments],
+            unplanned=self.unplanned,
+        )
+
+    def save(self):
+        """writes the plan's blocks in a single bulk insert, occurrences are saved as freetimes first,
+        only flushes so the caller decides when the plan commits
+
+        Blocks made since the plan was worked out (by another request or a job) are left as
+        they are instead of failing the insert.
+
+        Returns:
+            int: how many of the plan's blocks were saved
+        """
+        keys = [f for _, f in self.assignments if isinstance(f, str)]
+        saved = FreetimeSeries.materialize(self.user_id, keys) if keys else {}
+        rows = [dict(task_id=t, freetime_id=saved.get(f, f)) for t, f in self.assignments]
+        rows = [row for row in rows if isinstance(row["freetime_id"], int)]
+        count = 0
+        if rows:
+            inserted = db.session.execute(
+                postgresql.insert(blocks).values(rows).on_conflict_do_nothing().returning(blocks.c.task_id))
+            count = len(inserted.all())
+        db.session.flush()
+        return count
+
+def load_open_tasks(user_id):
+    """gets (id, priority, minutes) of a user's unfinished tasks that have no blocks yet"""
+    planned = db.session.query(blocks.c.task_id)
+    rows = (db.session.query(Task.id, Task.priority, Task.time_estimate)
+        .filter(Task.user_id == user_id, Task.status != "done", Task.id.notin_(planned))
+    ).all()
+    return [(id, priority, estimate or DEFAULT_ESTIMATE) for id, priority, estimate in rows]
+
+def load_open_freetimes(user_id, since=None):
+    """gets (id, minutes) of a user's upcoming freetimes that have no blocks yet, in start order,
+    along with (key, minutes) of their repeating freetimes' occurrences in the expansion window"""
+    since = since or datetime.utcnow()
+    planned = db.session.query(blocks.c.freetime_id)
+    rows = (db.session.query(Freetime.id, Freetime.start_time, Freetime.end_time)
+        .filter(Freetime.user_id == user_id, Freetime.start_time >= since, Freetime.id.notin_(planned))
+        .order_by(Freetime.start_time, Freetime.end_time)
+    ).all()
+    occurrences = [(o.start_time, o.end_time, o.id) for o in FreetimeSeries.expand(user_id, since)]
+    merged = heapq.merge([(start, end, id) for id, start, end in rows], occurrences, key=lambda row: row[:2])
+    return [(id, int((end - start).total_seconds() // 60)) for start, end, id in merged]
+
+def task_value(task):
+    """how much placing a task is worth, high priority & long tasks count the most"""
+    _, priority, minutes = task
+    return (priority + 1) * minutes
+
+def plan_greedy(tasks, freetimes):
+    """places tasks by priority (longest first on ties) into the earliest freetime they fit
+
+    Args:
+        tasks (list[tuple]): (id, priority, minutes) of the tasks to place
+        freetimes (list[tuple]): (id, minutes) of the freetimes in start order
+
+    Returns:
+        tuple(dict, list): task id -> freetime index & the tasks that could not be placed
+    """
+    tree = CapacityTree([minutes for _, minutes in freetimes])
+    placed = {}
+    unplaced = []
+    for task in sorted(tasks, key=lambda t: (-t[1], -t[2], t[0])):
+        index = tree.earliest_fit(task[2])
+        if index is None:
+            unplaced.append(task)
+        else:
+            tree.take(index, task[2])
+            placed[task[0]] = index
+    return placed, unplaced
+
+def plan_optimized(tasks, freetimes, budget=OPTIMIZE_BUDGET):
+    """best fit packing followed by swaps that raise the total value, stops once budget runs out
+
+    Args:
+        tasks (list[tuple]): (id, priority, minutes) of the tasks to place
+        freetimes (list[tuple]): (id, minutes) of the freetimes in start order
+        budget (float): seconds allowed for the improvement passes
+
+    Returns:
+        tuple(dict, list): task id -> freetime index & the tasks that could not be placed
+    """
+    deadline = perf_counter() + budget
+    remaining = [minutes for _, minutes in freetimes]
+    # sorted (remaining minutes, freetime index) so the tightest fit is a bisect away
+    free = sorted((minutes, i) for i, minutes in enumerate(remaining))
+    contents = [[] for _ in freetimes]
+    placed = {}
+    unplaced = []
+
+    def best_fit(minutes):
+        pos = bisect_left(free, (minutes, -1))
+        return free[pos][1] if pos < len(free) else None
+
+    def move(index, minutes):
+        free.pop(bisect_left(free, (remaining[index], index)))
+        remaining[index] -= minutes
+        insort(free, (remaining[index], index))
+
+    def put(task, index):
+        move(index, task[2])
+        contents[index].append(task)
+        placed[task[0]] = index
+
+    def pull(task, index):
+        move(index, -task[2])
+        contents[index].remove(task)
+        del placed[task[0]]
+
+    for task in sorted(tasks, key=lambda t: (-task_value(t), t[0])):
+        index = best_fit(task[2])
+        if index is None:
+            unplaced.append(task)
+        else:
+            put(task, index)
+
+    improved = True
+    while improved and unplaced and perf_counter() < deadline:
+        improved = False
+        for task in list(unplaced):
+            if perf_counter() >= deadline:
+                break
+            index = best_fit(task[2])
+            if index is not None:
+                put(task, index)
+                unplaced.remove(task)
+                improved = True
+                continue
+            # evict one cheaper task to make room, re-placing it elsewhere when possible
+            for index, held in enumerate(contents):
+                swap = next((h for h in held if remaining[index] + h[2] >= task[2]
+                    and task_value(h) < task_value(task)), None)
+                if swap is None:
+                    continue
+                pull(swap, index)
+                put(task, index)
+                unplaced.remove(task)
+                other = best_fit(swap[2])
+                if other is None:
+                    unplaced.append(swap)
+                else:
+                    put(swap, other)
+                improved = True
+                break
+    return placed, unplaced
+
+def make_plan(user_id, mode="greedy", since=None):
+    """proposes blocks for a user's open tasks in their open freetimes
+
+    Args:
+        user_id (int): the user to plan for
+        mode (string): one of PLAN_MODES
+        since (datetime, optional): only use freetimes starting after this, defaults to now (UTC)
+
+    Returns:
+        Plan: the proposed plan, nothing is saved until Plan.save is called
+    """
+    tasks = load_open_tasks(user_id)
+    freetimes = load_open_freetimes(user_id, since)
+    if mode == "optimize":
+        placed, unplaced = plan_optimized(tasks, freetimes)
+    else:
+        placed, unplaced = plan_greedy(tasks, freetimes)
+    assignments = [(task_id, freetimes[index][0]) for task_id, index in placed.items()]
+    return Plan(mode, assignments, [task[0] for task in unplaced], user_id)
@@ -0,0 +1,156 @@
+import re
+import hmac
+import random
+import heapq
+from collections import deque
+from threading import Lock
+from time import perf_counter
+
+from flask import g, has_request_context, request, jsonify, abort
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+# most distinct statement shapes kept in the process wide totals
+MAX_STATEMENTS = 500
+
+# patterns used to turn statements into one shape per query, literals become ?
+NORMALIZERS = (
+    (re.compile(r"%\(\w+\)s|%s|\?"), "?"),
+    (re.compile(r"'(?:[^']|'')*'"), "?"),
+    (re.compile(r"\b\d+(?:\.\d+)?\b"), "?"),
+    (re.compile(r"\(\s*\?(?:\s*,\s*\?)+\s*\)"), "(...)"),
+    (re.compile(r"\s+"), " "),
+)
+
+def normalize_sql(statement):
+    """gives the shape of a statement with literals & parameters replaced, so similar ones group"""
+    for pattern, replacement in NORMALIZERS:
+        statement = pattern.sub(replacement, statement)
+    return statement.strip()
+
+class SQLProfiler:
+    """records the SQL each sampled request runs through engine events
+
+    Per request it keeps the statement count, total database time & the slowest
+    statements, with an EXPLAIN of the slow SELECTs. Recent request profiles &
+    per statement totals are kept in memory for the debug endpoint.
+    """
+
+    def __init__(self, app=None):
+        self.lock = Lock()
+        self.recent = deque(maxlen=100)
+        self.statements = {}
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        """hooks the profiler into the app & every engine, configured from app.config
+
+        PROFILER_SAMPLE_RATE: share of requests profiled, 0 turns profiling off
+        PROFILER_SLOWEST: slow statements kept per request
+        PROFILER_EXPLAIN_MS: SELECTs slower than this get an EXPLAIN, None to never explain
+        PROFILER_HEADER: add an X-SQL-Profile header to responses, by default only when debugging or testing
+        PROFILER_TOKEN: token the debug endpoint asks for, the endpoint 404s without one
+        """
+        app.config.setdefault("PROFILER_SAMPLE_RATE", 0.0)
+        app.config.setdefault("PROFILER_SLOWEST", 5)
+        app.config.setdefault("PROFILER_EXPLAIN_MS", None)
+        app.config.setdefault("PROFILER_HEADER", None)
+        app.config.setdefault("PROFILER_TOKEN", None)
+        self.app = app
+
+        event.listen(Engine, "before_cursor_execute", self.before_cursor_execute)
+        event.listen(Engine, "after_cursor_execute", self.after_cursor_execute)
+        app.before_request(self.start_request)
+        app.after_request(self.finish_request)
+        app.add_url_rule("/debug/sql", "debug_sql", self.debug_view)
+
+    def start_request(self):
+        """decides whether this request is sampled & sets up its profile"""
+        rate = self.app.config["PROFILER_SAMPLE_RATE"]
+        if rate and random.random() < rate:
+            g.sql_profile = dict(count=0, time=0.0, slowest=[])
+
+    def before_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        if has_request_context() and "sql_profile" in g:
+            conn.info.setdefault("profiler_started", []).append(perf_counter())
+
+    def after_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        if not (has_request_context() and "sql_profile" in g):
+            return
+        started = conn.info.get("profiler_started")
+        if not started:
+            return
+        elapsed = (perf_counter() - started.pop()) * 1000
+        profile = g.sql_profile
+        profile["count"] += 1
+        profile["time"] += elapsed
+        shape = normalize_sql(statement)
+        entry = (elapsed, profile["count"], shape, self.explain(cursor, statement, parameters, elapsed))
+        slowest = profile["slowest"]
+        if len(slowest) < self.app.config["PROFILER_SLOWEST"]:
+            heapq.heappush(slowest, entry)
+        elif elapsed > slowest[0][0]:
+            heapq.heapreplace(slowest, entry)
+        with self.lock:
+            if shape not in self.statements and len(self.statements) >= MAX_STATEMENTS:
+                return
+            totals = self.statements.setdefault(shape, dict(count=0, time=0.0, max=0.0))
+            totals["count"] += 1
+            totals["time"] += elapsed
+            totals["max"] = max(totals["max"], elapsed)
+
+    def explain(self, cursor, statement, parameters, elapsed):
+        """runs EXPLAIN for slow SELECTs on a fresh cursor of the same connection
+
+        Returns:
+            string | None: the query plan, or None when not slow enough or not a SELECT
+        """
+        threshold = self.app.config["PROFILER_EXPLAIN_MS"]
+        if threshold is None or elapsed < threshold or not statement.lstrip().upper().startswith("SELECT"):
+            return None
+        explain_cursor = cursor.connection.cursor()
+        # a savepoint keeps a failed EXPLAIN from aborting the request's transaction
+        explain_cursor.execute("SAVEPOINT profiler_explain")
+        try:
+            explain_cursor.execute(f"EXPLAIN {statement}", parameters)
+            plan = "\n".join(row[0] for row in explain_cursor.fetchall())
+            explain_cursor.execute("RELEASE SAVEPOINT profiler_explain")
+            return plan
+        except Exception:
+            explain_cursor.execute("ROLLBACK TO SAVEPOINT profiler_explain")
+            return None
+        finally:
+            explain_cursor.close()
+
+    def finish_request(self, response):
+        """stores the request's profile & adds the summary header"""
+        profile = g.pop("sql_profile", None)
+        if profile is None:
+            return response
+        summary = dict(
+            method=request.method, path=request.path, status=response.status_code,
+            count=profile["count"], time=round(profile["time"], 3),
+            slowest=[dict(time=round(t, 3), sql=sql, plan=plan) for t, _, sql, plan in sorted(profile["slowest"], reverse=True)],
+        )
+        self.recent.append(summary)
+        header = self.app.config["PROFILER_HEADER"]
+        if header or (header is None and (self.app.debug or self.app.testing)):
+            response.headers["X-SQL-Profile"] = f"count={summary['count']}; time={summary['time']}ms"
+        return response
+
+    def report(self, limit=20):
+        """gives the recent request profiles & the statements that took the most time overall"""
+        with self.lock:
+            totals = sorted(self.statements.items(), key=lambda item: item[1]["time"], reverse=True)[:limit]
+        return dict(
+            requests=list(self.recent),
+            statements=[dict(sql=sql, count=t["count"], time=round(t["time"], 3), max=round(t["max"], 3)) for sql, t in totals],
+        )
+
+    def debug_view(self):
+        """shows the profiler report to whoever has the PROFILER_TOKEN"""
+        token = self.app.config["PROFILER_TOKEN"]
+        if not token or not hmac.compare_digest(request.headers.get("X-Debug-Token", ""), token):
+            return abort(404)
+        return jsonify(self.report(request.args.get("limit", 20, type=int)))
@@ -0,0 +1,168 @@
+import json
+import os
+from random import choice
+from threading import Lock, Thread
+from time import time
+
+from requests import get
+
+# the public Go Quotes API the corpus comes from
+QUOTES_URL = "https://goquotes-api.herokuapp.com/api/v1/all/quotes"
+
+class QuotesUnavailable(Exception):
+    """raised when there are no quotes in memory and the source can't be reached"""
+
+def remote_source(url=QUOTES_URL, timeout=5):
+    """makes a source that downloads the corpus from the quotes API
+
+    Args:
+        url (string): the API endpoint listing all quotes
+        timeout (float): seconds to wait on the API before giving up
+
+    Returns:
+        function: gives back the list of quotes when called
+    """
+    def fetch():
+        resp = get(url, timeout=timeout)
+        resp.raise_for_status()
+        return resp.json()["quotes"]
+    return fetch
+
+def file_source(path):
+    """makes a source that reads quotes from a local json file, handy offline & in tests
+
+    Args:
+        path (string): file holding a list of quotes or an object with a (quotes) list
+
+    Returns:
+        function: gives back the list of quotes when called
+    """
+    def fetch():
+        with open(path) as file:
+            data = json.load(file)
+        return data["quotes"] if isinstance(data, dict) else data
+    return fetch
+
+class QuoteStore:
+    """keeps the quote corpus in memory, refreshing it in the background once it goes stale
+
+    A local json file backs the memory copy so a restarted worker can serve quotes
+    right away. When the source fails max_failures times in a row the circuit opens
+    and no more calls are made to it until cooldown seconds have passed.
+    """
+
+    def __init__(self, source, path=None, ttl=24 * 60 * 60, max_failures=3, cooldown=5 * 60):
+        self.source = source
+        self.path = path
+        self.ttl = ttl
+        self.max_failures = max_failures
+        self.cooldown = cooldown
+        self.quotes = []
+        self.fetched_at = 0
+        self.failures = 0
+        self.opened_at = None
+        self.lock = Lock()
+        self.refreshing = False
+        self.load()
+
+    def __repr__(self):
+        return f"<QuoteStore quotes={len(self.quotes)} failures={self.failures} open={self.is_open}>"
+
+    @property
+    def is_open(self):
+        """whether the circuit is open & the source should be left alone"""
+        return self.opened_at is not None and time() - self.opened_at < self.cooldown
+
+    @property
+    def is_stale(self):
+        """whether the corpus is older than the ttl"""
+        return time() - self.fetched_at > self.ttl
+
+    def load(self):
+        """reads the corpus from the local file if there is one"""
+        if not (self.path and os.path.exists(self.path)):
+            return
+        try:
+            with open(self.path) as file:
+                data = json.load(file)
+            self.quotes = data["quotes"]
+            self.fetched_at = data["fetched_at"]
+        except (OSError, ValueError, KeyError):
+            pass
+
+    def dump(self):
+        """writes the corpus to the local file so other workers & restarts can use it"""
+        if not self.path:
+            return
+        temp_path = f"{self.path}.{os.getpid()}.tmp"
+        with open(temp_path, "w") as file:
+            json.dump(dict(quotes=self.quotes, fetched_at=self.fetched_at), file)
+        os.replace(temp_path, self.path)
+
+    def refresh(self):
+        """fetches the corpus from the source unless the circuit is open
+
+        Returns:
+            bool: whether new quotes were stored
+        """
+        if self.is_open:
+            return False
+        try:
+            quotes = self.source()
+        except Exception:
+            self.failures += 1
+            if self.failures >= self.max_failures:
+                self.opened_at = time()
+            return False
+        if not quotes:
+            return False
+        self.quotes = quotes
+        self.fetched_at = time()
+        self.failures = 0
+        self.opened_at = None
+        try:
+            self.dump()
+        except OSError:
+            pass
+        return True
+
+    def refresh_in_background(self):
+        """starts a refresh thread unless one is already running"""
+        with self.lock:
+            if self.refreshing or self.is_open:
+                return
+            self.refreshing = True
+
+        def run():
+            try:
+                self.refresh()
+            finally:
+                self.refreshing = False
+
+        Thread(target=run, daemon=True).start()
+
+    def all(self):
+        """gives every quote, serving stale ones while a refresh runs in the background
+
+        Raises:
+            QuotesUnavailable: when nothing is stored and the source can't be reached
+        """
+        quotes = self.quotes
+        if not quotes:
+            with self.lock:
+                if not self.quotes:
+                    self.refresh()
+            quotes = self.quotes
+            if not quotes:
+                raise QuotesUnavailable("quotes are unavailable right now")
+        elif self.is_stale:
+            self.refresh_in_background()
+        return quotes
+
+    def random(self):
+        """gives a single random quote
+
+        Raises:
+            QuotesUnavailable: when nothing is stored and the source can't be reached
+        """
+        return choice(self.all())
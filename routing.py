@@ -0,0 +1,135 @@
+import os
+import random
+from time import time
+
+from flask import g, has_request_context, request, session
+from flask_sqlalchemy import SQLAlchemy, SignallingSession, _EngineConnector
+from sqlalchemy import orm
+from sqlalchemy.sql.elements import TextClause
+
+# methods of requests that only read, their queries can go to a replica
+READ_METHODS = ("GET", "HEAD", "OPTIONS")
+# session key holding the time until which a user who just wrote reads from the primary
+STICKY_KEY = "_primary_until"
+
+def pool_options(prefix, workers=None, environ=os.environ):
+    """reads the pool settings of one engine from the environment
+
+    {prefix}_POOL_SIZE, {prefix}_MAX_OVERFLOW & {prefix}_POOL_TIMEOUT size each worker's pool.
+    {prefix}_MAX_CONNECTIONS instead caps the connections all gunicorn workers (WEB_CONCURRENCY)
+    open together, split evenly between them.
+
+    Returns:
+        dict: engine options
+    """
+    options = {
+        "pool_size": int(environ.get(f"{prefix}_POOL_SIZE", 5)),
+        "max_overflow": int(environ.get(f"{prefix}_MAX_OVERFLOW", 10)),
+        "pool_timeout": float(environ.get(f"{prefix}_POOL_TIMEOUT", 30)),
+    }
+    budget = environ.get(f"{prefix}_MAX_CONNECTIONS")
+    if budget:
+        per_worker = max(1, int(budget) // (workers or int(environ.get("WEB_CONCURRENCY", 1))))
+        options["pool_size"] = min(options["pool_size"], per_worker)
+        options["max_overflow"] = per_worker - options["pool_size"]
+    return options
+
+def is_read(clause):
+    """whether a statement only reads, so a replica can answer it
+
+    Raw SQL counts as a read only when it starts with SELECT, a WITH query may hold a
+    data modifying CTE so it goes to the primary.
+    """
+    if clause is None:
+        return False
+    if isinstance(clause, TextClause):
+        return clause.text.lstrip()[:6].upper() == "SELECT"
+    # rows locked with FOR UPDATE are about to be written
+    return not getattr(clause, "is_dml", False) and getattr(clause, "_for_update_arg", None) is None
+
+class RoutingSession(SignallingSession):
+    """a session sending the reads of read only requests to the request's replica
+
+    Flushes, DML, locking reads & bare connections go to the primary. Once a request
+    writes, the rest of it reads from the primary too so it sees its own writes.
+    """
+
+    def __init__(self, db, **options):
+        self.db = db
+        super().__init__(db, **options)
+
+    def get_bind(self, mapper=None, clause=None):
+        if not has_request_context():
+            return super().get_bind(mapper, clause)
+        replica = g.get("db_replica")
+        if replica is not None and not self._flushing and is_read(clause):
+            return self.db.get_engine(self.app, bind=replica)
+        if self._flushing or not is_read(clause):
+            g.db_replica = None
+            g.db_wrote = True
+        return super().get_bind(mapper, clause)
+
+class BindConnector(_EngineConnector):
+    """makes the engine of a bind with its own options from SQLALCHEMY_BIND_ENGINE_OPTIONS"""
+
+    def get_options(self, sa_url, echo):
+        sa_url, options = super().get_options(sa_url, echo)
+        options.update(self._app.config.get("SQLALCHEMY_BIND_ENGINE_OPTIONS", {}).get(self._bind, {}))
+        return sa_url, options
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    """SQLAlchemy with a RoutingSession & engine options per bind"""
+
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+    def make_connector(self, app=None, bind=None):
+        return BindConnector(self, self.get_app(app), bind)
+
+def use_primary(view):
+    """marks a view to always read from the primary, for read only routes that can't lag
+
+    GET views that read & then write need it too: until their first write they read from
+    the replica, so they could act on rows the replica hasn't caught up on yet.
+    """
+    view.use_primary = True
+    return view
+
+class ReplicaRouter:
+    """picks a replica for each read only request & keeps users who just wrote on the primary
+
+    Replicas are SQLALCHEMY_BINDS named in REPLICA_BINDS. After a request writes, the
+    user's requests read from the primary for REPLICA_STICKY_SECONDS, which should cover
+    the replicas' lag, so they always see their own changes. A read only request's reads
+    before its first write still come from the replica, so views that write on GET must be
+    marked use_primary.
+    """
+
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault("REPLICA_BINDS", [])
+        app.config.setdefault("REPLICA_STICKY_SECONDS", 5.0)
+        self.app = app
+        app.before_request(self.choose_replica)
+        app.after_request(self.remember_writes)
+
+    def choose_replica(self):
+        """routes the request's reads to a random replica when it's safe to"""
+        binds = self.app.config["REPLICA_BINDS"]
+        view = self.app.view_functions.get(request.endpoint)
+        if (binds and request.method in READ_METHODS and not getattr(view, "use_primary", False)
+                and session.get(STICKY_KEY, 0) < time()):
+            g.db_replica = random.choice(binds)
+
+    def remember_writes(self, response):
+        """keeps the user reading from the primary for a while after a write
+
+        Every request that isn't read only counts as a write, streamed responses write after
+        this runs & the session cookie went out.
+        """
+        if (g.get("db_wrote") or request.method not in READ_METHODS) and self.app.config["REPLICA_BINDS"]:
+            session[STICKY_KEY] = time() + self.app.config["REPLICA_STICKY_SECONDS"]
+        return response
@@ -1,47 +1,239 @@
-from random import randint, choice
-from datetime import datetime
+"""fills the database with a reproducible synthetic dataset for development & performance work
 
-from models import db, User, Freetime, Task
+    python seed.py                                      # a small dataset to click around in
+    python seed.py --users 100000 --tasks 20 --freetimes 30 --blocks 0.5 --skew 1.1 --seed 7
+    python seed.py --users 1000000 --out data/          # only write the COPY files
+    python seed.py --load data/                         # load files written before
+
+Every user's rows come from a random generator seeded with --seed & the user's number, so the
+same arguments always give the same rows. Rows are written as they're generated to one COPY
+file per table & the files are COPYed in afterwards, so memory use stays flat at any size.
+Every user gets the same password, hashed once.
+"""
+import os
+import sys
+import shutil
+import tempfile
+from argparse import ArgumentParser
+from datetime import datetime, timedelta
+from random import Random
+from time import perf_counter
+
+import bcrypt
+
+from models import db, hasher, STATUSES, User, Task, Freetime, UserCapacity
 from app import app
 
-db.drop_all()
-db.create_all()
-
-# users
-names = ("Bob", "Bill", "Sam", "Sally", "Tim", "Rob") #6
-users = [User.register(f"{n}@gmail.com", f"{randint(10, 99)}n{randint(10, 99)}", n) for n in names]
-db.session.add_all(users)
-db.session.commit()
-
-# freetimes
-def get_time():
-    """generates datetime objects of random times"""
-    year = randint(2020, 2030)
-    month = randint(1, 12)
-    day = randint(1, 28)
-    hour = randint(0, 23)
-    minute = randint(0, 59)
-    return datetime(year, month, day, hour, minute)
-
-freetimes = [Freetime(user_id=choice(users).id, start_time=get_time(), end_time=get_time()) for _ in range(24)]
-db.session.add_all(freetimes)
-
-# tasks
-tasks = []
-for _ in range(24):
-    user = choice(users)
-    titles = ["Dishes", "Laundry", "Vacuum Living Room", "Walk Dog", "Make Dinner", "Learn Boxing"]
-    title = choice(titles)
-    description = f"{title} description for {user.name}... more stuff & instructions"
-    tasks.append(Task(title=title, description=description, user_id=user.id))
-
-db.session.add_all(tasks)
-db.session.commit()
-
-# blocks
-block_values = []
-for _ in range(48):
-    task = choice(tasks)
-    task.freetimes.append(choice(freetimes))
-
-db.session.commit()
+# columns of each COPY file, loaded in this order so foreign keys line up
+COLUMNS = {
+    "users": ("id", "name", "email", "password", "timezone", "data_version", "data_changed_at"),
+    "freetimes": ("id", "start_time", "end_time", "user_id", "updated_at"),
+    "tasks": ("id", "title", "description", "status", "time_estimate", "priority", "user_id", "updated_at"),
+    "blocks": ("task_id", "freetime_id"),
+}
+
+# the text below has no tabs, newlines or backslashes, so rows are written without COPY escaping,
+# \N is how COPY writes NULL
+NAMES = ("Bob", "Bill", "Sam", "Sally", "Tim", "Rob", "Ana", "Priya", "Kenji", "Olu", "Marta", "Lee")
+TITLES = ("Dishes", "Laundry", "Vacuum Living Room", "Walk Dog", "Make Dinner", "Learn Boxing",
+    "Pay Bills", "Call Mom", "Water Plants", "Write Report", "Groceries", "Read Chapter")
+TIMEZONES = ("\\N", "UTC", "America/New_York", "America/Los_Angeles", "Europe/London", "Asia/Tokyo")
+# how often each status comes up, most tasks are still pending
+STATUS_WEIGHTS = (6, 2, 2)
+ESTIMATES = ("\\N", 15, 30, 45, 60, 90, 120, 180, 240)
+# memory the index builds after a load get
+MAINTENANCE_WORK_MEM = os.environ.get("SEED_MAINTENANCE_WORK_MEM", "256MB")
+# characters of bcrypt's base64, a salt's last one only carries 2 bits
+SALT_ALPHABET = "./ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789"
+
+def skew_weights(users, skew):
+    """gives a function of a user's number to how many times the average amount of rows they get
+
+    With skew 0 every user gets the average, higher skews follow Zipf's law so a few
+    users own most of the rows, like real usage.
+    """
+    if not skew:
+        return lambda number: 1.0
+    mean = sum(n ** -skew for n in range(1, users + 1)) / users
+    return lambda number: number ** -skew / mean
+
+def draw_count(rng, average):
+    """rounds an average amount of rows up or down at random so the totals stay near it"""
+    whole = int(average)
+    return whole + (rng.random() < average - whole)
+
+class Dataset:
+    """the parameters of a synthetic dataset, generating it row by row
+
+    Args:
+        users (int): how many users
+        tasks (float): average tasks per user
+        freetimes (float): average freetimes per user
+        blocks (float): share of tasks blocked into 1 to 3 of their user's freetimes
+        skew (float): how unevenly tasks & freetimes are spread over users, 0 for evenly
+        seed (int): seed every user's random generator starts from
+        start (datetime): when the first freetimes begin, naive UTC
+        days (int): days the freetimes of each user are spread over
+        password (string): the password every user logs in with
+    """
+
+    def __init__(self, users=6, tasks=4, freetimes=4, blocks=0.5, skew=0.0, seed=0,
+            start=datetime(2030, 1, 1), days=90, password="password123"):
+        self.users = users
+        self.tasks = tasks
+        self.freetimes = freetimes
+        self.blocks = blocks
+        self.skew = skew
+        self.seed = seed
+        self.start = start
+        self.days = days
+        self.password = password
+
+    def __repr__(self):
+        return f"<Dataset users={self.users} tasks={self.tasks} freetimes={self.freetimes} blocks={self.blocks} skew={self.skew} seed={self.seed}>"
+
+    def hash_password(self):
+        """hashes the shared password once, salted from the seed so the hash is reproducible too"""
+        rng = Random(f"{self.seed}:password")
+        salt = "".join(rng.choice(SALT_ALPHABET) for _ in range(21)) + rng.choice(".Oeu")
+        return bcrypt.hashpw(self.password.encode("utf-8"), f"$2b${hasher.rounds:02}${salt}".encode()).decode("utf-8")
+
+    def rows(self):
+        """generates every row in user order
+
+        Yields:
+            tuple(string, string): the table & its row in COPY text format
+        """
+        hashed_password = self.hash_password()
+        weight = skew_weights(self.users, self.skew)
+        span = timedelta(days=self.days)
+        stamp = str(self.start)
+        freetime_id = task_id = 0
+        for number in range(1, self.users + 1):
+            rng = Random(f"{self.seed}:{number}")
+            name = f"{rng.choice(NAMES)} {number}"[:20]
+            yield "users", f"{number}\t{name}\tuser{number}@example.com\t{hashed_password}\t{rng.choice(TIMEZONES)}\t0\t{stamp}\n"
+
+            # windows of the user's freetimes never overlap, each sits somewhere in its own slot
+            count = draw_count(rng, self.freetimes * weight(number))
+            first_freetime = freetime_id + 1
+            if count:
+                slot = span / count
+                for index in range(count):
+                    length = min(timedelta(minutes=rng.randrange(30, 241, 15)), slot * 0.8)
+                    start = self.start + slot * index + (slot - length) * rng.random()
+                    start = start.replace(second=0, microsecond=0)
+                    freetime_id += 1
+                    yield "freetimes", f"{freetime_id}\t{start}\t{start + length}\t{number}\t{stamp}\n"
+
+            for _ in range(draw_count(rng, self.tasks * weight(number))):
+                task_id += 1
+                title = rng.choice(TITLES)
+                status = rng.choices(STATUSES, STATUS_WEIGHTS)[0]
+                yield "tasks", (f"{task_id}\t{title}\t{title} for {name}... more stuff & instructions\t{status}\t"
+                    f"{rng.choice(ESTIMATES)}\t{rng.randrange(10)}\t{number}\t{stamp}\n")
+                if count and rng.random() < self.blocks:
+                    for index in sorted(rng.sample(range(count), min(count, rng.randint(1, 3)))):
+                        yield "blocks", f"{task_id}\t{first_freetime + index}\n"
+
+    def write(self, directory):
+        """streams the dataset to one COPY file per table in directory
+
+        Returns:
+            dict: table -> rows written
+        """
+        os.makedirs(directory, exist_ok=True)
+        files = {table: open(os.path.join(directory, f"{table}.tsv"), "w", encoding="utf-8", buffering=1 << 20) for table in COLUMNS}
+        counts = dict.fromkeys(COLUMNS, 0)
+        try:
+            for table, row in self.rows():
+                files[table].write(row)
+                counts[table] += 1
+        finally:
+            for file in files.values():
+                file.close()
+        return counts
+
+def load(directory, reset=True):
+    """COPYs the files written by Dataset.write into the database
+
+    Args:
+        directory (string): where the files are
+        reset (bool): drop & recreate the schema first, otherwise the tables must be empty
+    """
+    if reset:
+        db.drop_all()
+        db.create_all()
+    connection = db.session.connection()
+    connection.execute(db.text(f"SET LOCAL maintenance_work_mem = '{MAINTENANCE_WORK_MEM}'"))
+    # checking foreign keys & building indexes once after the COPY is much faster than
+    # doing it row by row
+    foreign_keys = connection.execute(db.text("""
+        SELECT conrelid::regclass::text, conname, pg_get_constraintdef(oid) FROM pg_constraint
+        WHERE contype = 'f' AND conrelid::regclass::text = ANY(:tables)
+    """), dict(tables=list(COLUMNS))).all()
+    for table, name, _ in foreign_keys:
+        connection.execute(db.text(f'ALTER TABLE {table} DROP CONSTRAINT "{name}"'))
+    indexes = [index for table in COLUMNS for index in db.metadata.tables[table].indexes]
+    for index in indexes:
+        index.drop(connection)
+    # the capacity counters are counted once at the end instead of by the triggers on every COPY
+    for table in COLUMNS:
+        connection.execute(db.text(f"ALTER TABLE {table} DISABLE TRIGGER USER"))
+    cursor = connection.connection.cursor()
+    for table, columns in COLUMNS.items():
+        with open(os.path.join(directory, f"{table}.tsv"), encoding="utf-8") as file:
+            cursor.copy_expert(f"COPY {table} ({', '.join(columns)}) FROM STDIN", file)
+    for index in indexes:
+        index.create(connection)
+    for table, name, definition in foreign_keys:
+        connection.execute(db.text(f'ALTER TABLE {table} ADD CONSTRAINT "{name}" {definition}'))
+    for table in COLUMNS:
+        connection.execute(db.text(f"ALTER TABLE {table} ENABLE TRIGGER USER"))
+    # ids were given by the files, move the sequences past them
+    for model in (User, Freetime, Task):
+        table = model.__tablename__
+        db.session.execute(db.text(
+            f"SELECT setval(pg_get_serial_sequence('{table}', 'id'), COALESCE((SELECT MAX(id) FROM {table}), 0) + 1, false)"
+        ))
+    # fresh statistics so the first queries get good plans
+    db.session.execute(db.text(f"ANALYZE {', '.join(COLUMNS)}"))
+    db.session.commit()
+    UserCapacity.reconcile(fix=True)
+
+def main():
+    parser = ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--users", type=int, default=6)
+    parser.add_argument("--tasks", type=float, default=4, help="average tasks per user")
+    parser.add_argument("--freetimes", type=float, default=4, help="average freetimes per user")
+    parser.add_argument("--blocks", type=float, default=0.5, help="share of tasks blocked into freetimes")
+    parser.add_argument("--skew", type=float, default=0.0, help="0 spreads rows evenly, 1+ gives a few heavy users")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--start", type=datetime.fromisoformat, default=datetime(2030, 1, 1), help="first day of freetimes")
+    parser.add_argument("--days", type=int, default=90, help="days each user's freetimes are spread over")
+    parser.add_argument("--password", default="password123", help="every user's password")
+    parser.add_argument("--out", help="write the COPY files here instead of loading them")
+    parser.add_argument("--load", help="load COPY files written before with --out")
+    parser.add_argument("--keep", action="store_true", help="load into the existing (empty) tables instead of recreating the schema")
+    args = parser.parse_args()
+
+    started = perf_counter()
+    if args.load:
+        directory = args.load
+    else:
+        dataset = Dataset(args.users, args.tasks, args.freetimes, args.blocks, args.skew, args.seed,
+            args.start, args.days, args.password)
+        directory = args.out or tempfile.mkdtemp(prefix="instime-seed-")
+        counts = dataset.write(directory)
+        print(", ".join(f"{count} {table}" for table, count in counts.items()), f"written in {perf_counter() - started:.1f}s", file=sys.stderr)
+    if args.out:
+        return
+    try:
+        load(directory, reset=not args.keep)
+    finally:
+        if not args.load:
+            shutil.rmtree(directory)
+    print(f"loaded in {perf_counter() - started:.1f}s", file=sys.stderr)
+
+if __name__ == "__main__":
+    main()
@@ -10,6 +10,19 @@ navBurger.addEventListener("click", () => {
     navButtons.forEach(btn => btn.classList.toggle("is-inverted"));
 });
 
+// saves the browser's timezone for users who haven't got one so times show in their zone,
+// a zone the server turned down is remembered so it isn't sent again on every page
+if (document.body.dataset.timezone === "") {
+    const timezone = Intl.DateTimeFormat().resolvedOptions().timeZone;
+    if (timezone && localStorage.getItem("rejectedTimezone") !== timezone) {
+        axios.post("/timezone", {timezone}).then(resp => {
+            if (resp.data.error) localStorage.setItem("rejectedTimezone", timezone);
+        }).catch(err => {
+            console.error(err);
+        });
+    }
+}
+
 // date used to restrict setting available time periods in the past
 const yesterday = new Date();
 yesterday.setDate(yesterday.getDate() - 1);
@@ -59,6 +72,7 @@ if (calendars && freetimesSection) {
     const createStartTimeSpan = document.querySelector("#create-start-time");
     const createEndTimeSpan = document.querySelector("#create-end-time");
     const createFreetimeButton = document.querySelector("#create-freetime");
+    const createRepeatSelect = document.querySelector("#create-repeat");
 
     const editFreetimeSection = document.querySelector("section.edit-freetime");
     const editCalendar = document.querySelector("#edit-times").bulmaCalendar;
@@ -67,6 +81,43 @@ if (calendars && freetimesSection) {
     const editEndTimeSpan = document.querySelector("#edit-end-time");
     const editFreetimeButton = document.querySelector("#edit-freetime");
 
+    // uploads a calendar file to import its events as freetimes
+    const importFreetimesInput = document.querySelector("#import-freetimes");
+    importFreetimesInput.addEventListener("change", () => {
+        const data = new FormData();
+        data.append("calendar", importFreetimesInput.files[0]);
+        axios.post("/times/import", data).then(resp => {
+            window.location.href = resp.data.url;
+        }).catch(err => {
+            console.error(err);
+        });
+    });
+
+    // merges the user's overlapping & touching freetimes
+    const normalizeFreetimesButton = document.querySelector("#normalize-freetimes");
+    normalizeFreetimesButton.addEventListener("click", () => {
+        axios.post("/times/normalize").then(resp => {
+            window.location.href = resp.data.url;
+        }).catch(err => {
+            console.error(err);
+        });
+    });
+
+    // deletes a repeating freetime or skips one of its upcoming occurrences
+    const repeatingSection = document.querySelector("section.repeating");
+    repeatingSection.addEventListener("click", e => {
+        if (e.target.tagName !== "BUTTON") return;
+        const {series, occurrence} = e.target.parentElement.dataset;
+        const request = series
+            ? axios.delete(`/times/series/${series}`)
+            : axios.delete("/times/occurrences", {data: {id: occurrence}});
+        request.then(resp => {
+            window.location.href = resp.data.url;
+        }).catch(err => {
+            console.error(err);
+        });
+    });
+
     // manipulates DOM to toggle view to show the freetime form & hide the list of freetimes
     addFreetimeButton.addEventListener("click", () => {
         createFreetimeSection.classList.toggle("is-hidden");
@@ -109,7 +160,8 @@ if (calendars && freetimesSection) {
         if (typeof resultsValid === "boolean") {
             start = start.toISOString();
             end = end.toISOString();
-            axios.post("/times", {start, end}).then(resp => {
+            const repeat = createRepeatSelect.value;
+            axios.post("/times", {start, end, repeat}).then(resp => {
                 window.location.href = resp.config.url;
             }).catch(err => {
                 console.error(err);
@@ -235,6 +287,24 @@ if (tasksSection) {
         addTaskButton.classList.add("is-hidden");
     });
 
+    const searchInput = tasksSection.querySelector(".task-search input[name=q]");
+    const suggestions = tasksSection.querySelector("#task-suggestions");
+    let searchTimer;
+
+    // suggests the titles of matching tasks while the user types a search
+    searchInput.addEventListener("input", () => {
+        clearTimeout(searchTimer);
+        const q = searchInput.value.trim();
+        if (!q) return suggestions.replaceChildren();
+        searchTimer = setTimeout(() => {
+            axios.get("/tasks/search", {params: {q, limit: 8}}).then(resp => {
+                suggestions.replaceChildren(...(resp.data.tasks || []).map(task => new Option(task.title)));
+            }).catch(err => {
+                console.error(err);
+            });
+        }, 150);
+    });
+
     if (tasksList) {
         // sends a delete request to remove a task
         tasksList.addEventListener("click", e => {
@@ -249,6 +319,22 @@ if (tasksSection) {
     }
 }
 
+// Plans page
+const autoPlanButton = document.querySelector("#auto-plan");
+
+if (autoPlanButton) {
+    // asks the server to pack open tasks into open freetimes & reloads to show the result
+    autoPlanButton.addEventListener("click", () => {
+        autoPlanButton.classList.add("is-loading");
+        axios.post("/plans/auto", {mode: "optimize"}).then(resp => {
+            window.location.href = resp.data.url;
+        }).catch(err => {
+            console.error(err);
+            autoPlanButton.classList.remove("is-loading");
+        });
+    });
+}
+
 // button to generate some quotes
 const quotesButton = document.querySelector("#quotes-button");
 
@@ -268,29 +354,22 @@ if (quotesButton) {
         `;
     }
 
-    // list of quotes & the display box for them
-    let quotes = JSON.parse(localStorage.getItem("quotes"));
+    // the display box for quotes
     const quotesDiv = document.querySelector("#quotes");
 
-    // if quotes already exist in localstorage, use them, else fetch quotes from the server
+    // asks the server for a random quote to display
     quotesButton.addEventListener("click", async () => {
-        if (quotes === null) {
-            // disable button & show loading while it fetches data
-            quotesButton.classList.add("is-loading");
-            quotesButton.disabled = true;
-            try {
-                const res = await axios.get("/quotes")
-                quotes = res.data.quotes;
-                localStorage.setItem("quotes", JSON.stringify(quotes));
-            } catch(err) {
-                console.error(err);
-            }
-            // allow button to be clicked again & stops loading animation
-            quotesButton.classList.remove("is-loading");
-            quotesButton.disabled = false;
+        // disable button & show loading while it fetches data
+        quotesButton.classList.add("is-loading");
+        quotesButton.disabled = true;
+        try {
+            const res = await axios.get("/quotes/random");
+            quotesDiv.innerHTML = createQuote(res.data.quote);
+        } catch(err) {
+            console.error(err);
         }
-        // pick a random quote from the list of quotes to display
-        const ranNum = Math.floor(Math.random() * quotes.length);
-        quotesDiv.innerHTML = createQuote(quotes[ranNum]);
+        // allow button to be clicked again & stops loading animation
+        quotesButton.classList.remove("is-loading");
+        quotesButton.disabled = false;
     });
 }
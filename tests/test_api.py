@@ -0,0 +1,143 @@
+import os
+from datetime import datetime
+from unittest import TestCase
+
+from models import db, User, Freetime, Task
+
+os.environ["DATABASE_URL"] = "postgresql:///instime_test"
+
+from app import app
+
+app.config["WTF_CSRF_ENABLED"] = False
+app.config["TESTING"] = True
+
+db.drop_all()
+db.create_all()
+
+class TasksApiTestCase(TestCase):
+    """does the json tasks api list, change & batch a user's tasks"""
+
+    def setUp(self):
+        """empty out old data, log in a user & give them a freetime"""
+
+        Freetime.query.delete()
+        Task.query.delete()
+        User.query.delete()
+
+        with app.test_request_context():
+            user = User.register("user@email.com", "strongpassword123", "Martin Brown")
+            other = User.register("other@email.com", "strongpassword123", "Sam Smith")
+            db.session.flush()
+            freetime = Freetime(start_time=datetime(2030, 1, 1, 10), end_time=datetime(2030, 1, 1, 11), user_id=user.id)
+            foreign = Freetime(start_time=datetime(2030, 1, 1, 10), end_time=datetime(2030, 1, 1, 11), user_id=other.id)
+            db.session.add_all([freetime, foreign])
+            db.session.flush()
+            self.user_id = user.id
+            self.other_id = other.id
+            self.freetime_id = freetime.id
+            self.foreign_id = foreign.id
+            db.session.commit()
+
+        self.client = app.test_client()
+        self.client.post("/login", data={"email": "user@email.com", "password": "strongpassword123"})
+
+    def tearDown(self):
+        """clean up the session"""
+
+        db.session.rollback()
+
+    def test_login_required(self):
+        """does the api answer 401 rather than redirect"""
+
+        resp = app.test_client().get("/api/tasks")
+
+        self.assertEqual(resp.status_code, 401)
+        self.assertIn("error", resp.json)
+
+    def test_create_get_patch_delete(self):
+        """does a task go through its whole life over the api"""
+
+        resp = self.client.post("/api/tasks", json=dict(title="run", description="5k", time_estimate=30, freetimes=[self.freetime_id]))
+
+        self.assertEqual(resp.status_code, 201)
+        task_id = resp.json["id"]
+        self.assertTrue(resp.headers["Location"].endswith(f"/api/tasks/{task_id}"))
+        self.assertEqual(resp.json["freetimes"], [self.freetime_id])
+        self.assertEqual(resp.json["status"], "pending")
+
+        resp = self.client.patch(f"/api/tasks/{task_id}", json=dict(status="done", freetimes=[]))
+
+        self.assertEqual((resp.json["status"], resp.json["freetimes"], resp.json["title"]), ("done", [], "run"))
+        self.assertEqual(self.client.get(f"/api/tasks/{task_id}?fields=title").json, dict(title="run"))
+        self.assertEqual(self.client.delete(f"/api/tasks/{task_id}").status_code, 204)
+        self.assertEqual(self.client.get(f"/api/tasks/{task_id}").status_code, 404)
+
+    def test_invalid_writes(self):
+        """are invalid fields, foreign freetimes & other users' tasks refused"""
+
+        other_task = Task(title="theirs", description="sakjhga", user_id=self.other_id)
+        db.session.add(other_task)
+        db.session.commit()
+        other_id = other_task.id
+
+        self.assertEqual(self.client.post("/api/tasks", json=dict(title="", description="x")).status_code, 400)
+        self.assertEqual(self.client.post("/api/tasks", json=dict(title="x", description="x", priority=10)).status_code, 400)
+        resp = self.client.post("/api/tasks", json=dict(title="x", description="x", freetimes=[self.foreign_id]))
+        self.assertEqual(resp.status_code, 400)
+        self.assertIn("(freetimes)", resp.json["error"])
+        self.assertEqual(self.client.post("/api/tasks", json=dict(title="x", description="x", freetimes=[[self.freetime_id]])).status_code, 400)
+        resp = self.client.post("/api/tasks/batch", json=[dict(op="update", id=[other_id]), dict(op="delete", id={})])
+        self.assertEqual([result["ok"] for result in resp.json["results"]], [False, False])
+        self.assertEqual(self.client.patch(f"/api/tasks/{other_id}", json=dict(title="mine")).status_code, 404)
+        self.assertEqual(self.client.delete(f"/api/tasks/{other_id}").status_code, 404)
+        self.assertEqual(Task.query.filter_by(user_id=self.user_id).count(), 0)
+
+    def test_list_fields_and_cursor(self):
+        """do sparse fields, embedded freetimes & cursors page through the tasks"""
+
+        self.client.post("/api/tasks/batch", json=[
+            dict(op="create", title=f"task {i}", description="sakjhga", priority=i, freetimes=[self.freetime_id] if i == 0 else [])
+            for i in range(5)
+        ])
+
+        resp = self.client.get("/api/tasks?fields=title,freetimes&freetimes=embed&limit=2")
+
+        first = resp.json["tasks"][0]
+        self.assertEqual(set(first), {"title", "freetimes"})
+        self.assertEqual(first["freetimes"], [dict(id=self.freetime_id, start="2030-01-01T10:00:00", end="2030-01-01T11:00:00")])
+        titles = [t["title"] for t in resp.json["tasks"]]
+        cursor = resp.json["next_cursor"]
+        while cursor:
+            resp = self.client.get(f"/api/tasks?fields=title&limit=2&cursor={cursor}")
+            titles.extend(t["title"] for t in resp.json["tasks"])
+            cursor = resp.json["next_cursor"]
+        self.assertEqual(titles, [f"task {i}" for i in range(5)])
+
+        self.assertEqual(self.client.get("/api/tasks?fields=secret").status_code, 400)
+        self.assertEqual(self.client.get("/api/tasks?freetimes=all").status_code, 400)
+        self.assertEqual(self.client.get("/api/tasks?cursor=bad").status_code, 400)
+
+    def test_batch(self):
+        """does a batch apply the valid operations & report the rest"""
+
+        resp = self.client.post("/api/tasks/batch", json=dict(operations=[
+            dict(op="create", title="a", description="x", time_estimate=15),
+            dict(op="create", title="b", description="x"),
+            dict(op="create", title="c"),
+            dict(op="move"),
+        ]))
+        ids = [result.get("id") for result in resp.json["results"]]
+
+        self.assertEqual([result["ok"] for result in resp.json["results"]], [True, True, False, False])
+
+        resp = self.client.post("/api/tasks/batch", json=[
+            dict(op="update", id=ids[0], title="a2", freetimes=[self.freetime_id]),
+            dict(op="delete", id=ids[1]),
+            dict(op="update", id=ids[1], title="gone"),
+        ])
+
+        self.assertEqual([result["ok"] for result in resp.json["results"]], [True, True, False])
+        tasks = Task.query.filter_by(user_id=self.user_id).all()
+        self.assertEqual([(t.title, t.time_estimate) for t in tasks], [("a2", 15)])
+        self.assertEqual(tasks[0].get_freetime_ids(), [self.freetime_id])
+        self.assertIn("error", self.client.post("/api/tasks/batch", json=dict(ops=[])).json)
@@ -1,7 +1,12 @@
 import os
+import json
+from datetime import datetime, timedelta
+from contextlib import contextmanager
+from io import BytesIO
 from unittest import TestCase
+from sqlalchemy import event
 
-from models import db, User, Freetime, Task
+from models import db, User, Freetime, FreetimeSeries, Task
 from forms import CreateUserForm, LoginUserForm
 
 os.environ["DATABASE_URL"] = "postgresql:///instime_test"
@@ -15,6 +20,22 @@ app.config["TESTING"] = True
 db.drop_all()
 db.create_all()
 
+# most SQL statements a task create / edit request may run, however many freetimes are picked,
+# one of them looks up the repeating freetimes whose occurrences are offered as choices
+TASK_QUERY_BUDGET = 9
+
+@contextmanager
+def count_queries():
+    """collects every SQL statement run inside the block"""
+    statements = []
+    def record(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+    event.listen(db.engine, "before_cursor_execute", record)
+    try:
+        yield statements
+    finally:
+        event.remove(db.engine, "before_cursor_execute", record)
+
 class RoutesTestCase(TestCase):
     """do get & post request work along with authorized views"""
 
@@ -99,6 +120,154 @@ class RoutesTestCase(TestCase):
         self.assertEqual(resp.status_code, 200)
         self.assertIn("Available times", str(resp.data))
     
+    def test_freetimes_view_overlap(self):
+        """does the freetimes_view route reject overlapping freetimes"""
+
+        data = {"start": "2030-01-01T08:00:00.000Z", "end": "2030-01-01T10:00:00.000Z"}
+        resp = self.client.post("/times", json=data)
+
+        self.assertNotIn("error", resp.json)
+        self.assertEqual(Freetime.query.count(), 1)
+
+        data = {"start": "2030-01-01T09:00:00.000Z", "end": "2030-01-01T11:00:00.000Z"}
+        resp = self.client.post("/times", json=data)
+
+        self.assertIn("error", resp.json)
+        self.assertEqual(len(resp.json["conflicts"]), 1)
+        self.assertEqual(Freetime.query.count(), 1)
+
+        data["overlap"] = "merge"
+        resp = self.client.post("/times", json=data)
+
+        self.assertNotIn("error", resp.json)
+        self.assertEqual(Freetime.query.count(), 1)
+        self.assertEqual(Freetime.query.one().end_time.hour, 11)
+
+    def test_batch_freetimes(self):
+        """does the batch route apply operations & report each one"""
+
+        mine = Freetime(start_time=datetime(2030, 1, 1, 8), end_time=datetime(2030, 1, 1, 9), user_id=self.user.id)
+        gone = Freetime(start_time=datetime(2030, 1, 2, 8), end_time=datetime(2030, 1, 2, 9), user_id=self.user.id)
+        db.session.add_all([mine, gone])
+        db.session.commit()
+        mine_id, gone_id = mine.id, gone.id
+
+        operations = [
+            {"op": "create", "start": "2030-01-03T08:00:00Z", "end": "2030-01-03T09:00:00Z"},
+            {"op": "update", "id": mine_id, "start": "2030-01-01T10:00:00Z", "end": "2030-01-01T11:00:00Z"},
+            {"op": "delete", "id": gone_id},
+            {"op": "delete", "id": gone_id + 100},
+            {"op": "create", "start": "2030-01-03T09:00:00Z"},
+        ]
+        resp = self.client.post("/times/batch", json=operations)
+        results = resp.json["results"]
+
+        self.assertEqual([r["ok"] for r in results], [True, True, True, False, False])
+        self.assertIsNotNone(Freetime.query.get(results[0]["id"]))
+        self.assertEqual(Freetime.query.get(mine_id).start_time.hour, 10)
+        self.assertIsNone(Freetime.query.get(gone_id))
+
+        resp = self.client.post("/times/batch", json=[{"op": "delete", "id": [mine_id]}, {"op": "update", "id": {}}, {"op": "delete", "id": True}])
+
+        self.assertEqual([r["ok"] for r in resp.json["results"]], [False, False, False])
+
+    def test_batch_freetimes_overlap(self):
+        """are batch writes overlapping other freetimes rejected unless allowed"""
+
+        mine = Freetime(start_time=datetime(2030, 1, 1, 8), end_time=datetime(2030, 1, 1, 9), user_id=self.user.id)
+        db.session.add(mine)
+        db.session.commit()
+        mine_id = mine.id
+
+        operations = [
+            {"op": "create", "start": "2030-01-01T08:30:00Z", "end": "2030-01-01T09:30:00Z"},
+            {"op": "update", "id": mine_id, "start": "2030-01-01T10:00:00Z", "end": "2030-01-01T11:00:00Z"},
+            {"op": "create", "start": "2030-01-01T08:30:00Z", "end": "2030-01-01T09:30:00Z"},
+            {"op": "create", "start": "2030-01-01T09:00:00Z", "end": "2030-01-01T10:30:00Z"},
+        ]
+        results = self.client.post("/times/batch", json=operations).json["results"]
+
+        self.assertEqual([r["ok"] for r in results], [False, True, True, False])
+        self.assertEqual(results[0]["conflicts"], [mine_id])
+        self.assertEqual(results[3]["conflicts"], [mine_id])
+        self.assertIn("error", self.client.post("/times/batch?overlap=merge", json=operations).json)
+
+        results = self.client.post("/times/batch?overlap=allow", json=operations[:1]).json["results"]
+
+        self.assertTrue(results[0]["ok"])
+        self.assertEqual(Freetime.query.filter_by(user_id=self.user.id).count(), 3)
+
+    def test_batch_freetimes_ndjson(self):
+        """does the batch route stream ndjson operations"""
+
+        lines = [json.dumps({"op": "create", "start": f"2030-02-{d:02}T08:00:00Z", "end": f"2030-02-{d:02}T09:00:00Z"}) for d in range(1, 11)]
+        resp = self.client.post("/times/batch", data="\n".join(lines), content_type="application/x-ndjson")
+        *results, last = [json.loads(line) for line in resp.data.decode().splitlines()]
+
+        self.assertEqual(last, dict(committed=True, ok=10, failed=0))
+        self.assertEqual(len(results), 10)
+        self.assertTrue(all(r["ok"] for r in results))
+        self.assertEqual(Freetime.query.filter_by(user_id=self.user.id).count(), 10)
+
+    def test_user_timezone(self):
+        """does the timezone route change how times are shown"""
+
+        freetime = Freetime(start_time=datetime(2030, 1, 1, 8), end_time=datetime(2030, 1, 1, 9), user_id=self.user.id)
+        db.session.add(freetime)
+        db.session.commit()
+
+        resp = self.client.post("/timezone", json={"timezone": "Nowhere/Land"})
+        self.assertIn("error", resp.json)
+
+        resp = self.client.post("/timezone", json={"timezone": "Asia/Tokyo"})
+        self.assertEqual(resp.json["timezone"], "Asia/Tokyo")
+        self.assertEqual(self.client.get("/timezone").json["timezone"], "Asia/Tokyo")
+        self.assertIn("Jan 01, 2030 @ 17:00 - Jan 01, 2030 @ 18:00", str(self.client.get("/times").data))
+
+    def test_fragment_cache(self):
+        """are page fragments served from the cache until the user's data changes"""
+
+        self.client.get("/times")
+        with count_queries() as cached:
+            resp = self.client.get("/times")
+
+        self.assertIn("You don't have any freetimes", resp.get_data(as_text=True))
+        self.assertFalse(any("FROM freetimes" in statement for statement in cached))
+
+        data = {"start": "2030-01-01T08:00:00.000Z", "end": "2030-01-01T10:00:00.000Z"}
+        self.client.post("/times", json=data)
+        resp = self.client.get("/times")
+
+        self.assertIn("Your freetimes", str(resp.data))
+
+    def test_not_modified(self):
+        """do pages answer 304 without loading data until the user's data changes"""
+
+        resp = self.client.get("/times")
+        etag = resp.headers["ETag"]
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertIsNone(resp.last_modified)
+
+        with count_queries() as statements:
+            resp = self.client.get("/times", headers={"If-None-Match": etag})
+
+        self.assertEqual(resp.status_code, 304)
+        self.assertFalse(any("FROM freetimes" in statement for statement in statements))
+        self.assertEqual(self.client.get("/tasks", headers={"If-None-Match": etag}).status_code, 200)
+
+        # a one second date can't tell two changes in the same second apart
+        resp = self.client.get("/plans", headers={"If-Modified-Since": "Fri, 01 Jan 2100 00:00:00 GMT"})
+        self.assertEqual(resp.status_code, 200)
+
+        data = {"start": "2030-01-01T08:00:00.000Z", "end": "2030-01-01T10:00:00.000Z"}
+        self.client.post("/times", json=data)
+        self.client.get("/times")
+        resp = self.client.get("/times", headers={"If-None-Match": etag})
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertNotEqual(resp.headers["ETag"], etag)
+
     def test_tasks_view(self):
         """does the tasks_view route work"""
 
@@ -107,6 +276,23 @@ class RoutesTestCase(TestCase):
         self.assertEqual(resp.status_code, 200)
         self.assertIn("Add new task", str(resp.data))
     
+    def test_search_tasks(self):
+        """does the search_tasks route & the tasks page search work"""
+
+        for title in ("walk dog", "dishes"):
+            self.client.post("/tasks", data=dict(title=title, description="sakjhga", status="pending", priority=1))
+
+        resp = self.client.get("/tasks/search?q=wal")
+
+        self.assertEqual([t["title"] for t in resp.json["tasks"]], ["walk dog"])
+        self.assertEqual(self.client.get("/tasks/search?q=wal&status=done").json["tasks"], [])
+        self.assertIn("error", self.client.get("/tasks/search?q=wal&priority=high").json)
+        page = self.client.get("/tasks?q=dish").get_data(as_text=True)
+        self.assertIn("dishes", page)
+        self.assertNotIn("walk dog", page)
+        self.assertIn("None of your tasks match", self.client.get("/tasks?q=zebra").get_data(as_text=True))
+        self.assertEqual(self.client.get("/tasks?status=later").status_code, 400)
+    
     def test_update_task(self):
         """does the update_task route work"""
 
@@ -120,6 +306,145 @@ class RoutesTestCase(TestCase):
         self.assertEqual(resp.status_code, 200)
         self.assertIn("Edit your task", str(resp.data))
     
+    def add_freetimes(self, count):
+        """adds count freetimes to the user and returns their ids"""
+
+        day = datetime(2030, 1, 1)
+        freetimes = [Freetime(start_time=day + timedelta(hours=i), end_time=day + timedelta(hours=i, minutes=30), user_id=self.user.id) for i in range(count)]
+        db.session.add_all(freetimes)
+        db.session.commit()
+
+        return [f.id for f in freetimes]
+
+    def test_task_query_budget(self):
+        """do task create & edit run the same few queries however many freetimes are picked"""
+
+        counts = []
+        for count in (2, 20):
+            ids = self.add_freetimes(count)
+            data = {"title": f"task {count}", "description": "sakjhga", "status": "pending", "priority": 1, "freetimes": ids}
+            with count_queries() as created:
+                self.client.post("/tasks", data=data)
+            task_id = Task.query.filter_by(title=f"task {count}").one().id
+            data["freetimes"] = ids[1:]
+            with count_queries() as edited:
+                self.client.post(f"/tasks/{task_id}/edit", data=data)
+            counts.append((len(created), len(edited)))
+
+            self.assertEqual(sorted(Task.query.get(task_id).get_freetime_ids()), sorted(ids[1:]))
+
+        self.assertEqual(counts[0], counts[1])
+        self.assertLessEqual(max(counts[0]), TASK_QUERY_BUDGET)
+
+    def test_calendar_feed(self):
+        """does the calendar feed list freetimes & blocks, and only changes after a sync"""
+
+        ids = self.add_freetimes(3)
+        task = Task(title="write, report", description="line one\nline two", user_id=self.user.id)
+        db.session.add(task)
+        task.freetimes = [Freetime.query.get(ids[0])]
+        db.session.commit()
+        task_id = task.id
+
+        url = self.client.get("/calendar").json["url"]
+        resp = self.client.get(url)
+        feed = resp.get_data(as_text=True)
+
+        self.assertEqual(resp.mimetype, "text/calendar")
+        self.assertEqual(feed.count("BEGIN:VEVENT"), 4)
+        self.assertIn(f"UID:freetime-{ids[0]}@instime", feed)
+        self.assertIn("SUMMARY:write\\, report", feed)
+        self.assertIn("DTSTART:20300101T000000Z", feed)
+        self.assertEqual(self.client.get(url.replace("/calendar/", "/calendar/x")).status_code, 404)
+
+        hour_ago = datetime.utcnow() - timedelta(hours=1)
+        db.session.execute("UPDATE freetimes SET updated_at = :t", {"t": hour_ago})
+        db.session.execute("UPDATE tasks SET updated_at = :t", {"t": hour_ago})
+        db.session.execute("UPDATE blocks SET created_at = :t", {"t": hour_ago})
+        db.session.commit()
+        sync = self.client.get(url).headers["X-Sync-Token"]
+
+        self.assertNotIn("BEGIN:VEVENT", self.client.get(url, query_string={"sync": sync}).get_data(as_text=True))
+
+        Freetime.query.get(ids[0]).end_time = datetime(2030, 1, 1, 0, 45)
+        db.session.commit()
+        feed = self.client.get(url, query_string={"sync": sync}).get_data(as_text=True)
+
+        self.assertEqual(feed.count("BEGIN:VEVENT"), 2)
+        self.assertIn(f"UID:block-{task_id}-{ids[0]}@instime", feed)
+        self.assertEqual(self.client.get(url, query_string={"sync": "nope"}).status_code, 400)
+
+    def test_normalize_freetimes(self):
+        """does the normalize route preview with GET & merge with POST"""
+
+        self.add_freetimes(2)
+        self.add_freetimes(1)
+
+        resp = self.client.get("/times/normalize")
+
+        self.assertEqual(resp.json["merged"], 1)
+        self.assertEqual(Freetime.query.filter_by(user_id=self.user.id).count(), 3)
+
+        resp = self.client.post("/times/normalize")
+
+        self.assertEqual(resp.json["merged"], 1)
+        self.assertEqual(Freetime.query.filter_by(user_id=self.user.id).count(), 2)
+
+    def test_import_freetimes(self):
+        """does the import route load events as freetimes once"""
+
+        events = "".join(
+            f"BEGIN:VEVENT\r\nUID:event-{i}\r\nDTSTART:203002{i + 1:02}T080000Z\r\nDTEND:203002{i + 1:02}T090000Z\r\nEND:VEVENT\r\n"
+            for i in range(5)
+        )
+        calendar = f"BEGIN:VCALENDAR\r\n{events}BEGIN:VEVENT\r\nEND:VEVENT\r\nEND:VCALENDAR\r\n"
+        resp = self.client.post("/times/import", data=calendar, content_type="text/calendar")
+
+        self.assertEqual((resp.json["imported"], resp.json["duplicates"], resp.json["invalid"]), (5, 0, 1))
+        self.assertEqual(Freetime.query.filter_by(user_id=self.user.id).count(), 5)
+
+        resp = self.client.post("/times/import", data={"calendar": (BytesIO(calendar.encode()), "cal.ics")})
+
+        self.assertEqual((resp.json["imported"], resp.json["duplicates"]), (0, 5))
+        self.assertEqual(Freetime.query.filter_by(user_id=self.user.id).count(), 5)
+        self.assertIn("error", self.client.post("/times/import", json={}).json)
+
+    def test_repeating_freetimes(self):
+        """can a repeating freetime be made, skipped & have a task assigned to one of its occurrences"""
+
+        start = datetime.utcnow().replace(microsecond=0) + timedelta(days=1)
+        times = dict(start=start.isoformat() + "Z", end=(start + timedelta(hours=1)).isoformat() + "Z")
+
+        self.assertIn("error", self.client.post("/times", json=dict(times, repeat="FREQ=SOMETIMES")).json)
+        resp = self.client.post("/times", json=dict(times, repeat="FREQ=DAILY"))
+        series_id = resp.json["id"]
+        keys = [f"{series_id}@{start + timedelta(days=d):%Y%m%dT%H%M%S}" for d in range(3)]
+
+        self.assertIn(keys[0], self.client.get("/times").get_data(as_text=True))
+        self.assertTrue(self.client.delete("/times/occurrences", json=dict(id=keys[1])).json["url"])
+        self.assertIn("error", self.client.delete("/times/occurrences", json=dict(id=keys[1] + "0")).json)
+
+        self.client.post("/tasks", data=dict(title="run", description="5k", freetimes=[keys[2]]))
+        saved = Freetime.query.filter_by(series_id=series_id).one()
+
+        self.assertEqual(saved.start_time, start + timedelta(days=2))
+        self.assertEqual([t.title for t in saved.tasks], ["run"])
+        page = self.client.get("/times").get_data(as_text=True)
+        self.assertIn(keys[0], page)
+        self.assertNotIn(keys[1], page)
+        self.assertNotIn(keys[2], page)
+
+        self.client.post("/tasks", data=dict(title="swim", description="1k", freetimes=[keys[0]]))
+        first_id = Freetime.query.filter_by(series_id=series_id, start_time=start).one().id
+        self.client.delete("/times", json=dict(id=first_id))
+
+        self.assertNotIn(keys[0], self.client.get("/times").get_data(as_text=True))
+
+        self.client.delete(f"/times/series/{series_id}")
+
+        self.assertIsNone(FreetimeSeries.query.get(series_id))
+        self.assertEqual(Freetime.query.filter_by(user_id=self.user.id).count(), 1)
+
     def test_plans_view(self):
         """does the plans_view route work"""
 
@@ -127,6 +452,49 @@ class RoutesTestCase(TestCase):
         
         self.assertEqual(resp.status_code, 200)
         self.assertIn("Your plans", str(resp.data))
+        self.assertEqual(self.client.get("/plans?tasks_cursor=bad").status_code, 400)
+
+    def test_plans_view_pages(self):
+        """do the plans sections page with cursors & link back to their start"""
+
+        db.session.add_all([Task(title=f"task {i}", description="sakjhga", user_id=self.user.id) for i in range(3)])
+        db.session.commit()
+        per_page, app.config["PLANS_PER_PAGE"] = app.config["PLANS_PER_PAGE"], 2
+        try:
+            page = self.client.get("/plans").get_data(as_text=True)
+            next_url = page.split('href="/plans?tasks_cursor=')[1].split('"')[0]
+            page = self.client.get(f"/plans?tasks_cursor={next_url}").get_data(as_text=True)
+        finally:
+            app.config["PLANS_PER_PAGE"] = per_page
+
+        self.assertIn("task 2", page)
+        self.assertNotIn("task 0", page)
+        self.assertIn("Back to the start", page)
+
+    def test_get_capacity(self):
+        """does get_capacity give the user's counted minutes"""
+
+        start = datetime(2030, 1, 1, 12)
+        self.client.post("/times", json=dict(start=start.isoformat(), end=(start + timedelta(hours=2)).isoformat()))
+        freetime_id = Freetime.query.filter_by(user_id=self.user.id).one().id
+        self.client.post("/tasks", data=dict(title="run", description="5k", time_estimate=45, freetimes=[str(freetime_id)]))
+
+        resp = self.client.get("/plans/capacity")
+
+        self.assertEqual(resp.json, dict(freetime_minutes=120, planned_minutes=45, open_minutes=75, pending_minutes=45))
+        self.assertEqual(self.client.get(f"/times/{freetime_id}").json["open_minutes"], 75)
+        self.assertIn("75 min open", self.client.get("/plans").get_data(as_text=True))
+
+    def test_reconcile_capacity(self):
+        """does the reconcile-capacity command report & fix drifted counters"""
+
+        db.session.execute(db.text("UPDATE user_capacity SET pending_minutes = 99 WHERE user_id = :id"), dict(id=self.user.id))
+        db.session.commit()
+        runner = app.test_cli_runner()
+
+        self.assertEqual(runner.invoke(args=["reconcile-capacity"]).exit_code, 1)
+        self.assertEqual(runner.invoke(args=["reconcile-capacity", "--fix"]).exit_code, 0)
+        self.assertEqual(runner.invoke(args=["reconcile-capacity"]).exit_code, 0)
 
 class LoginRequiredViewsTestCase(TestCase):
     """do the protected views all redirect to login"""
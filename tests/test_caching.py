@@ -0,0 +1,107 @@
+import os
+import tempfile
+from time import sleep
+from unittest import TestCase
+
+from caching import LRUCache, SQLiteCache, make_cache
+
+class LRUCacheTestCase(TestCase):
+    """does the lru cache evict & expire entries"""
+
+    def test_get_set(self):
+        """does the cache give back stored values & count hits/misses"""
+
+        cache = LRUCache()
+        cache.set("a", 1)
+
+        self.assertEqual(cache.get("a"), 1)
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual(cache.stats()["hits"], 1)
+        self.assertEqual(cache.stats()["misses"], 1)
+
+    def test_evicts_least_recent(self):
+        """does the cache drop the least recently used entry when full"""
+
+        cache = LRUCache(maxsize=2)
+        cache.set("a", 1)
+        cache.set("b", 2)
+        cache.get("a")
+        cache.set("c", 3)
+
+        self.assertEqual(cache.get("a"), 1)
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual(len(cache), 2)
+
+    def test_sizeof(self):
+        """does the cache weigh entries with sizeof"""
+
+        cache = LRUCache(maxsize=10, sizeof=len)
+        cache.set("a", "12345")
+        cache.set("b", "123456")
+        cache.set("c", "12345678901")
+
+        self.assertIsNone(cache.get("a"))
+        self.assertEqual(cache.get("b"), "123456")
+        self.assertIsNone(cache.get("c"))
+        self.assertEqual(cache.size, 6)
+
+    def test_ttl(self):
+        """does the cache expire entries older than the ttl"""
+
+        cache = LRUCache(ttl=0.01)
+        cache.set("a", 1)
+        sleep(0.02)
+
+        self.assertIsNone(cache.get("a"))
+        self.assertEqual(len(cache), 0)
+
+class SQLiteCacheTestCase(TestCase):
+    """does the shared sqlite cache evict by size & work across instances"""
+
+    def setUp(self):
+        """make a fresh cache file"""
+
+        fd, self.path = tempfile.mkstemp(suffix=".sqlite3")
+        os.close(fd)
+
+    def tearDown(self):
+        """remove the cache file"""
+
+        for suffix in ("", "-wal", "-shm"):
+            if os.path.exists(self.path + suffix):
+                os.remove(self.path + suffix)
+
+    def test_shared(self):
+        """do two caches on the same file see each other's entries"""
+
+        first = SQLiteCache(self.path)
+        second = SQLiteCache(self.path)
+        first.set("a", "<p>a</p>")
+
+        self.assertEqual(second.get("a"), "<p>a</p>")
+        second.delete("a")
+        self.assertIsNone(first.get("a"))
+
+    def test_evicts_least_recent(self):
+        """does the cache drop the least recently used entries past maxsize"""
+
+        cache = SQLiteCache(self.path, maxsize=10)
+        cache.set("a", "12345")
+        cache.set("b", "12345")
+        cache.get("a")
+        cache.set("c", "123")
+        cache.set("d", "12345678901")
+
+        self.assertEqual(cache.get("a"), "12345")
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual(cache.get("c"), "123")
+        self.assertIsNone(cache.get("d"))
+        self.assertEqual(cache.size, 8)
+
+    def test_make_cache(self):
+        """does make_cache pick the backend"""
+
+        self.assertIsInstance(make_cache("memory", 10), LRUCache)
+        self.assertIsInstance(make_cache("shared", 10, self.path), SQLiteCache)
+        with self.assertRaises(ValueError):
+            make_cache("redis")
@@ -0,0 +1,57 @@
+from unittest import TestCase
+from threading import Event
+from flask_bcrypt import Bcrypt
+
+from hashing import PasswordHasher, HasherBusy
+
+class PasswordHasherTestCase(TestCase):
+    """does the hasher hash on its pool & shed extra load"""
+
+    def setUp(self):
+        """make a cheap hasher"""
+
+        self.hasher = PasswordHasher(Bcrypt(), rounds=4, workers=1, max_pending=1)
+
+    def tearDown(self):
+        """stop the pool"""
+
+        self.hasher.executor.shutdown()
+
+    def test_hash_check(self):
+        """does a hash check against its password"""
+
+        hashed_password = self.hasher.hash("strongpassword123")
+
+        self.assertTrue(hashed_password.startswith("$2b$04$"))
+        self.assertTrue(self.hasher.check(hashed_password, "strongpassword123"))
+        self.assertFalse(self.hasher.check(hashed_password, "wrongpassword"))
+
+    def test_needs_rehash(self):
+        """does the hasher spot hashes made with other rounds"""
+
+        hashed_password = self.hasher.hash("strongpassword123")
+
+        self.assertFalse(self.hasher.needs_rehash(hashed_password))
+        self.hasher.rounds = 5
+        self.assertTrue(self.hasher.needs_rehash(hashed_password))
+
+    def test_busy(self):
+        """does the hasher refuse work past max_pending"""
+
+        self.hasher.slots.acquire()
+
+        self.assertRaises(HasherBusy, self.hasher.hash, "strongpassword123")
+        self.hasher.slots.release()
+        self.assertTrue(self.hasher.hash("strongpassword123"))
+
+    def test_timeout(self):
+        """does a slow hash fail as busy & keep its slot until it finished"""
+
+        done = Event()
+        self.hasher.timeout = 0.01
+
+        self.assertRaises(HasherBusy, self.hasher.run, done.wait, 5)
+        self.assertRaises(HasherBusy, self.hasher.hash, "strongpassword123")
+        done.set()
+        self.hasher.executor.shutdown()
+        self.assertTrue(self.hasher.slots.acquire(blocking=False))
@@ -0,0 +1,127 @@
+from datetime import datetime
+from unittest import TestCase
+
+from models import FreetimeSeries
+from ical import fold, unfold, parse_line, parse_events, escape_text, format_series, format_timezone, RowStream
+
+CALENDAR = """BEGIN:VCALENDAR
+VERSION:2.0
+BEGIN:VEVENT
+UID:one@example.com
+DTSTART:20300101T080000Z
+DTEND:20300101T100000Z
+SUMMARY:Morning
+BEGIN:VALARM
+TRIGGER:-PT15M
+DURATION:PT5M
+END:VALARM
+END:VEVENT
+BEGIN:VEVENT
+UID:two@exam
+ ple.com
+DTSTART;TZID="America/New_York":20300101T080000
+DURATION:PT1H30M
+END:VEVENT
+BEGIN:VEVENT
+DTSTART;VALUE=DATE:20300102
+SUMMARY:All day
+END:VEVENT
+BEGIN:VEVENT
+UID:backwards@example.com
+DTSTART:20300101T100000Z
+DTEND:20300101T080000Z
+END:VEVENT
+BEGIN:VEVENT
+UID:one@example.com
+RECURRENCE-ID:20300108T080000Z
+DTSTART:20300108T090000Z
+DTEND:20300108T100000Z
+END:VEVENT
+END:VCALENDAR
+"""
+
+class ICalTestCase(TestCase):
+    """do calendars parse & write correctly"""
+
+    def test_parse_events(self):
+        """are events read with their times in UTC & unusable ones flagged"""
+
+        events = list(parse_events(CALENDAR.encode().splitlines(True)))
+
+        self.assertEqual(events[0], ("one@example.com", datetime(2030, 1, 1, 8), datetime(2030, 1, 1, 10)))
+        self.assertEqual(events[1], ("two@example.com", datetime(2030, 1, 1, 13), datetime(2030, 1, 1, 14, 30)))
+        self.assertEqual(events[2][1:], (datetime(2030, 1, 2), datetime(2030, 1, 3)))
+        self.assertTrue(events[2][0].endswith("@ics-import"))
+        self.assertEqual(events[3:], [None, None])
+
+    def test_parse_line(self):
+        """are quoted parameters holding colons kept whole"""
+
+        self.assertEqual(
+            parse_line('DTSTART;TZID="Custom:Zone";VALUE=DATE-TIME:20300101T080000'),
+            ("DTSTART", {"TZID": "Custom:Zone", "VALUE": "DATE-TIME"}, "20300101T080000"),
+        )
+
+    def test_fold(self):
+        """are long lines folded to 75 octets & unfolded back"""
+
+        line = "SUMMARY:" + escape_text("café, " * 30)
+        folded = fold(line)
+
+        self.assertTrue(all(len(piece.encode()) <= 75 for piece in folded.split("\r\n")))
+        self.assertEqual(list(unfold(folded.splitlines(True))), [line])
+
+    def test_row_stream(self):
+        """does the row stream hand out exactly the generated rows"""
+
+        rows = [f"{i}\tx\n" for i in range(1000)]
+        stream = RowStream(iter(rows))
+        chunks = []
+        while True:
+            chunk = stream.read(100)
+            if not chunk:
+                break
+            chunks.append(chunk)
+
+        self.assertEqual("".join(chunks), "".join(rows))
+
+    def test_format_series(self):
+        """does a series become one repeating event in its own timezone"""
+
+        series = FreetimeSeries(id=4, start_time=datetime(2030, 3, 8, 13), end_time=datetime(2030, 3, 8, 15),
+            rule="FREQ=DAILY", timezone="America/New_York")
+        event = format_series(series, [datetime(2030, 3, 11, 12)], datetime(2030, 3, 1))
+
+        self.assertIn("UID:series-4@instime\r\n", event)
+        self.assertIn("DTSTART;TZID=America/New_York:20300308T080000\r\n", event)
+        self.assertIn("DURATION:PT7200S\r\nRRULE:FREQ=DAILY\r\n", event)
+        self.assertIn("EXDATE;TZID=America/New_York:20300311T080000\r\n", event)
+
+        series.timezone = None
+        event = format_series(series, [datetime(2030, 3, 11, 12)], datetime(2030, 3, 1))
+
+        self.assertIn("DTSTART:20300308T130000Z\r\n", event)
+        self.assertIn("EXDATE:20300311T120000Z\r\n", event)
+
+    def test_format_timezone(self):
+        """does a TZID get a VTIMEZONE with yearly rules, or each change when they don't repeat"""
+
+        zone = format_timezone("America/New_York", 2029)
+
+        self.assertIn("TZID:America/New_York\r\n", zone)
+        self.assertIn("BEGIN:DAYLIGHT\r\nDTSTART:20290311T020000\r\nTZOFFSETFROM:-0500\r\nTZOFFSETTO:-0400\r\n", zone)
+        self.assertIn("RRULE:FREQ=YEARLY;BYMONTH=3;BYDAY=2SU\r\n", zone)
+        self.assertIn("RRULE:FREQ=YEARLY;BYMONTH=11;BYDAY=1SU\r\n", zone)
+        self.assertEqual(zone.count("BEGIN:STANDARD"), 1)
+
+        zone = format_timezone("Asia/Kolkata", 2029)
+
+        self.assertIn("BEGIN:STANDARD\r\nDTSTART:20290101T000000\r\nTZOFFSETFROM:+0530\r\nTZOFFSETTO:+0530\r\n", zone)
+        self.assertNotIn("DAYLIGHT", zone)
+
+        # the friday before the last sunday of march isn't the same nth friday every year
+        zone = format_timezone("Asia/Jerusalem", 2029)
+
+        self.assertNotIn("RRULE", zone)
+        self.assertIn("DTSTART:20290323T020000\r\n", zone)
+        self.assertIn("DTSTART:20300329T020000\r\n", zone)
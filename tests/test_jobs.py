@@ -0,0 +1,286 @@
+import os
+from datetime import datetime, timedelta
+from time import sleep
+from unittest import TestCase
+
+from models import db, User, Freetime, Task, Job
+from jobs import job, enqueue, cancel, check_cancelled, claim, requeue_stale, Worker, JobFailed
+
+os.environ["DATABASE_URL"] = "postgresql:///instime_test"
+
+from app import app
+
+app.config["WTF_CSRF_ENABLED"] = False
+app.config["TESTING"] = True
+app.config["JOB_BACKOFF"] = 0.01
+
+db.drop_all()
+db.create_all()
+
+@job("test_echo", public=False)
+def run_echo(job):
+    return dict(echo=job.args.get("value"))
+
+@job("test_flaky", max_attempts=2, public=False)
+def run_flaky(job):
+    db.session.add(Task(title="half done", description="rolled back", user_id=job.user_id))
+    db.session.flush()
+    raise RuntimeError("flaked")
+
+@job("test_broken", public=False)
+def run_broken(job):
+    raise JobFailed("never works")
+
+@job("test_cancelled", public=False)
+def run_cancelled(job):
+    db.session.add(Task(title="half done", description="rolled back", user_id=job.user_id))
+    # the user cancels from another connection while the job runs
+    with db.engine.begin() as conn:
+        conn.execute(db.text("UPDATE jobs SET cancel_requested = true WHERE id = :id"), dict(id=job.id))
+    check_cancelled(job)
+
+@job("test_cancelled_unchecked", public=False)
+def run_cancelled_unchecked(job):
+    db.session.add(Task(title="finished", description="rolled back", user_id=job.user_id))
+    # cancelled while it runs, but the job never checks
+    with db.engine.begin() as conn:
+        conn.execute(db.text("UPDATE jobs SET cancel_requested = true WHERE id = :id"), dict(id=job.id))
+    return dict(done=True)
+
+@job("test_slow", public=False)
+def run_slow(job):
+    db.session.add(Task(title="slow", description="kept", user_id=job.user_id))
+    sleep(app.config["JOB_TIMEOUT"] * 2)
+    # another worker looks for stale jobs on its own connection
+    with db.engine.begin() as conn:
+        cutoff = datetime.utcnow() - timedelta(seconds=app.config["JOB_TIMEOUT"])
+        stale = conn.execute(db.text("SELECT COUNT(*) FROM jobs WHERE id = :id AND locked_at < :cutoff"), dict(id=job.id, cutoff=cutoff)).scalar()
+    return dict(stale=stale)
+
+@job("test_taken_back", public=False)
+def run_taken_back(job):
+    db.session.add(Task(title="twice", description="dropped", user_id=job.user_id))
+    # the job outlived JOB_TIMEOUT & another worker took it back
+    with db.engine.begin() as conn:
+        conn.execute(db.text("UPDATE jobs SET locked_by = 'other-worker' WHERE id = :id"), dict(id=job.id))
+    return dict(done=True)
+
+class JobQueueTestCase(TestCase):
+    """do workers claim, run, retry & cancel queued jobs"""
+
+    def setUp(self):
+        """empty out old data & make two users"""
+
+        Job.query.delete()
+        Task.query.delete()
+        User.query.delete()
+
+        users = [User(email=f"user{i}@email.com", name="Martin Brown", password="j3h6na3kamg") for i in range(2)]
+        db.session.add_all(users)
+        db.session.commit()
+
+        self.user_ids = [user.id for user in users]
+        self.worker = Worker(app, "test-worker")
+
+    def tearDown(self):
+        """clean out the session"""
+
+        db.session.rollback()
+
+    def get_job(self, id):
+        """reads a job fresh from the database"""
+
+        db.session.expire_all()
+        return Job.query.get(id)
+
+    def test_run_job(self):
+        """does a worker run a queued job & store its result"""
+
+        id = enqueue("test_echo", self.user_ids[0], dict(value=7)).id
+        db.session.commit()
+
+        self.assertTrue(self.worker.run_once())
+        self.assertFalse(self.worker.run_once())
+        done = self.get_job(id)
+        self.assertEqual((done.status, done.result, done.attempts), ("done", dict(echo=7), 1))
+        self.assertIsNotNone(done.finished_at)
+        self.assertRaises(ValueError, enqueue, "test_unknown")
+
+    def test_retry_with_backoff(self):
+        """is a failed attempt rolled back & retried later, then failed once out of attempts"""
+
+        id = enqueue("test_flaky", self.user_ids[0]).id
+        db.session.commit()
+
+        self.worker.run_once()
+        retried = self.get_job(id)
+
+        self.assertEqual((retried.status, retried.attempts), ("queued", 1))
+        self.assertIn("flaked", retried.error)
+        self.assertGreater(retried.run_at, datetime.utcnow() - timedelta(seconds=1))
+        self.assertEqual(Task.query.count(), 0)
+
+        retried.run_at = datetime.utcnow()
+        db.session.commit()
+        self.worker.run_once()
+
+        self.assertEqual((self.get_job(id).status, self.get_job(id).attempts), ("failed", 2))
+
+    def test_job_failed(self):
+        """does JobFailed fail a job without retries"""
+
+        id = enqueue("test_broken", self.user_ids[0]).id
+        db.session.commit()
+
+        self.worker.run_once()
+
+        self.assertEqual((self.get_job(id).status, self.get_job(id).error), ("failed", "JobFailed: never works"))
+
+    def test_taken_back(self):
+        """are the writes of a job taken back from its worker dropped instead of applied twice"""
+
+        id = enqueue("test_taken_back", self.user_ids[0]).id
+        db.session.commit()
+
+        self.worker.run_once()
+
+        self.assertEqual((self.get_job(id).status, self.get_job(id).locked_by), ("running", "other-worker"))
+        self.assertEqual(Task.query.count(), 0)
+
+    def test_per_user_concurrency(self):
+        """is a user's second job passed over while their first runs"""
+
+        first = enqueue("test_echo", self.user_ids[0]).id
+        second = enqueue("test_echo", self.user_ids[0]).id
+        other = enqueue("test_echo", self.user_ids[1]).id
+        db.session.commit()
+
+        self.assertEqual(claim("w1", 1).id, first)
+        self.assertEqual(claim("w2", 1).id, other)
+        self.assertIsNone(claim("w3", 1))
+        self.assertEqual(claim("w3", 2).id, second)
+
+    def test_cancel(self):
+        """are queued jobs cancelled at once & running ones at their next check"""
+
+        queued = enqueue("test_echo", self.user_ids[0]).id
+        running = enqueue("test_cancelled", self.user_ids[1]).id
+        db.session.commit()
+
+        self.assertTrue(cancel(queued))
+        db.session.commit()
+        self.assertFalse(cancel(queued))
+        self.assertEqual(self.get_job(queued).status, "cancelled")
+
+        self.worker.run_once()
+
+        self.assertEqual(self.get_job(running).status, "cancelled")
+        self.assertEqual(Task.query.count(), 0)
+
+    def test_cancel_unchecked(self):
+        """is a job cancelled while it ran rolled back even when it never checked"""
+
+        id = enqueue("test_cancelled_unchecked", self.user_ids[0]).id
+        db.session.commit()
+
+        self.worker.run_once()
+
+        self.assertEqual((self.get_job(id).status, self.get_job(id).result), ("cancelled", None))
+        self.assertEqual(Task.query.count(), 0)
+
+    def test_requeue_stale(self):
+        """are jobs of a worker that went quiet taken back"""
+
+        id = enqueue("test_echo", self.user_ids[0]).id
+        db.session.commit()
+        claim("gone", 1)
+
+        self.assertEqual(requeue_stale(60), 0)
+
+        Job.query.filter(Job.id == id).update(dict(locked_at=datetime.utcnow() - timedelta(minutes=5)))
+        db.session.commit()
+
+        self.assertEqual(requeue_stale(60), 1)
+        self.assertEqual((self.get_job(id).status, self.get_job(id).locked_by), ("queued", None))
+
+    def test_heartbeat(self):
+        """does a job running past JOB_TIMEOUT keep its lock fresh instead of going stale"""
+
+        id = enqueue("test_slow", self.user_ids[0]).id
+        db.session.commit()
+
+        app.config["JOB_TIMEOUT"] = 0.3
+        try:
+            self.worker.run_once()
+        finally:
+            app.config["JOB_TIMEOUT"] = 15 * 60
+
+        self.assertEqual((self.get_job(id).status, self.get_job(id).result), ("done", dict(stale=0)))
+        self.assertEqual(Task.query.count(), 1)
+
+class JobRoutesTestCase(TestCase):
+    """can users queue, poll & cancel their jobs"""
+
+    def setUp(self):
+        """empty out old data & log a user in"""
+
+        Job.query.delete()
+        Freetime.query.delete()
+        Task.query.delete()
+        User.query.delete()
+
+        with app.test_request_context():
+            user = User.register("user@email.com", "strongpassword123", "Martin Brown")
+            db.session.flush()
+            self.user_id = user.id
+            db.session.add(Task(title="run", description="5k", time_estimate=30, user_id=user.id))
+            db.session.add(Freetime(start_time=datetime(2100, 1, 1, 10), end_time=datetime(2100, 1, 1, 11), user_id=user.id))
+            db.session.commit()
+
+        self.client = app.test_client()
+        self.client.post("/login", data={"email": "user@email.com", "password": "strongpassword123"})
+
+    def tearDown(self):
+        """clean out the session"""
+
+        db.session.rollback()
+
+    def test_queue_and_poll(self):
+        """does a queued job run & report its result when polled"""
+
+        resp = self.client.post("/jobs", json=dict(kind="auto_plan", args=dict(mode="greedy")))
+
+        self.assertEqual(resp.status_code, 202)
+        self.assertEqual(self.client.get(resp.json["url"]).json["status"], "queued")
+
+        Worker(app, "test-worker").run_once()
+
+        polled = self.client.get(resp.json["url"]).json
+        self.assertEqual((polled["status"], polled["result"]), ("done", dict(planned=1)))
+        self.assertEqual([j["id"] for j in self.client.get("/jobs").json["jobs"]], [resp.json["id"]])
+
+    def test_queue_refused(self):
+        """are unknown & app only kinds refused & the queue per user capped"""
+
+        self.assertIn("error", self.client.post("/jobs", json=dict(kind="nope")).json)
+        self.assertIn("error", self.client.post("/jobs", json=dict(kind="reconcile_capacity")).json)
+        self.assertIn("error", self.client.post("/jobs", json=dict(kind="test_echo")).json)
+        self.assertIn("error", self.client.post("/jobs", json=dict(kind=["auto_plan"])).json)
+        self.assertIn("error", self.client.post("/jobs", json=["auto_plan"]).json)
+
+        app.config["JOB_QUEUE_LIMIT"] = 1
+        try:
+            self.client.post("/jobs", json=dict(kind="normalize_freetimes"))
+            self.assertEqual(self.client.post("/jobs", json=dict(kind="normalize_freetimes")).status_code, 429)
+        finally:
+            app.config["JOB_QUEUE_LIMIT"] = 20
+
+    def test_cancel_job(self):
+        """does cancel_job stop a queued job"""
+
+        url = self.client.post("/jobs", json=dict(kind="delete_freetimes")).json["url"]
+
+        self.assertEqual(self.client.delete(url).json["status"], "cancelled")
+        self.assertIn("error", self.client.delete(url).json)
+        Worker(app, "test-worker").run_once()
+        self.assertEqual(Freetime.query.filter_by(user_id=self.user_id).count(), 1)
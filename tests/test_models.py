@@ -1,11 +1,12 @@
 import os
+from threading import Thread
 from unittest import TestCase
 from psycopg2.errors import UniqueViolation
 from sqlalchemy.exc import IntegrityError
-from datetime import datetime
+from datetime import datetime, timedelta
 from flask_bcrypt import Bcrypt
 
-from models import db, User, Freetime, Task
+from models import db, User, Freetime, FreetimeSeries, Occurrence, Task, PlanDiff, UserCapacity, UserIdentity, blocks, user_cache, hasher, make_tsquery, encode_cursor, decode_cursor
 
 os.environ['DATABASE_URL'] = "postgresql:///instime_test"
 
@@ -132,6 +133,21 @@ class UserModelTestCase(TestCase):
         self.assertIsInstance(user, User)
         self.assertEqual(user, self.user)
     
+    def test_user_authenticate_rehash(self):
+        """does authenticate rehash passwords made with an old work factor"""
+
+        rounds = hasher.rounds
+        hasher.rounds = 4
+        try:
+            user = User.authenticate(self.user.email, "strongpassword123")
+            db.session.commit()
+        finally:
+            hasher.rounds = rounds
+
+        self.assertEqual(user, self.user)
+        self.assertTrue(user.password.startswith("$2b$04$"))
+        self.assertTrue(User.authenticate(self.user.email, "strongpassword123"))
+
     def test_user_authenticate_fail(self):
         """does the user authenticate work right when there is wrong credentials"""
 
@@ -143,6 +159,30 @@ class UserModelTestCase(TestCase):
         self.assertFalse(wrong_email)
         self.assertFalse(wrong_credentials)
 
+    def test_user_load_identity(self):
+        """does load_identity cache a detached copy of the user"""
+
+        user_cache.clear()
+        misses = user_cache.misses
+        identity = User.load_identity(str(self.user.id))
+        cached = User.load_identity(self.user.id)
+
+        self.assertIsInstance(identity, UserIdentity)
+        self.assertEqual(identity, self.user)
+        self.assertEqual(cached.name, "Martin Brown")
+        self.assertIsNot(cached, identity)
+        self.assertEqual(user_cache.misses, misses + 1)
+        self.assertIsNone(User.load_identity(self.user.id + 1))
+
+    def test_user_load_identity_invalidated(self):
+        """does changing a user drop them from the cache"""
+
+        User.load_identity(self.user.id)
+        self.user.name = "Marty Brown"
+        db.session.commit()
+
+        self.assertEqual(User.load_identity(self.user.id).name, "Marty Brown")
+
 class TaskModelTestCase(TestCase):
     """does the task model behave right"""
 
@@ -243,6 +283,93 @@ class TaskModelTestCase(TestCase):
 
         self.assertIsNone(task.pretty_estimate)
 
+    def add_sortable_tasks(self):
+        """adds tasks with mixed statuses, priorities & estimates (some missing)"""
+
+        tasks = [Task(
+            title=f"task {i}", description="sakjhga", user_id=self.user.id,
+            status=("pending", "partial", "done")[i % 3], priority=i % 4,
+            time_estimate=None if i % 5 == 0 else (i * 7) % 30 + 1,
+        ) for i in range(25)]
+        db.session.add_all(tasks)
+        db.session.commit()
+
+    def test_task_get_user_tasks_by_sort(self):
+        """does get_user_tasks_by_sort order tasks like the sort asks"""
+
+        self.add_sortable_tasks()
+
+        by_status = Task.get_user_tasks_by_sort(self.user, "status")
+        by_priority = Task.get_user_tasks_by_sort(self.user, "priority")
+        by_estimate = Task.get_user_tasks_by_sort(self.user, "estimate")
+        estimate = lambda t: -1 if t.time_estimate is None else t.time_estimate
+
+        self.assertEqual(len(by_status), 26)
+        self.assertEqual(by_status, sorted(by_status, key=lambda t: (t.status, -t.priority)))
+        self.assertEqual(by_priority, sorted(by_priority, key=lambda t: (-t.priority, -estimate(t))))
+        self.assertEqual(by_estimate, sorted(by_estimate, key=lambda t: (-estimate(t), -t.priority)))
+        self.assertIsNone(by_estimate[-1].time_estimate)
+
+    def test_task_get_user_tasks_page(self):
+        """does paging with cursors walk every task once in order"""
+
+        self.add_sortable_tasks()
+
+        for sort in (None, "status", "priority", "estimate"):
+            everything, _ = Task.get_user_tasks_page(self.user.id, sort)
+            pages, cursor = [], None
+            while True:
+                tasks, cursor = Task.get_user_tasks_page(self.user.id, sort, cursor, per_page=4)
+                pages.extend(tasks)
+                if not cursor:
+                    break
+            self.assertEqual(pages, everything)
+
+    def test_task_get_user_tasks_page_bad_cursor(self):
+        """does a malformed cursor raise a value error"""
+
+        self.assertRaises(ValueError, Task.get_user_tasks_page, self.user.id, "status", "not-a-cursor", 4)
+        self.assertRaises(ValueError, Task.get_user_tasks_page, self.user.id, "status", encode_cursor([1, 1, 1]), 4)
+        self.assertRaises(ValueError, Task.get_user_tasks_page, self.user.id, "priority", encode_cursor([1, "1", 1]), 4)
+        self.assertRaises(ValueError, Task.get_user_tasks_page, self.user.id, None, encode_cursor([True]), 4)
+
+    def test_cursor_types(self):
+        """do cursors carry datetimes & refuse values of the wrong type"""
+
+        cursor = encode_cursor([datetime(2030, 1, 1, 8, 30), 4])
+
+        self.assertEqual(decode_cursor(cursor, [datetime, int]), [datetime(2030, 1, 1, 8, 30), 4])
+        self.assertRaises(ValueError, decode_cursor, cursor, [int, int])
+        self.assertRaises(ValueError, decode_cursor, encode_cursor(["soon", 4]), [datetime, int])
+
+    def test_make_tsquery(self):
+        """are typed words turned into safe prefix terms"""
+
+        self.assertEqual(make_tsquery("Walk the DOG's"), "walk:* & the:* & dogs:*")
+        self.assertEqual(make_tsquery("a:* | !(b) & 'c'"), "a:* & b:* & c:*")
+        self.assertIsNone(make_tsquery(" &|! "))
+
+    def test_task_search(self):
+        """does search rank title matches first, match prefixes & filter"""
+
+        other = Task(title="dishes", description="then walk to the park", priority=3, user_id=self.user.id)
+        done = Task(title="walking club", description="sign up", status="done", user_id=self.user.id)
+        db.session.add_all([other, done])
+        db.session.commit()
+
+        self.assertEqual([t for t, _ in Task.search(self.user.id, "walk")], [self.task, done, other])
+        self.assertEqual([t for t, _ in Task.search(self.user.id, "walki")], [done])
+        self.assertEqual([t for t, _ in Task.search(self.user.id, "wal", status="pending")], [self.task, other])
+        self.assertEqual([t for t, _ in Task.search(self.user.id, "walk", priority=3)], [other])
+        self.assertEqual(Task.search(self.user.id + 1, "walk"), [])
+        self.assertEqual(Task.search(self.user.id, ""), [])
+
+        other.description = "dry the plates"
+        db.session.commit()
+
+        self.assertEqual([t for t, _ in Task.search(self.user.id, "walk dog")], [self.task])
+        self.assertEqual([t for t, _ in Task.search(self.user.id, "plate")], [other])
+
 class FreetimeModelTestCase(TestCase):
     """does the freetime model behave right"""
 
@@ -322,3 +449,418 @@ class FreetimeModelTestCase(TestCase):
 
         self.assertEqual(len(freetime.tasks), 1)
         self.assertIsInstance(freetime.tasks[0], Task)
+
+    def add_window(self, start_hour, end_hour):
+        """adds a freetime on a fixed day between the given hours and returns it"""
+
+        day = datetime(2030, 1, 1)
+        freetime = Freetime(start_time=day + timedelta(hours=start_hour), end_time=day + timedelta(hours=end_hour), user_id=self.user.id)
+        db.session.add(freetime)
+        db.session.commit()
+
+        return freetime
+
+    def test_freetime_get_overlapping(self):
+        """does get_overlapping only find the user's freetimes that overlap"""
+
+        day = datetime(2030, 1, 1)
+        morning = self.add_window(8, 10)
+        noon = self.add_window(11, 13)
+        self.add_window(13, 15)
+
+        overlaps = Freetime.get_overlapping(self.user.id, day + timedelta(hours=9), day + timedelta(hours=12))
+        touching = Freetime.get_overlapping(self.user.id, day + timedelta(hours=10), day + timedelta(hours=11))
+        excluded = Freetime.get_overlapping(self.user.id, day + timedelta(hours=9), day + timedelta(hours=12), morning.id)
+
+        self.assertEqual(overlaps, [morning, noon])
+        self.assertEqual(touching, [])
+        self.assertEqual(excluded, [noon])
+
+    def test_freetime_save_window_reject(self):
+        """does save_window refuse windows that overlap other freetimes"""
+
+        day = datetime(2030, 1, 1)
+        morning = self.add_window(8, 10)
+
+        saved, conflicts = Freetime.save_window(self.user.id, day + timedelta(hours=9), day + timedelta(hours=11))
+
+        self.assertIsNone(saved)
+        self.assertEqual(conflicts, [morning])
+
+    def test_freetime_save_window_concurrent(self):
+        """does a second write wait for the first & reject its overlap instead of both passing the check"""
+
+        day = datetime(2030, 1, 1)
+        user_id = self.user.id
+        outcome = {}
+
+        def save_other():
+            with app.app_context():
+                saved, conflicts = Freetime.save_window(user_id, day + timedelta(hours=9), day + timedelta(hours=11))
+                outcome.update(saved=saved, conflicts=[c.id for c in conflicts])
+                db.session.commit()
+
+        saved, _ = Freetime.save_window(user_id, day + timedelta(hours=8), day + timedelta(hours=10))
+        db.session.flush()
+        other = Thread(target=save_other)
+        other.start()
+        # the other write waits on the lock until this one commits
+        other.join(0.5)
+        self.assertTrue(other.is_alive())
+        db.session.commit()
+        other.join()
+
+        self.assertIsNone(outcome["saved"])
+        self.assertEqual(outcome["conflicts"], [saved.id])
+        self.assertEqual(Freetime.query.filter_by(user_id=user_id).count(), 2)
+
+    def test_freetime_save_window_merge(self):
+        """does save_window merge overlapping freetimes and keep their blocks"""
+
+        day = datetime(2030, 1, 1)
+        morning = self.add_window(8, 10)
+        noon = self.add_window(11, 13)
+        task = self.add_user_task()
+        noon.tasks.append(task)
+        db.session.commit()
+        noon_id = noon.id
+
+        saved, conflicts = Freetime.save_window(self.user.id, day + timedelta(hours=9), day + timedelta(hours=12), "merge")
+        db.session.commit()
+
+        self.assertEqual(saved, morning)
+        self.assertEqual(len(conflicts), 2)
+        self.assertEqual(saved.start_time, day + timedelta(hours=8))
+        self.assertEqual(saved.end_time, day + timedelta(hours=13))
+        self.assertIsNone(Freetime.query.get(noon_id))
+        self.assertEqual(saved.tasks, [task])
+        self.assertEqual(db.session.query(blocks).count(), 1)
+
+    def test_freetime_coalesce(self):
+        """does coalesce merge overlapping & touching freetimes without changing them"""
+
+        day = datetime(2030, 1, 1)
+        morning = self.add_window(8, 10)
+        late_morning = self.add_window(9, 11)
+        noon = self.add_window(11, 12)
+        evening = self.add_window(18, 19)
+
+        merged = Freetime.coalesce(self.user.id)[1:]
+
+        self.assertEqual(merged, [
+            (day + timedelta(hours=8), day + timedelta(hours=12), [morning.id, late_morning.id, noon.id]),
+            (day + timedelta(hours=18), day + timedelta(hours=19), [evening.id]),
+        ])
+        self.assertEqual(Freetime.query.filter_by(user_id=self.user.id).count(), 5)
+
+    def test_freetime_normalize(self):
+        """does normalize merge freetimes into one row & move their blocks onto it"""
+
+        day = datetime(2030, 1, 1)
+        morning = self.add_window(8, 10)
+        inside = self.add_window(8, 9)
+        noon = self.add_window(10, 12)
+        task = self.add_user_task()
+        other = self.add_user_task()
+        morning.tasks.append(task)
+        inside.tasks.append(task)
+        noon.tasks.append(other)
+        db.session.commit()
+        morning_id, task_id, other_id = morning.id, task.id, other.id
+
+        Freetime.normalize(self.user.id)
+        db.session.commit()
+        db.session.expire_all()
+
+        freetimes = Freetime.query.filter_by(user_id=self.user.id).order_by(Freetime.start_time).all()[1:]
+        self.assertEqual([f.id for f in freetimes], [morning_id])
+        self.assertEqual(freetimes[0].end_time, day + timedelta(hours=12))
+        self.assertEqual(sorted(t.id for t in freetimes[0].tasks), sorted([task_id, other_id]))
+        self.assertEqual(db.session.query(blocks).count(), 2)
+
+class FreetimeSeriesTestCase(TestCase):
+    """do repeating freetimes expand, skip & save their occurrences right"""
+
+    def setUp(self):
+        """clear out old data and create some sample data"""
+
+        Freetime.query.delete()
+        FreetimeSeries.query.delete()
+        Task.query.delete()
+        User.query.delete()
+
+        hashed_password = bcrypt.generate_password_hash("strongpassword123").decode("utf-8")
+        user = User(email="user@email.com", password=hashed_password, name="Martin Brown")
+        db.session.add(user)
+        db.session.commit()
+        # 8am - 10am New York time every day, starting before DST begins on March 10th
+        series = FreetimeSeries(start_time=datetime(2030, 3, 8, 13), end_time=datetime(2030, 3, 8, 15),
+            rule="FREQ=DAILY", timezone="America/New_York", user_id=user.id)
+        db.session.add(series)
+        db.session.commit()
+
+        self.user = user
+        self.series = series
+
+    def tearDown(self):
+        """clean out the session"""
+
+        db.session.rollback()
+
+    def test_series_check_rule(self):
+        """does check_rule accept RRULEs & turn down others"""
+
+        self.assertEqual(FreetimeSeries.check_rule("RRULE:FREQ=WEEKLY;BYDAY=MO"), "FREQ=WEEKLY;BYDAY=MO")
+        self.assertRaises(ValueError, FreetimeSeries.check_rule, "FREQ=SOMETIMES")
+        self.assertRaises(ValueError, FreetimeSeries.check_rule, "FREQ=MINUTELY")
+
+    def test_series_expand(self):
+        """does expand keep the local start time over DST"""
+
+        occurrences = FreetimeSeries.expand(self.user.id, datetime(2030, 3, 8), datetime(2030, 3, 12))
+
+        self.assertEqual([o.start_time for o in occurrences], [
+            datetime(2030, 3, 8, 13), datetime(2030, 3, 9, 13), datetime(2030, 3, 10, 12), datetime(2030, 3, 11, 12),
+        ])
+        self.assertEqual(occurrences[2].end_time, datetime(2030, 3, 10, 14))
+        self.assertEqual(occurrences[0].id, f"{self.series.id}@20300308T130000")
+        self.assertEqual(Occurrence.parse_key(occurrences[0].id), (self.series.id, datetime(2030, 3, 8, 13)))
+        self.assertEqual(len(FreetimeSeries.expand(self.user.id, datetime(2030, 3, 8), datetime(2031, 3, 8), limit=10)), 10)
+
+    def test_series_skip(self):
+        """does skip take only real occurrences out of the series"""
+
+        key = f"{self.series.id}@20300309T130000"
+
+        self.assertTrue(FreetimeSeries.skip(self.user.id, key))
+        self.assertFalse(FreetimeSeries.skip(self.user.id, f"{self.series.id}@20300309T120000"))
+        self.assertFalse(FreetimeSeries.skip(self.user.id + 1, key))
+        self.assertFalse(FreetimeSeries.skip(self.user.id, "nope"))
+        starts = [o.start_time for o in FreetimeSeries.expand(self.user.id, datetime(2030, 3, 8), datetime(2030, 3, 11))]
+        self.assertEqual(starts, [datetime(2030, 3, 8, 13), datetime(2030, 3, 10, 12)])
+
+    def test_series_materialize(self):
+        """does materialize save an occurrence as a freetime once"""
+
+        key = f"{self.series.id}@20300310T120000"
+
+        saved = FreetimeSeries.materialize(self.user.id, [key, "nope", f"{self.series.id}@20300310T130000"])
+        again = FreetimeSeries.materialize(self.user.id, [key])
+        db.session.commit()
+
+        self.assertEqual(list(saved), [key])
+        self.assertEqual(again, saved)
+        freetime = Freetime.query.get(saved[key])
+        self.assertEqual((freetime.start_time, freetime.end_time), (datetime(2030, 3, 10, 12), datetime(2030, 3, 10, 14)))
+        self.assertEqual(FreetimeSeries.materialize(self.user.id + 1, [key]), {})
+        starts = [o.start_time for o in FreetimeSeries.expand(self.user.id, datetime(2030, 3, 10), datetime(2030, 3, 12))]
+        self.assertEqual(starts, [datetime(2030, 3, 11, 12)])
+
+    def test_removed_occurrences_stay_gone(self):
+        """do occurrences saved as freetimes stay out of the series once deleted or merged away"""
+
+        keys = [f"{self.series.id}@2030031{d}T120000" for d in range(3)]
+        saved = FreetimeSeries.materialize(self.user.id, keys)
+        day = datetime(2030, 3, 11)
+        db.session.add(Freetime(start_time=day + timedelta(hours=11), end_time=day + timedelta(hours=12, minutes=30), user_id=self.user.id))
+        db.session.add(Freetime(start_time=day + timedelta(days=1, hours=11), end_time=day + timedelta(days=1, hours=12, minutes=30), user_id=self.user.id))
+        db.session.commit()
+
+        Freetime.apply_batch(self.user.id, [dict(op="delete", id=saved[keys[0]])])
+        Freetime.normalize(self.user.id)
+        Freetime.save_window(self.user.id, day + timedelta(days=1, hours=12, minutes=15), day + timedelta(days=1, hours=14, minutes=30), "merge")
+        db.session.commit()
+
+        self.assertEqual(Freetime.query.filter(Freetime.series_id == self.series.id).count(), 0)
+        starts = [o.start_time for o in FreetimeSeries.expand(self.user.id, datetime(2030, 3, 10), datetime(2030, 3, 14))]
+        self.assertEqual(starts, [datetime(2030, 3, 13, 12)])
+
+class PlanDiffTestCase(TestCase):
+    """does the plan diff split a user's data right"""
+
+    def setUp(self):
+        """clear out old data and create some sample data"""
+
+        Freetime.query.delete()
+        Task.query.delete()
+        User.query.delete()
+
+        hashed_password = bcrypt.generate_password_hash("strongpassword123").decode("utf-8")
+        user = User(email="user@email.com", password=hashed_password, name="Martin Brown")
+        db.session.add(user)
+        db.session.commit()
+
+        day = datetime(2030, 1, 1)
+        freetimes = [Freetime(start_time=day + timedelta(hours=h), end_time=day + timedelta(hours=h + 1), user_id=user.id) for h in range(3)]
+        tasks = [Task(title=f"task {i}", description="sakjhga", user_id=user.id) for i in range(3)]
+        db.session.add_all(freetimes + tasks)
+        db.session.commit()
+        tasks[0].freetimes.append(freetimes[1])
+        db.session.commit()
+
+        self.user = user
+        self.freetimes = freetimes
+        self.tasks = tasks
+
+    def tearDown(self):
+        """clean out the session"""
+
+        db.session.rollback()
+
+    def test_plan_diff(self):
+        """does the plan diff find planned blocks & open tasks/freetimes"""
+
+        plans = PlanDiff(self.user.id)
+
+        self.assertEqual(plans.blocks, [(self.tasks[0], self.freetimes[1])])
+        self.assertEqual(plans.open_tasks, self.tasks[1:])
+        self.assertEqual(plans.open_freetimes, [self.freetimes[0], self.freetimes[2]])
+        self.assertIsNone(plans.next_tasks)
+
+    def test_plan_diff_pages(self):
+        """does the plan diff page each section with cursors"""
+
+        first = PlanDiff(self.user.id, per_page=1)
+        second = PlanDiff(self.user.id, per_page=1, tasks_cursor=first.next_tasks, freetimes_cursor=first.next_freetimes)
+
+        self.assertEqual(first.open_tasks, [self.tasks[1]])
+        self.assertIsNotNone(first.next_tasks)
+        self.assertEqual(second.open_tasks, [self.tasks[2]])
+        self.assertIsNone(second.next_tasks)
+        self.assertEqual(second.open_freetimes, [self.freetimes[2]])
+        self.assertIsNone(first.next_blocks)
+        self.assertRaises(ValueError, PlanDiff, self.user.id, 1, first.next_tasks)
+
+class UserCapacityTestCase(TestCase):
+    """do the triggers keep the capacity counters right"""
+
+    def setUp(self):
+        """clear out old data and create some sample data"""
+
+        Freetime.query.delete()
+        Task.query.delete()
+        User.query.delete()
+
+        user = User(email="user@email.com", password="j3h6na3kamg", name="Martin Brown")
+        db.session.add(user)
+        db.session.commit()
+
+        day = datetime(2030, 1, 1)
+        freetimes = [Freetime(start_time=day + timedelta(hours=h), end_time=day + timedelta(hours=h + 1), user_id=user.id) for h in (0, 2)]
+        tasks = [Task(title=f"task {i}", description="sakjhga", time_estimate=20, user_id=user.id) for i in range(2)]
+        db.session.add_all(freetimes + tasks)
+        db.session.commit()
+
+        self.user = user
+        self.freetimes = freetimes
+        self.tasks = tasks
+
+    def tearDown(self):
+        """clean out the session"""
+
+        db.session.rollback()
+
+    def capacity(self):
+        """reads the user's counters fresh from the database"""
+
+        db.session.expire_all()
+        return UserCapacity.get(self.user.id).to_dict()
+
+    def test_capacity_counts(self):
+        """are new users, freetimes & tasks counted"""
+
+        self.assertEqual(self.capacity(), dict(freetime_minutes=120, planned_minutes=0, open_minutes=120, pending_minutes=40))
+
+    def test_capacity_blocks(self):
+        """do blocks, estimates & statuses move the counters"""
+
+        self.tasks[0].freetimes.append(self.freetimes[0])
+        self.tasks[1].freetimes.append(self.freetimes[0])
+        db.session.commit()
+
+        self.assertEqual(self.freetimes[0].committed_minutes, 40)
+        self.assertEqual(self.freetimes[0].open_minutes, 20)
+        self.assertEqual(self.capacity(), dict(freetime_minutes=120, planned_minutes=40, open_minutes=80, pending_minutes=40))
+
+        # a bulk update & a status change, past the ORM's unit of work
+        Task.query.filter_by(user_id=self.user.id).update(dict(time_estimate=45))
+        self.tasks[0].status = "done"
+        db.session.commit()
+
+        self.assertEqual(self.freetimes[0].committed_minutes, 90)
+        self.assertEqual(self.capacity(), dict(freetime_minutes=120, planned_minutes=90, open_minutes=60, pending_minutes=45))
+
+        db.session.delete(self.tasks[1])
+        db.session.commit()
+
+        self.assertEqual(self.capacity(), dict(freetime_minutes=120, planned_minutes=45, open_minutes=75, pending_minutes=0))
+
+    def test_capacity_concurrent_blocks(self):
+        """do two transactions planning into the same freetime both count"""
+
+        freetime_id = self.freetimes[0].id
+        first, second = db.engine.connect(), db.engine.connect()
+        try:
+            holding = first.begin()
+            first.execute(blocks.insert(), dict(task_id=self.tasks[0].id, freetime_id=freetime_id))
+            # the second waits on the freetime's row lock until the first commits
+            waiting = Thread(target=lambda: second.execute(blocks.insert(), dict(task_id=self.tasks[1].id, freetime_id=freetime_id)))
+            waiting.start()
+            waiting.join(0.5)
+            holding.commit()
+            waiting.join()
+        finally:
+            first.close()
+            second.close()
+
+        self.assertEqual(self.capacity()["planned_minutes"], 40)
+        self.assertEqual(UserCapacity.reconcile(), dict(freetimes=0, users=0))
+
+    def test_capacity_freetimes(self):
+        """do moved & deleted freetimes move the counters"""
+
+        self.tasks[0].freetimes.append(self.freetimes[0])
+        self.freetimes[1].end_time += timedelta(minutes=30)
+        db.session.commit()
+
+        self.assertEqual(self.capacity(), dict(freetime_minutes=150, planned_minutes=20, open_minutes=130, pending_minutes=40))
+
+        db.session.delete(self.freetimes[0])
+        db.session.commit()
+
+        self.assertEqual(self.capacity(), dict(freetime_minutes=90, planned_minutes=0, open_minutes=90, pending_minutes=40))
+
+    def test_capacity_backfill(self):
+        """do users from before the counters get theirs when the tables are created again"""
+
+        self.tasks[0].freetimes.append(self.freetimes[0])
+        db.session.commit()
+        db.session.execute(db.text("ALTER TABLE freetimes DISABLE TRIGGER USER"))
+        db.session.execute(db.text("UPDATE freetimes SET committed_minutes = 0"))
+        db.session.execute(db.text("ALTER TABLE freetimes ENABLE TRIGGER USER"))
+        UserCapacity.query.delete()
+        db.session.commit()
+
+        db.create_all()
+
+        self.assertEqual(self.capacity(), dict(freetime_minutes=120, planned_minutes=20, open_minutes=100, pending_minutes=40))
+        self.assertEqual(UserCapacity.reconcile(), dict(freetimes=0, users=0))
+
+    def test_capacity_reconcile(self):
+        """does reconcile find & fix counters that drifted"""
+
+        self.tasks[0].freetimes.append(self.freetimes[0])
+        db.session.commit()
+        self.assertEqual(UserCapacity.reconcile(), dict(freetimes=0, users=0))
+
+        db.session.execute(db.text("ALTER TABLE freetimes DISABLE TRIGGER USER"))
+        db.session.execute(db.text("UPDATE freetimes SET committed_minutes = 5"))
+        db.session.execute(db.text("ALTER TABLE freetimes ENABLE TRIGGER USER"))
+        db.session.execute(db.text("DELETE FROM user_capacity"))
+        db.session.commit()
+
+        self.assertEqual(UserCapacity.reconcile(), dict(freetimes=2, users=1))
+        self.assertEqual(UserCapacity.reconcile(fix=True), dict(freetimes=2, users=1))
+        self.assertEqual(UserCapacity.reconcile(), dict(freetimes=0, users=0))
+        self.assertEqual(self.capacity(), dict(freetime_minutes=120, planned_minutes=20, open_minutes=100, pending_minutes=40))
+
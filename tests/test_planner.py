@@ -0,0 +1,145 @@
+import os
+from unittest import TestCase
+from datetime import datetime, timedelta
+from time import perf_counter
+from random import Random
+from flask_bcrypt import Bcrypt
+
+from models import db, User, Freetime, FreetimeSeries, Task, blocks
+from planner import plan_greedy, plan_optimized, make_plan, task_value
+
+os.environ['DATABASE_URL'] = "postgresql:///instime_test"
+
+from app import app
+
+app.config["TESTING"] = True
+
+db.drop_all()
+db.create_all()
+
+bcrypt = Bcrypt()
+
+class PackingTestCase(TestCase):
+    """do the packing strategies respect capacity"""
+
+    def check_capacity(self, tasks, freetimes, placed):
+        """asserts no freetime has more minutes assigned than it holds"""
+
+        used = [0] * len(freetimes)
+        minutes = {t[0]: t[2] for t in tasks}
+        for task_id, index in placed.items():
+            used[index] += minutes[task_id]
+        for (_, capacity), total in zip(freetimes, used):
+            self.assertLessEqual(total, capacity)
+
+    def test_plan_greedy(self):
+        """does greedy put high priority tasks in the earliest freetime they fit"""
+
+        tasks = [(1, 0, 45), (2, 9, 60), (3, 5, 90)]
+        freetimes = [(10, 60), (11, 120)]
+
+        placed, unplaced = plan_greedy(tasks, freetimes)
+
+        self.assertEqual(placed, {2: 0, 3: 1})
+        self.assertEqual(unplaced, [(1, 0, 45)])
+
+    def test_plan_optimized(self):
+        """does optimize place at least as much value as greedy"""
+
+        rand = Random(7)
+        tasks = [(i, rand.randint(0, 9), rand.randint(5, 120)) for i in range(300)]
+        freetimes = [(i, rand.randint(10, 180)) for i in range(100)]
+
+        greedy, _ = plan_greedy(tasks, freetimes)
+        optimized, unplaced = plan_optimized(tasks, freetimes)
+        value = lambda placed: sum(task_value(t) for t in tasks if t[0] in placed)
+
+        self.check_capacity(tasks, freetimes, greedy)
+        self.check_capacity(tasks, freetimes, optimized)
+        self.assertGreaterEqual(value(optimized), value(greedy))
+        self.assertEqual(len(optimized) + len(unplaced), len(tasks))
+
+    def test_plan_greedy_large(self):
+        """does greedy stay fast on large accounts"""
+
+        rand = Random(3)
+        tasks = [(i, rand.randint(0, 9), rand.randint(5, 120)) for i in range(10000)]
+        freetimes = [(i, rand.randint(10, 240)) for i in range(5000)]
+
+        start = perf_counter()
+        placed, _ = plan_greedy(tasks, freetimes)
+
+        self.assertLess(perf_counter() - start, 1)
+        self.check_capacity(tasks, freetimes, placed)
+
+class MakePlanTestCase(TestCase):
+    """does the planner work against the database"""
+
+    def setUp(self):
+        """clear out old data and create some sample data"""
+
+        Freetime.query.delete()
+        FreetimeSeries.query.delete()
+        Task.query.delete()
+        User.query.delete()
+
+        hashed_password = bcrypt.generate_password_hash("strongpassword123").decode("utf-8")
+        user = User(email="user@email.com", password=hashed_password, name="Martin Brown")
+        db.session.add(user)
+        db.session.commit()
+
+        day = datetime.utcnow() + timedelta(days=1)
+        freetime = Freetime(start_time=day, end_time=day + timedelta(hours=1), user_id=user.id)
+        tasks = [
+            Task(title="dishes", description="do them", time_estimate=40, priority=5, user_id=user.id),
+            Task(title="laundry", description="fold it", time_estimate=40, priority=1, user_id=user.id),
+            Task(title="taxes", description="file them", status="done", user_id=user.id),
+        ]
+        db.session.add(freetime)
+        db.session.add_all(tasks)
+        db.session.commit()
+
+        self.user = user
+        self.freetime = freetime
+        self.tasks = tasks
+
+    def tearDown(self):
+        """clean out the session"""
+
+        db.session.rollback()
+
+    def test_make_plan(self):
+        """does make_plan propose without saving until asked"""
+
+        plan = make_plan(self.user.id)
+
+        self.assertEqual(plan.assignments, [(self.tasks[0].id, self.freetime.id)])
+        self.assertEqual(plan.unplanned, [self.tasks[1].id])
+        self.assertEqual(db.session.query(blocks).count(), 0)
+
+        self.assertEqual(plan.save(), 1)
+        db.session.commit()
+
+        self.assertEqual(self.freetime.tasks, [self.tasks[0]])
+        self.assertEqual(make_plan(self.user.id).assignments, [])
+        self.assertEqual(plan.save(), 0)
+
+    def test_make_plan_occurrences(self):
+        """does make_plan use occurrences of repeating freetimes & save them when planned"""
+
+        day = datetime.utcnow().replace(microsecond=0) + timedelta(days=2)
+        series = FreetimeSeries(start_time=day, end_time=day + timedelta(hours=1), rule="FREQ=WEEKLY", user_id=self.user.id)
+        db.session.add(series)
+        db.session.commit()
+
+        plan = make_plan(self.user.id)
+        key = f"{series.id}@{day:%Y%m%dT%H%M%S}"
+
+        self.assertEqual(plan.assignments, [(self.tasks[0].id, self.freetime.id), (self.tasks[1].id, key)])
+
+        plan.save()
+        db.session.commit()
+        saved = Freetime.query.filter_by(series_id=series.id).one()
+
+        self.assertEqual((saved.start_time, saved.tasks), (day, [self.tasks[1]]))
+        self.assertEqual(make_plan(self.user.id).assignments, [])
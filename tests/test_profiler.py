@@ -0,0 +1,79 @@
+import os
+from unittest import TestCase
+
+from models import db
+from profiler import normalize_sql
+
+os.environ["DATABASE_URL"] = "postgresql:///instime_test"
+
+from app import app, profiler
+
+app.config["WTF_CSRF_ENABLED"] = False
+app.config["TESTING"] = True
+
+db.drop_all()
+db.create_all()
+
+class NormalizeSQLTestCase(TestCase):
+    """does normalize_sql group statements by shape"""
+
+    def test_normalize_sql(self):
+        """are literals, parameters & IN lists replaced"""
+
+        statement = "SELECT *  FROM tasks\n WHERE id IN (%(id_1)s, %(id_2)s) AND title = 'it''s' AND priority > 5"
+
+        self.assertEqual(normalize_sql(statement), "SELECT * FROM tasks WHERE id IN (...) AND title = ? AND priority > ?")
+
+class SQLProfilerTestCase(TestCase):
+    """does the profiler record sampled requests"""
+
+    def setUp(self):
+        """profile every request"""
+
+        self.client = app.test_client()
+        self.config = {key: app.config[key] for key in ("PROFILER_SAMPLE_RATE", "PROFILER_EXPLAIN_MS", "PROFILER_TOKEN")}
+        app.config.update(PROFILER_SAMPLE_RATE=1.0, PROFILER_EXPLAIN_MS=0, PROFILER_TOKEN="secret")
+        profiler.recent.clear()
+
+    def tearDown(self):
+        """put the profiler settings back"""
+
+        app.config.update(self.config)
+        db.session.rollback()
+
+    def test_profile_header(self):
+        """does a sampled request get the summary header & a stored profile"""
+
+        resp = self.client.get("/login")
+
+        self.assertIn("count=", resp.headers["X-SQL-Profile"])
+        self.assertEqual(profiler.recent[-1]["path"], "/login")
+
+    def test_profile_explain(self):
+        """do slow selects get a query plan"""
+
+        resp = self.client.post("/login", data={"email": "nobody@mail.com", "password": "wrongpassword"})
+        slowest = profiler.recent[-1]["slowest"]
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertTrue(slowest)
+        self.assertTrue(any(entry["plan"] for entry in slowest))
+
+    def test_unsampled(self):
+        """are requests left alone when the sample rate is 0"""
+
+        app.config["PROFILER_SAMPLE_RATE"] = 0
+        resp = self.client.get("/login")
+
+        self.assertNotIn("X-SQL-Profile", resp.headers)
+        self.assertEqual(len(profiler.recent), 0)
+
+    def test_debug_view(self):
+        """is the report only given out with the token"""
+
+        self.client.get("/login")
+
+        self.assertEqual(self.client.get("/debug/sql").status_code, 404)
+        resp = self.client.get("/debug/sql", headers={"X-Debug-Token": "secret"})
+        self.assertEqual(resp.status_code, 200)
+        self.assertIn("statements", resp.json)
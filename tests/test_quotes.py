@@ -0,0 +1,127 @@
+import os
+import json
+import tempfile
+from time import sleep
+from unittest import TestCase
+
+from quotes import QuoteStore, QuotesUnavailable, file_source
+
+os.environ["DATABASE_URL"] = "postgresql:///instime_test"
+
+from app import app, quote_store
+
+QUOTES = [{"text": "Do it now.", "author": "Someone"}, {"text": "Later is fine.", "author": "Someone else"}]
+
+class StandInSource:
+    """a local source that counts its calls & can be told to fail"""
+
+    def __init__(self, quotes=QUOTES):
+        self.quotes = quotes
+        self.calls = 0
+        self.fail = False
+
+    def __call__(self):
+        self.calls += 1
+        if self.fail:
+            raise ConnectionError("source is down")
+        return self.quotes
+
+class QuoteStoreTestCase(TestCase):
+    """does the quote store cache & protect the source"""
+
+    def setUp(self):
+        """make a temporary local store"""
+
+        self.dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.dir.name, "quotes.json")
+        self.source = StandInSource()
+
+    def tearDown(self):
+        """remove the local store"""
+
+        self.dir.cleanup()
+
+    def test_cached(self):
+        """does the store only hit the source once while fresh"""
+
+        store = QuoteStore(self.source, self.path)
+
+        self.assertIn(store.random(), QUOTES)
+        self.assertIn(store.random(), QUOTES)
+        self.assertEqual(self.source.calls, 1)
+
+    def test_local_file(self):
+        """does a new store start from the local file"""
+
+        QuoteStore(self.source, self.path).all()
+        store = QuoteStore(StandInSource([]), self.path)
+
+        self.assertEqual(store.all(), QUOTES)
+
+    def test_stale_while_revalidate(self):
+        """does a stale store keep serving while it refreshes in the background"""
+
+        store = QuoteStore(self.source, self.path, ttl=0)
+        store.all()
+        newer = [{"text": "New.", "author": "Anon"}]
+        self.source.quotes = newer
+
+        self.assertEqual(store.all(), QUOTES)
+        for _ in range(50):
+            if store.quotes == newer:
+                break
+            sleep(0.01)
+        self.assertEqual(store.quotes, newer)
+
+    def test_circuit_breaker(self):
+        """does the store stop calling a failing source"""
+
+        self.source.fail = True
+        store = QuoteStore(self.source, max_failures=2, cooldown=60)
+
+        for _ in range(4):
+            self.assertRaises(QuotesUnavailable, store.all)
+        self.assertEqual(self.source.calls, 2)
+        self.assertTrue(store.is_open)
+
+    def test_file_source(self):
+        """does the file source read both json layouts"""
+
+        with open(self.path, "w") as file:
+            json.dump({"quotes": QUOTES}, file)
+
+        self.assertEqual(file_source(self.path)(), QUOTES)
+
+class QuoteRoutesTestCase(TestCase):
+    """do the quote routes serve from the store"""
+
+    def setUp(self):
+        """point the app's store at a stand-in source"""
+
+        self.client = app.test_client()
+        self.source, quote_store.source = quote_store.source, StandInSource()
+        self.quotes, quote_store.quotes = quote_store.quotes, []
+
+    def tearDown(self):
+        """put the app's store back"""
+
+        quote_store.source = self.source
+        quote_store.quotes = self.quotes
+
+    def test_random_quote(self):
+        """does the random quote route give one quote"""
+
+        resp = self.client.get("/quotes/random")
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertIn(resp.json["quote"], QUOTES)
+
+    def test_quotes_unavailable(self):
+        """does the route report when there are no quotes"""
+
+        quote_store.source.fail = True
+        quote_store.opened_at = None
+        resp = self.client.get("/quotes")
+
+        self.assertEqual(resp.status_code, 503)
+        self.assertIn("error", resp.json)
@@ -0,0 +1,137 @@
+import os
+import json
+from unittest import TestCase
+from sqlalchemy import create_engine, text
+
+from models import db, User, Task
+from routing import pool_options, is_read, STICKY_KEY
+
+os.environ['DATABASE_URL'] = "postgresql:///instime_test"
+
+from app import app
+
+app.config["TESTING"] = True
+app.config["WTF_CSRF_ENABLED"] = False
+
+db.drop_all()
+db.create_all()
+
+# a second database stands in for a replica, it's only "replicated" by the tests themselves
+REPLICA_URL = "postgresql:///instime_test_replica"
+
+with create_engine("postgresql:///instime_test", isolation_level="AUTOCOMMIT").connect() as conn:
+    if not conn.execute(text("SELECT 1 FROM pg_database WHERE datname = 'instime_test_replica'")).scalar():
+        conn.execute(text("CREATE DATABASE instime_test_replica"))
+
+class PoolOptionsTestCase(TestCase):
+    """are pools sized per engine & worker"""
+
+    def test_pool_options(self):
+        """do the prefixed settings size the pool"""
+
+        options = pool_options("DB_REPLICA", environ={"DB_REPLICA_POOL_SIZE": "3", "DB_REPLICA_POOL_TIMEOUT": "2.5"})
+
+        self.assertEqual(options, dict(pool_size=3, max_overflow=10, pool_timeout=2.5))
+
+    def test_pool_options_budget(self):
+        """is a connection budget split between the workers"""
+
+        options = pool_options("DB", environ={"DB_MAX_CONNECTIONS": "40", "WEB_CONCURRENCY": "4"})
+
+        self.assertEqual((options["pool_size"], options["max_overflow"]), (5, 5))
+        self.assertEqual(pool_options("DB", workers=80, environ={"DB_MAX_CONNECTIONS": "40"})["pool_size"], 1)
+
+    def test_is_read(self):
+        """are only plain reads sent to replicas"""
+
+        self.assertTrue(is_read(db.select(Task.id)))
+        self.assertTrue(is_read(text(" select 1")))
+        self.assertFalse(is_read(db.select(Task.id).with_for_update()))
+        self.assertFalse(is_read(db.update(Task).values(priority=1)))
+        self.assertFalse(is_read(text("ANALYZE tasks")))
+        self.assertFalse(is_read(text("WITH gone AS (DELETE FROM tasks RETURNING id) SELECT count(*) FROM gone")))
+        self.assertFalse(is_read(None))
+
+class ReplicaRoutingTestCase(TestCase):
+    """do read only requests go to the replica & users who wrote stay on the primary"""
+
+    def setUp(self):
+        """point a replica bind at the second database & log in a user that exists in both"""
+
+        app.config["SQLALCHEMY_BINDS"] = {"replica_0": REPLICA_URL}
+        app.config["REPLICA_BINDS"] = ["replica_0"]
+        self.replica = db.get_engine(app, bind="replica_0")
+        db.metadata.drop_all(bind=self.replica)
+        db.metadata.create_all(bind=self.replica)
+
+        Task.query.delete()
+        User.query.delete()
+        user = User.register("user@email.com", "strongpassword123", "Martin Brown")
+        db.session.commit()
+        self.replicate("users")
+
+        self.client = app.test_client()
+        self.client.post("/login", data={"email": "user@email.com", "password": "strongpassword123"})
+        self.unstick()
+        self.user = user
+
+    def tearDown(self):
+        """take the replica away again"""
+
+        db.session.rollback()
+        app.config["SQLALCHEMY_BINDS"] = {}
+        app.config["REPLICA_BINDS"] = []
+
+    def replicate(self, table):
+        """copies a table's rows from the primary into the replica"""
+        # generated columns are computed again by the replica
+        columns = [c for c in db.metadata.tables[table].columns if c.computed is None]
+        rows = [dict(row) for row in db.session.execute(db.select(columns)).mappings()]
+        with self.replica.begin() as conn:
+            conn.execute(text(f"DELETE FROM {table}"))
+            if rows:
+                conn.execute(db.metadata.tables[table].insert(), rows)
+
+    def unstick(self):
+        """forgets the user's last write, as if the replicas had caught up"""
+        with self.client.session_transaction() as session:
+            session.pop(STICKY_KEY, None)
+
+    def add_task(self, title):
+        task = Task(title=title, description="sakjhga", user_id=self.user.id)
+        db.session.add(task)
+        User.bump_version(self.user.id)
+        db.session.commit()
+        return task
+
+    def test_reads_go_to_replica(self):
+        """does a page leave out rows the replica doesn't have yet"""
+
+        self.add_task("unreplicated")
+
+        self.assertNotIn("unreplicated", self.client.get("/tasks").get_data(as_text=True))
+
+        self.replicate("users")
+        self.replicate("tasks")
+
+        self.assertIn("unreplicated", self.client.get("/tasks").get_data(as_text=True))
+
+    def test_read_your_writes(self):
+        """does a user read from the primary right after writing"""
+
+        self.client.post("/tasks", data={"title": "fresh", "description": "sakjhga", "status": "pending", "priority": 1})
+
+        self.assertIn("fresh", self.client.get("/tasks").get_data(as_text=True))
+
+        self.unstick()
+
+        self.assertNotIn("fresh", self.client.get("/tasks").get_data(as_text=True))
+
+    def test_streamed_writes_stick(self):
+        """does a streamed ndjson batch, committed after the headers went out, keep the user on the primary"""
+
+        line = json.dumps({"op": "create", "start": "2030-01-01T08:00:00Z", "end": "2030-01-01T09:00:00Z"})
+        self.client.post("/times/batch", data=line, content_type="application/x-ndjson").get_data()
+
+        with self.client.session_transaction() as session:
+            self.assertIn(STICKY_KEY, session)
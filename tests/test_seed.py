@@ -0,0 +1,76 @@
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+
+from models import db, User, Freetime, Task, UserCapacity, blocks
+
+os.environ['DATABASE_URL'] = "postgresql:///instime_test"
+
+from app import app
+from seed import Dataset, load
+
+app.config["TESTING"] = True
+
+db.drop_all()
+db.create_all()
+
+class DatasetTestCase(TestCase):
+    """does the generator make the same valid data every time"""
+
+    def setUp(self):
+        """make a place for the files"""
+
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        """clean out the files & the session"""
+
+        shutil.rmtree(self.directory)
+        db.session.rollback()
+
+    def read(self, table):
+        with open(os.path.join(self.directory, f"{table}.tsv")) as file:
+            return [line.rstrip("\n").split("\t") for line in file]
+
+    def test_dataset_deterministic(self):
+        """do the same arguments give the same rows & another seed different ones"""
+
+        rows = list(Dataset(users=20, skew=1, seed=3).rows())
+
+        self.assertEqual(list(Dataset(users=20, skew=1, seed=3).rows()), rows)
+        self.assertNotEqual(list(Dataset(users=20, skew=1, seed=4).rows()), rows)
+
+    def test_dataset_write(self):
+        """are freetimes apart, blocks within their user & heavy users heavier with skew"""
+
+        counts = Dataset(users=50, tasks=10, freetimes=10, blocks=0.5, skew=1.2).write(self.directory)
+
+        self.assertEqual(counts["users"], 50)
+        freetimes = self.read("freetimes")
+        self.assertEqual(len(freetimes), counts["freetimes"])
+        owners = {id: user_id for id, _, _, user_id, _ in freetimes}
+        tasks = {id: user_id for id, _, _, _, _, _, user_id, _ in self.read("tasks")}
+        self.assertTrue(all(owners[freetime_id] == tasks[task_id] for task_id, freetime_id in self.read("blocks")))
+        per_user = {}
+        for _, start, end, user_id, _ in freetimes:
+            per_user.setdefault(user_id, []).append((start, end))
+        for windows in per_user.values():
+            self.assertTrue(all(end <= next_start for (_, end), (next_start, _) in zip(windows, windows[1:])))
+        self.assertGreater(len(per_user["1"]), len(per_user.get("50", [])))
+
+    def test_load(self):
+        """do the files load & leave the sequences ready for new rows"""
+
+        counts = Dataset(users=5, tasks=3, freetimes=3).write(self.directory)
+        load(self.directory)
+
+        self.assertEqual(User.query.count(), 5)
+        self.assertEqual(Freetime.query.count(), counts["freetimes"])
+        self.assertEqual(db.session.query(blocks).count(), counts["blocks"])
+        task = Task(title="new", description="after the seed", user_id=1)
+        db.session.add(task)
+        db.session.commit()
+        self.assertEqual(task.id, counts["tasks"] + 1)
+        self.assertTrue(User.authenticate("user1@example.com", "password123"))
+        self.assertEqual(UserCapacity.reconcile(), dict(freetimes=0, users=0))
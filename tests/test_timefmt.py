@@ -0,0 +1,60 @@
+from unittest import TestCase
+from datetime import datetime, timedelta
+from time import perf_counter
+from dateutil import tz
+
+from timefmt import TimeFormatter, get_formatter, is_timezone
+
+# how the app shows times, as a plain strftime format
+DISPLAY_FORMAT = "%b %d, %Y @ %H:%M"
+
+class TimeFormatterTestCase(TestCase):
+    """does the formatter show times like a plain conversion would"""
+
+    def plain(self, value, tzname):
+        """formats a naive UTC datetime the slow way"""
+
+        return value.replace(tzinfo=tz.tzutc()).astimezone(tz.gettz(tzname)).strftime(DISPLAY_FORMAT)
+
+    def test_format_across_dst(self):
+        """are times around daylight saving changes shifted right"""
+
+        formatter = TimeFormatter("America/New_York")
+        start = datetime(2030, 3, 10, 5)
+        values = [start + timedelta(minutes=7 * i) for i in range(100)]
+
+        self.assertEqual([formatter.format(v) for v in values], [self.plain(v, "America/New_York") for v in values])
+
+    def test_format_ranges(self):
+        """are ranges joined into start - end labels"""
+
+        formatter = TimeFormatter("UTC")
+        labels = formatter.format_ranges([(datetime(2030, 1, 1, 8), datetime(2030, 1, 1, 9, 30))])
+
+        self.assertEqual(labels, ["Jan 01, 2030 @ 08:00 - Jan 01, 2030 @ 09:30"])
+
+    def test_get_formatter(self):
+        """is one formatter shared per timezone"""
+
+        self.assertIs(get_formatter("Europe/Paris"), get_formatter("Europe/Paris"))
+        self.assertRaises(ValueError, get_formatter, "Not/AZone")
+
+    def test_is_timezone(self):
+        """are only timezone names accepted"""
+
+        self.assertTrue(is_timezone("Asia/Kathmandu"))
+        self.assertFalse(is_timezone("Mars/Olympus"))
+        self.assertFalse(is_timezone("/etc/passwd"))
+        self.assertFalse(is_timezone(None))
+
+    def test_format_ranges_fast(self):
+        """do a few thousand labels take milliseconds"""
+
+        formatter = TimeFormatter("Australia/Sydney")
+        start = datetime(2030, 1, 1)
+        ranges = [(start + timedelta(minutes=37 * i), start + timedelta(minutes=37 * i + 30)) for i in range(5000)]
+
+        began = perf_counter()
+        formatter.format_ranges(ranges)
+
+        self.assertLess(perf_counter() - began, 0.5)
@@ -0,0 +1,105 @@
+import re
+from datetime import timedelta
+from functools import lru_cache
+
+from dateutil import tz
+
+# date part of how times are shown to users, TimeFormatter adds " @ hours:minutes" to it
+DATE_FORMAT = "%b %d, %Y"
+
+# most formatted minutes a formatter remembers before starting over
+MEMO_SIZE = 100000
+
+DAY = timedelta(days=1)
+HOUR = timedelta(hours=1)
+TICK = timedelta(microseconds=1)
+
+# shape of IANA names like America/New_York, keeps file paths away from dateutil's gettz
+TZ_NAME = re.compile(r"^[A-Za-z][A-Za-z0-9_+\-]*(/[A-Za-z0-9_+\-]+)*$")
+
+class TimeFormatter:
+    """formats stored UTC datetimes in one timezone, remembering offsets & formatted minutes
+
+    A timezone's offset changes at most once in a day, so when a UTC day starts & ends
+    on the same offset it's reused for every time in that day, otherwise the day falls
+    back to hours. Display strings only show minutes, so each minute is only formatted
+    once, and each day's date part is only formatted once.
+    """
+
+    def __init__(self, tzname=None):
+        if tzname and not is_timezone(tzname):
+            raise ValueError(f"unknown timezone {tzname}")
+        self.tzname = tzname
+        self.tz = tz.gettz(tzname) if tzname else tz.tzlocal()
+        self.offsets = {}
+        self.days = {}
+        self.memo = {}
+
+    def __repr__(self):
+        return f"<TimeFormatter {self.tzname or 'local'} memo={len(self.memo)}>"
+
+    def span_offset(self, start, length):
+        """gives the offset shared by all of [start, start + length) or None if it changes"""
+        utc = tz.tzutc()
+        first = start.replace(tzinfo=utc).astimezone(self.tz).utcoffset()
+        last = (start + length - TICK).replace(tzinfo=utc).astimezone(self.tz).utcoffset()
+        return first if first == last else None
+
+    def offset(self, value):
+        """gives the UTC offset of the timezone at a naive UTC datetime"""
+        day = value.replace(hour=0, minute=0, second=0, microsecond=0)
+        offset = self.offsets.get(day)
+        if offset is None:
+            offset = self.offsets[day] = self.span_offset(day, DAY) or False
+        if offset is False:
+            hour = value.replace(minute=0, second=0, microsecond=0)
+            offset = self.offsets.get(hour)
+            if offset is None:
+                offset = self.offsets[hour] = self.span_offset(hour, HOUR) or False
+            if offset is False:
+                offset = value.replace(tzinfo=tz.tzutc()).astimezone(self.tz).utcoffset()
+        return offset
+
+    def format(self, value):
+        """formats one naive UTC datetime into a display date
+
+        Returns:
+            string: nicely formatted date in the formatter's timezone
+        """
+        minute = value.replace(second=0, microsecond=0)
+        text = self.memo.get(minute)
+        if text is None:
+            if len(self.memo) >= MEMO_SIZE:
+                self.memo.clear()
+                self.offsets.clear()
+                self.days.clear()
+            local = minute + self.offset(minute)
+            date = local.date()
+            day = self.days.get(date)
+            if day is None:
+                day = self.days[date] = date.strftime(DATE_FORMAT)
+            text = self.memo[minute] = f"{day} @ {local.hour:02}:{local.minute:02}"
+        return text
+
+    def format_ranges(self, ranges):
+        """formats (start, end) pairs into "start - end" labels"""
+        format = self.format
+        return [f"{format(start)} - {format(end)}" for start, end in ranges]
+
+@lru_cache(maxsize=256)
+def get_formatter(tzname=None):
+    """gives the shared formatter of a timezone, the server's local zone when tzname is None
+
+    Raises:
+        ValueError: when tzname isn't a known timezone
+    """
+    return TimeFormatter(tzname)
+
+def is_timezone(tzname):
+    """whether tzname is a timezone name dateutil knows"""
+    if not (isinstance(tzname, str) and TZ_NAME.match(tzname)):
+        return False
+    try:
+        return tz.gettz(tzname) is not None
+    except ValueError:
+        return False